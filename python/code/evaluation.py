@@ -27,6 +27,7 @@
 
 def evaluate(model,
              libchips,
+             ctx,
              device,
              args,
              arg_hash):
@@ -35,6 +36,7 @@ def evaluate(model,
     Arguments:
         model {torch.nn.Module} -- The model to evaluate
         libchips {ctypes.CDLL} -- A shared library handle through which data can be read
+        ctx {int} -- The libchips context from which to read
         device {torch.device} -- The device to use for evaluation
         args {argparse.Namespace} -- The arguments dictionary
         arg_hash {str} -- The hashed arguments
@@ -53,8 +55,8 @@ def evaluate(model,
 
         batch_mult = 2
         for _ in range(args.max_eval_windows // (batch_mult * args.batch_size)):
-            batch = get_batch(libchips, args, batch_multiplier=batch_mult)
-            pred = model(batch[0].to(device))
+            batch = batch_to_device(get_batch(libchips, ctx, args, batch_multiplier=batch_mult), device, args)
+            pred = model(batch[0])
 
             if isinstance(pred, dict):
                 pred_seg = pred.get('seg', pred.get('out', None))
@@ -64,7 +66,7 @@ def evaluate(model,
                 pred_seg = pred
                 pred_2seg = pred_reg = None
 
-            if args.window_size_labels != args.window_size_imagery:
+            if args.window_size_labels != args.chip_size:
                 if pred_seg is not None:
                     pred_seg = torch.nn.functional.interpolate(
                         pred_seg, args.window_size_labels, mode='bilinear', align_corners=False)
@@ -132,7 +134,7 @@ def evaluate(model,
                     ).sum()
 
             if random.randint(0, args.batch_size * 4) == 0:
-                libchips.recenter(1)
+                libchips.recenter(ctx, 1)
 
             global EVALUATIONS_BATCHES_DONE
             EVALUATIONS_BATCHES_DONE += 1
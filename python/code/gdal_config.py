@@ -0,0 +1,57 @@
+# The MIT License (MIT)
+# =====================
+#
+# Copyright © 2020 Azavea
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the “Software”), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+
+
+def gdal_config_array(options: Optional[List[str]]) -> Any:
+    """Given optional KEY=VALUE GDAL configuration options, return a NULL-terminated C array of them suitable for passing to libchips
+
+    Arguments:
+        options {Optional[List[str]]} -- The options (or None)
+
+    Returns:
+        Any -- The array, or None if there are no options
+    """
+    if not options:
+        return None
+    return (ctypes.c_char_p * (len(options) + 1))(*[option.encode() for option in options], None)
+
+
+def print_gdal_config(libchips: ctypes.CDLL, ctx: int, options: Optional[List[str]]) -> None:
+    """Print the GDAL configuration that the threads of a libchips context actually read with
+
+    Arguments:
+        libchips {ctypes.CDLL} -- A shared library handle
+        ctx {int} -- The libchips context
+        options {Optional[List[str]]} -- The KEY=VALUE options given to the context (or None)
+    """
+    keys = ['GDAL_CACHEMAX', 'GDAL_NUM_THREADS', 'VSI_CACHE', 'VSI_CACHE_SIZE',
+            'GDAL_HTTP_MULTIRANGE', 'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES']
+    keys += [option.split('=')[0] for option in (options or []) if option.split('=')[0] not in keys]
+    value = ctypes.create_string_buffer(0x100)
+    for key in keys:
+        if libchips.get_config_option(ctx, key.encode(), value, len(value)):
+            print('\t {}={}'.format(key, value.value.decode()))
+        else:
+            print('\t {} unset'.format(key))
@@ -25,113 +25,162 @@
 # OTHER DEALINGS IN THE SOFTWARE.
 
 
-def numpy_replace(np_arr,
-                  replacement_dict,
-                  label_nd):
-    """Replace the contents of np_arr according to the mapping given in replacement_dict
-
-    Arguments:
-        np_arr {np.ndarray} -- The numpy array to alter
-        replacement_dict {INT2INT} -- The replacement mapping
-        label_nd {SCALER} -- The label nodata
-
-    Returns:
-        np.ndarray -- The array with replacement performed
-    """
-    b = np.copy(np_arr)
-    b[~np.isin(np_arr, list(replacement_dict.keys()))] = label_nd
-    for k, v in replacement_dict.items():
-        b[np_arr == k] = v
-    return b
+# GDAL data types as (numpy, torch) pairs; unsigned words travel
+# bit-for-bit in the signed torch type of the same width and are
+# widened on the device
+GDAL_TYPES = {
+    1: (np.uint8, torch.uint8),
+    2: (np.uint16, torch.int16),
+    3: (np.int16, torch.int16),
+    4: (np.uint32, torch.int32),
+    5: (np.int32, torch.int32),
+    6: (np.float32, torch.float32),
+    7: (np.float64, torch.float64),
+}
 
 
 def get_batch(libchips,
+              ctx,
               args,
               batch_multiplier=1):
-    """Read a batch of imagery and labels
+    """Read a batch of imagery and labels in the native types of the rasters
 
     Arguments:
         libchips {ctypes.CDLL} -- A shared library handle used for reading data
+        ctx {int} -- The libchips context from which to read
         args {argparse.Namespace} -- The arguments dictionary
 
     Keyword Arguments:
         batch_multiplier {int} -- How many base batches to fetch at once
 
     Returns:
-        Tuple[torch.Tensor, torch.Tensor] -- The raster data and label data as PyTorch tensors in a tuple
+        Tuple[torch.Tensor, torch.Tensor, np.ndarray] -- The raw raster data and label data as host PyTorch tensors, and the (pair, x, y) origin of each window
+    """
+    n = args.batch_size * batch_multiplier
+    shape_imagery = (n, len(args.bands), args.chip_size, args.chip_size)
+    shape_labels = (n, args.window_size_labels, args.window_size_labels)
+
+    # The batch is written directly into (pinned, if possible) host
+    # memory so that it can be sent to the device without further
+    # copying
+    pin_memory = (args.backend == 'cuda')
+    raster_batch_tensor = torch.empty(
+        shape_imagery, dtype=GDAL_TYPES[args.imagery_data_type][1], pin_memory=pin_memory)
+    label_batch_tensor = torch.empty(
+        shape_labels, dtype=GDAL_TYPES[args.label_data_type][1], pin_memory=pin_memory)
+    rasters = raster_batch_tensor.numpy()
+    labels = label_batch_tensor.numpy()
+    origins = np.zeros((n, 3), dtype=np.int32)
+
+    # Forbidden and desired label values are handled by the readers
+    start, count = 0, n
+    while count > 0:
+        got = libchips.get_next_batch_timeout(
+            ctx,
+            rasters[start:].ctypes.data_as(ctypes.c_void_p),
+            labels[start:].ctypes.data_as(ctypes.c_void_p),
+            origins[start:].ctypes.data_as(ctypes.POINTER(ctypes.c_int32)),
+            count,
+            args.read_timeout * 1000)
+        if got == 0:
+            print('\t\t WARNING: NO WINDOW AFTER {} SECONDS, READERS MAY HAVE STALLED'.format(
+                args.read_timeout))
+        start += got
+        count -= got
+
+    return (raster_batch_tensor, label_batch_tensor, origins)
+
+
+def widen(tensor, data_type):
+    """Reinterpret a tensor of raw words as the GDAL type that it holds
+
+    Arguments:
+        tensor {torch.Tensor} -- A tensor from get_batch
+        data_type {int} -- The GDAL data type of its words
+
+    Returns:
+        torch.Tensor -- A tensor in which every value is represented exactly
+    """
+    if data_type == 2:
+        return tensor.int() & 0xffff
+    elif data_type == 4:
+        return tensor.long() & 0xffffffff
+    return tensor
+
+
+def batch_to_device(batch, device, args):
+    """Send a batch to the device, then widen, mask and normalize it there
+
+    Arguments:
+        batch {Tuple[torch.Tensor, torch.Tensor, np.ndarray]} -- A batch from get_batch
+        device {torch.device} -- The device on which the model lives
+        args {argparse.Namespace} -- The arguments dictionary
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor, np.ndarray] -- Float imagery and long labels on the device, and the origins of the windows
     """
     assert(args.label_nd is not None)
 
-    shape_imagery = (len(args.bands), args.window_size_imagery,
-                     args.window_size_imagery)
-    shape_labels = (args.window_size_labels, args.window_size_labels)
-
-    temp1 = np.zeros(shape_imagery, dtype=np.float32)
-    temp1_ptr = temp1.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
-    temp2 = np.zeros(shape_labels, dtype=np.int32)
-    temp2_ptr = temp2.ctypes.data_as(ctypes.POINTER(ctypes.c_int32))
-
-    rasters = []
-    labels = []
-    for _ in range(args.batch_size * batch_multiplier):
-
-        while True:
-            again = False
-            libchips.get_next(temp1_ptr, temp2_ptr)
-            if args.forbidden_imagery_value is not None:
-                again = again or np.any(
-                    temp1 == args.forbidden_imagery_value)
-            if args.forbidden_label_value is not None:
-                again = again or np.any(
-                    temp2 == args.forbidden_label_value)
-            if args.desired_label_value is not None:
-                if not np.any(temp2 == args.desired_label_value):
-                    again = again or (args.reroll > random.random())
-            if not again:
-                break
-
-        rasters.append(temp1.copy())
-        labels.append(temp2.copy())
-
-    raster_batch = []
-    label_batch = []
-    for raster, label in zip(rasters, labels):
-
-        # NODATA from labels
-        label = np.array(label, dtype=np.long)
-        label = numpy_replace(label, args.label_map, args.label_nd)
-        label_nds = (label == args.label_nd)
-
-        # NODATA from rasters
-        image_nds = np.zeros(raster[0].shape)
-        if args.image_nd is not None:
-            image_nds += (raster == args.image_nd).sum(axis=0)
-
-        # NODATA from NaNs in rasters
-        image_nds += np.isnan(raster).sum(axis=0)
-
-        # Set label NODATA, remove NaNs from rasters
-        if args.window_size_imagery == args.window_size_labels:
-            nodata1 = nodata2 = ((image_nds + label_nds) > 0)
-        else:
-            ratio = float(args.window_size_labels) / args.window_size_imagery
-            image_nds2 = scipy.ndimage.zoom(
-                image_nds, ratio, order=0, prefilter=False)
-            label_nds2 = scipy.ndimage.zoom(
-                label_nds, 1/ratio, order=0, prefilter=False)
-            nodata1 = ((image_nds2 + label_nds) > 0)
-            nodata2 = ((image_nds + label_nds2) > 0)
-        label[nodata1 == True] = args.label_nd
-        for i in range(len(raster)):
-            raster[i][nodata2 == True] = 0.0
+    rasters = widen(batch[0].to(device, non_blocking=True), args.imagery_data_type).float()
+    labels = widen(batch[1].to(device, non_blocking=True), args.label_data_type).long()
 
-        raster_batch.append(raster)
-        label_batch.append(label)
+    # NODATA from labels (the label map is applied by the readers)
+    label_nds = (labels == args.label_nd)
 
-    raster_batch_tensor = torch.from_numpy(np.stack(raster_batch, axis=0))
-    label_batch_tensor = torch.from_numpy(np.stack(label_batch, axis=0))
+    # NODATA from rasters and from NaNs in rasters
+    image_nds = torch.isnan(rasters).any(dim=1)
+    if args.image_nd is not None:
+        image_nds |= (rasters == args.image_nd).any(dim=1)
 
-    return (raster_batch_tensor, label_batch_tensor)
+    if args.mus is not None and args.sigmas is not None:
+        mus = torch.tensor(args.mus, dtype=torch.float32, device=device)
+        sigmas = torch.tensor(args.sigmas, dtype=torch.float32, device=device)
+        sigmas = torch.where(sigmas > 0, sigmas, torch.ones_like(sigmas))
+        rasters = (rasters - mus[None, :, None, None]) / sigmas[None, :, None, None]
+
+    # Set label NODATA, remove NaNs from rasters
+    if args.chip_size == args.window_size_labels:
+        nodata1 = nodata2 = (image_nds | label_nds)
+    else:
+        image_nds2 = torch.nn.functional.interpolate(
+            image_nds[:, None].float(), args.window_size_labels, mode='nearest')[:, 0] > 0
+        label_nds2 = torch.nn.functional.interpolate(
+            label_nds[:, None].float(), args.chip_size, mode='nearest')[:, 0] > 0
+        nodata1 = (image_nds2 | label_nds)
+        nodata2 = (image_nds | label_nds2)
+    labels[nodata1] = args.label_nd
+    rasters = rasters.masked_fill(nodata2[:, None], 0.0)
+
+    return (rasters, labels, batch[2])
+
+
+def report_losses(libchips, ctx, origins, pred_seg, pred_2seg, labels, args):
+    """Give libchips the loss of each window of a batch so that it can revisit hard ones
+
+    Arguments:
+        libchips {ctypes.CDLL} -- A shared library handle used for reading data
+        ctx {int} -- The libchips context from which the batch was read
+        origins {np.ndarray} -- The (pair, x, y) origin of each window
+        pred_seg {Optional[torch.Tensor]} -- Segmentation predictions (or None)
+        pred_2seg {Optional[torch.Tensor]} -- Binary segmentation predictions (or None)
+        labels {torch.Tensor} -- The labels of the batch
+        args {argparse.Namespace} -- The arguments dictionary
+    """
+    with torch.no_grad():
+        valid = (labels != args.label_nd).float()
+        if pred_seg is not None:
+            pixel_losses = torch.nn.functional.cross_entropy(
+                pred_seg, labels, ignore_index=args.label_nd, reduction='none')
+        elif pred_2seg is not None:
+            pixel_losses = torch.nn.functional.binary_cross_entropy_with_logits(
+                pred_2seg, (labels == 1).float(), reduction='none')
+        else:
+            return
+        losses = (pixel_losses * valid).sum(dim=(1, 2)) / valid.sum(dim=(1, 2)).clamp(min=1)
+        losses = losses.cpu().numpy().astype(np.float32)
+    libchips.report_losses(ctx, len(losses),
+                           origins.ctypes.data_as(ctypes.POINTER(ctypes.c_int32)),
+                           losses.ctypes.data_as(ctypes.POINTER(ctypes.c_float)))
 
 
 def train(model,
@@ -140,6 +189,7 @@ def train(model,
           obj,
           epochs,
           libchips,
+          ctx,
           device,
           args,
           arg_hash,
@@ -153,6 +203,7 @@ def train(model,
         obj {OBJ} -- The objective function to use
         epochs {int} -- The number of "epochs"
         libchips {ctypes.CDLL} -- A shared library handle through which data can be read
+        ctx {int} -- The libchips context from which to read
         device {torch.device} -- The device to use
         args {argparse.Namespace} -- The arguments dictionary
         arg_hash {str} -- The arguments hash
@@ -162,13 +213,19 @@ def train(model,
         starting_epoch {int} -- The starting epoch (default: {0})
     """
     current_time = time.time()
+    stats = np.zeros(8, dtype=np.uint64)
+    libchips.get_stats(ctx, -1, stats.ctypes.data_as(
+        ctypes.POINTER(ctypes.c_uint64)))
+    pair_chips = np.zeros(len(args.pairs), dtype=np.uint64)
+    libchips.get_pair_stats(ctx, None, pair_chips.ctypes.data_as(
+        ctypes.POINTER(ctypes.c_uint64)))
     model.train()
     for i in range(starting_epoch, epochs):
         avg_loss = 0.0
         for _ in range(args.max_epoch_size):
-            batch = get_batch(libchips, args)
+            batch = batch_to_device(get_batch(libchips, ctx, args), device, args)
             opt.zero_grad()
-            pred = model(batch[0].to(device))
+            pred = model(batch[0])
             loss = None
 
             if isinstance(pred, dict):
@@ -181,7 +238,7 @@ def train(model,
                 pred_aux = pred_2seg = pred_reg = None
 
             # Scale predictions to labels if needed
-            if args.window_size_labels != args.window_size_imagery:
+            if args.window_size_labels != args.chip_size:
                 if pred_seg is not None:
                     pred_seg = torch.nn.functional.interpolate(
                         pred_seg, args.window_size_labels, mode='bilinear', align_corners=False)
@@ -195,20 +252,23 @@ def train(model,
             # Various kinds of segmentation
             if pred_seg is not None and pred_aux is None:
                 # segmentation only
-                labels = batch[1].to(device)
+                labels = batch[1]
                 loss = obj.get('seg')(pred_seg, labels)
             elif pred_seg is not None and pred_aux is not None:
                 # segmentation with auxiliary output
-                labels = batch[1].to(device)
+                labels = batch[1]
                 loss = obj.get('seg')(pred_seg, labels) + \
                     0.4 * obj.get('seg')(pred_aux, labels)
             elif pred_2seg is not None:
                 # binary segmentation only
-                labels = (batch[1] == 1).to(device, dtype=torch.float)
+                labels = (batch[1] == 1).float()
                 # XXX the above assumes that background and target are 0 and 1, respectively
                 pred_2seg = pred_2seg[:, 0, :, :]
                 loss = obj.get('2seg')(pred_2seg, labels)
 
+            if args.hard_example_fraction > 0:
+                report_losses(libchips, ctx, batch[2], pred_seg, pred_2seg, batch[1], args)
+
             if pred_reg is not None:
                 pcts = []
                 for label in batch[1].cpu().numpy():
@@ -227,12 +287,43 @@ def train(model,
             avg_loss = avg_loss + loss.item()
 
         avg_loss = avg_loss / args.max_epoch_size
-        libchips.recenter(0)
+        libchips.recenter(ctx, 0)
 
         last_time = current_time
         current_time = time.time()
         print('\t\t epoch={}/{} time={} avg_loss={}'.format(
             i+1, epochs, current_time - last_time, avg_loss))
+        last_stats = stats.copy()
+        libchips.get_stats(ctx, -1, stats.ctypes.data_as(
+            ctypes.POINTER(ctypes.c_uint64)))
+        windows, nbytes, rejections, failures, slot_wait, consumer_wait = \
+            (stats[:6] - last_stats[:6]).tolist()
+        prefetched = int(stats[7] - last_stats[7])
+        print('\t\t reads_per_second={} megabytes={} rejections={} failures={} reader_slot_wait={} consumer_wait={} full_slots={} prefetched={}'.format(
+            windows / (current_time - last_time), nbytes / (1 << 20), rejections, failures,
+            slot_wait / (1e9 * args.read_threads), consumer_wait / 1e9, int(stats[6]), prefetched))
+        last_pair_chips = pair_chips.copy()
+        libchips.get_pair_stats(ctx, None, pair_chips.ctypes.data_as(
+            ctypes.POINTER(ctypes.c_uint64)))
+        print('\t\t pair_chips={}'.format((pair_chips - last_pair_chips).tolist()))
+        if args.class_frequencies is not None:
+            seen = np.zeros(len(args.class_frequencies), dtype=np.uint64)
+            accepted = np.zeros(len(args.class_frequencies), dtype=np.uint64)
+            libchips.get_class_stats(ctx, seen.ctypes.data_as(ctypes.POINTER(ctypes.c_uint64)),
+                                     accepted.ctypes.data_as(ctypes.POINTER(ctypes.c_uint64)))
+            print('\t\t class_frequencies={} class_acceptance_rates={}'.format(
+                (accepted / max(accepted.sum(), 1)).round(4).tolist(),
+                (accepted / np.maximum(seen, 1)).round(4).tolist()))
+        if args.block_cache_megabytes > 0:
+            hits, misses, nbytes = ctypes.c_uint64(), ctypes.c_uint64(), ctypes.c_uint64()
+            libchips.get_cache_stats(ctx, hits, misses, nbytes)
+            print('\t\t block_cache_hits={} block_cache_misses={} block_cache_bytes={}'.format(
+                hits.value, misses.value, nbytes.value))
+        if args.disk_cache and args.disk_cache_megabytes > 0:
+            hits, misses, nbytes = ctypes.c_uint64(), ctypes.c_uint64(), ctypes.c_uint64()
+            libchips.get_disk_cache_stats(ctx, hits, misses, nbytes)
+            print('\t\t disk_cache_hits={} disk_cache_misses={} disk_cache_bytes={}'.format(
+                hits.value, misses.value, nbytes.value))
 
         with WATCHDOG_MUTEX:
             global WATCHDOG_TIME
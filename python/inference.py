@@ -87,34 +87,49 @@ if True:
 
 # Inference
 if True:
+    def inference_plan(width: int, height: int, window_size: int) -> List[Tuple[int, int]]:
+        """Plan the windows needed to cover an image, placing the last window of each row and column flush with the edge
+
+        Arguments:
+            width {int} -- The width of the image
+            height {int} -- The height of the image
+            window_size {int} -- The window size
+
+        Returns:
+            List[Tuple[int, int]] -- The x- and y-offsets of the windows, in the order in which they should be read
+        """
+        def offsets(extent):
+            return sorted(set(min(offset, max(0, extent - window_size))
+                              for offset in range(0, extent, window_size)))
+        return [(x_offset, y_offset) for x_offset in offsets(width) for y_offset in offsets(height)]
+
     def get_inference_window(libchips: ctypes.CDLL,
-                             x_offset: int,
-                             y_offset: int,
-                             args: argparse.Namespace) -> Union[None, torch.Tensor]:
-        """Read the data specified in the given plan
+                             ctx: int,
+                             args: argparse.Namespace) -> Tuple[int, Union[None, torch.Tensor]]:
+        """Read the next window of the plan
 
         Arguments:
             libchips {ctypes.CDLL} -- A shared library handle used for reading data
-            x_offset {int} -- The x-offset of the desired window
-            y_offset {int} -- The y-offset of the desired window
+            ctx {int} -- The libchips context (with a plan started) from which to read
             args {argparse.Namespace} -- Arguments
 
         Returns:
-            Union[None, torch.Tensor] -- The imagery data as a PyTorch tensor
+            Tuple[int, Union[None, torch.Tensor]] -- The libchips result (1 for a window, 2 for a cloudy window, otherwise 0) and the imagery data as a PyTorch tensor (or None)
         """
-        shape = (len(args.bands), args.window_size, args.window_size)
+        shape = (len(args.bands), args.chip_size, args.chip_size)
         image = np.zeros(shape, dtype=np.float32)
         image_ptr = image.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
 
-        if (libchips.get_inference_chip(image_ptr, x_offset, y_offset, 33) == 1):
+        result = libchips.get_next_inference_chip(ctx, image_ptr)
+        if (result == 1):
             image_nds = np.isnan(image).sum(axis=0)
             if args.image_nd is not None:
                 image_nds += (image == args.image_nd).sum(axis=0)
             for i in range(len(image)):
                 image[i][image_nds > 0] = 0.0
-            return torch.from_numpy(np.stack([image], axis=0))
+            return result, torch.from_numpy(np.stack([image], axis=0))
         else:
-            return None
+            return result, None
 
 # Arguments
 if True:
@@ -146,6 +161,12 @@ if True:
         parser.add_argument('--classes',
                             required=False, type=int, default=1,
                             help='The number of prediction classes')
+        parser.add_argument('--cloud-img',
+                            default=None, nargs='+', type=str,
+                            help='Cloud rasters (e.g. s2cloudless probabilities or 0/1 cloud masks), one per inference image, whose cloudy windows are skipped and written as nodata')
+        parser.add_argument('--cloud-threshold',
+                            default=0.5, type=float,
+                            help='Mean value of a --cloud-img raster over a window above which the window is skipped')
         parser.add_argument('--force-download',
                             type=ast.literal_eval, default=False)
         parser.add_argument('--no-raw',
@@ -158,6 +179,11 @@ if True:
         parser.add_argument('--inference-img',
                             required=True, nargs='+', type=str,
                             help='The location of the image on which to predict')
+        parser.add_argument('--gdal-config',
+                            default=None, nargs='+', type=str,
+                            help='KEY=VALUE GDAL configuration options with which libchips reads, e.g. GDAL_CACHEMAX=1024 GDAL_NUM_THREADS=2 VSI_CACHE=TRUE GDAL_HTTP_MULTIRANGE=YES')
+        parser.add_argument('--gdal-config-code', required=False, type=str,
+                            default='https://raw.githubusercontent.com/geotrellis/deeplab-nlcd/master/python/code/gdal_config.py')
         parser.add_argument('--input-stride',
                             default=2, type=int,
                             help='consult this: https://github.com/vdumoulin/conv_arithmetic/blob/master/README.md')
@@ -168,11 +194,19 @@ if True:
                             required=True,
                             help='The weights for the model used for preditions')
         parser.add_argument('--radius', default=10000)
+        parser.add_argument('--read-threads', type=int,
+                            help='The number of threads reading windows ahead of the model (defaults to the number of available cores)')
         parser.add_argument('--raw-prediction-img',
                             help='The location where the raw prediction image should be stored')
+        parser.add_argument('--reduced-resolution-reads',
+                            help='Have libchips average windows down by the resolution divisor as it reads them (for models trained that way)',
+                            action='store_true')
         parser.add_argument('--regression-prediction-img',
                             help='The location where the regression prediction image should be stored')
         parser.add_argument('--resolution-divisor', default=1, type=int)
+        parser.add_argument('--statistics',
+                            default=None, type=str,
+                            help='The JSON file of per-band means and standard deviations that the model was trained with')
         parser.add_argument('--window-size', default=256, type=int)
         parser.add_argument('--threshold', required=False,
                             default=0.0, type=float)
@@ -187,6 +221,12 @@ if True:
     def make_model(band_count, input_stride=1, class_count=1, divisor=1, pretrained=False):
         raise Exception()
 
+    def gdal_config_array(*argv):
+        raise Exception()
+
+    def print_gdal_config(*argv):
+        raise Exception()
+
     def load_architectures(uri: str) -> None:
         arch_str = read_text(uri)
         arch_code = compile(arch_str, uri, 'exec')
@@ -195,6 +235,7 @@ if True:
 
 tmp_weights = '/tmp/weights.pth'
 tmp_mul = '/tmp/mul.tif'
+tmp_cloud = '/tmp/cloud.tif'
 tmp_libchips = '/tmp/libchips.so'
 tmp_pred_final = '/tmp/pred-final.tif'
 tmp_pred_raw = '/tmp/pred-raw.tif'
@@ -215,8 +256,16 @@ if __name__ == '__main__':
     args = inference_cli_parser().parse_args()
 
     args.band_count = len(args.bands)
+    if args.reduced_resolution_reads:
+        assert(args.window_size % args.resolution_divisor == 0)
+        args.chip_size = args.window_size // args.resolution_divisor
+    else:
+        args.chip_size = args.window_size
+    if not args.read_threads:
+        args.read_threads = len(os.sched_getaffinity(0))
 
     load_architectures(args.architecture)
+    load_architectures(args.gdal_config_code)
 
     # ---------------------------------
     print('MODEL')
@@ -230,6 +279,12 @@ if __name__ == '__main__':
             del s3
         args.weights = tmp_weights
 
+    mus = sigmas = None
+    if args.statistics:
+        statistics = json.loads(read_text(args.statistics))
+        mus = np.array(statistics.get('mus'), dtype=np.float64)
+        sigmas = np.array(statistics.get('sigmas'), dtype=np.float64)
+
     # ---------------------------------
     print('DATA')
 
@@ -238,8 +293,14 @@ if __name__ == '__main__':
         text = read_text(args.inference_img[0])
         args.inference_img = list(
             filter(lambda line: len(line) > 0, text.split('\n')))
+    if args.cloud_img is not None and len(args.cloud_img) == 1 and args.cloud_img[0].endswith('.list'):
+        text = read_text(args.cloud_img[0])
+        args.cloud_img = list(
+            filter(lambda line: len(line) > 0, text.split('\n')))
+    if args.cloud_img is not None:
+        assert(len(args.cloud_img) == len(args.inference_img))
 
-    for inference_img in args.inference_img:
+    for (image_index, inference_img) in enumerate(args.inference_img):
         inference_img_orig = inference_img
         if inference_img.startswith('s3://'):
             if not os.path.exists(tmp_mul) or len(args.inference_img) > 1 or args.force_download:
@@ -251,6 +312,17 @@ if __name__ == '__main__':
                 del s3
             inference_img = tmp_mul
 
+        cloud_img = args.cloud_img[image_index] if args.cloud_img is not None else None
+        if cloud_img is not None and cloud_img.startswith('s3://'):
+            if not os.path.exists(tmp_cloud) or len(args.inference_img) > 1 or args.force_download:
+                s3 = boto3.client('s3')
+                bucket, prefix = parse_s3_url(cloud_img)
+                print('Cloud raster bucket and prefix: {}, {}'.format(
+                    bucket, prefix))
+                s3.download_file(bucket, prefix, tmp_cloud)
+                del s3
+            cloud_img = tmp_cloud
+
         # ---------------------------------
 
         device = torch.device(args.backend)
@@ -259,7 +331,7 @@ if __name__ == '__main__':
             args.band_count,
             input_stride=args.input_stride,
             class_count=args.classes,
-            divisor=args.resolution_divisor,
+            divisor=1 if args.reduced_resolution_reads else args.resolution_divisor,
             pretrained=False,
         ).to(device)
         if not hasattr(model, 'no_weights'):
@@ -280,25 +352,85 @@ if __name__ == '__main__':
             args.libchips = tmp_libchips
 
         libchips = ctypes.CDLL(args.libchips)
+        libchips.start.argtypes = [
+            ctypes.c_int, ctypes.c_int, ctypes.c_int,
+            ctypes.c_char_p, ctypes.c_char_p,
+            ctypes.c_int, ctypes.c_int,
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int, ctypes.c_int,
+            ctypes.c_int, ctypes.POINTER(ctypes.c_int),
+            ctypes.POINTER(ctypes.c_double),
+            ctypes.POINTER(ctypes.c_int),
+            ctypes.POINTER(ctypes.c_int),
+            ctypes.c_double,
+            ctypes.POINTER(ctypes.c_int), ctypes.c_int, ctypes.c_int,
+            ctypes.c_int64,
+            ctypes.c_char_p, ctypes.c_int64,
+            ctypes.c_char_p,
+            ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int, ctypes.c_int,
+            ctypes.POINTER(ctypes.c_double), ctypes.c_int,
+            ctypes.c_double, ctypes.c_int,
+            ctypes.c_int, ctypes.c_int,
+            ctypes.POINTER(ctypes.c_char_p),
+            ctypes.c_char_p, ctypes.c_double]
+        libchips.start.restype = ctypes.c_void_p
+        libchips.get_width.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        libchips.get_height.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        libchips.get_inference_chip.argtypes = [
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int]
+        libchips.start_inference_plan.argtypes = [
+            ctypes.c_void_p, ctypes.c_int, ctypes.POINTER(ctypes.c_int32), ctypes.POINTER(ctypes.c_int32), ctypes.c_int]
+        libchips.get_next_inference_chip.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        libchips.get_config_option.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int]
+        libchips.stop.argtypes = [ctypes.c_void_p]
         libchips.init()
 
         # ---------------------------------
         print('INFERENCE')
 
-        libchips.start(
-            1,  # Number of threads
-            0,  # Number of slots
+        ctx = libchips.start(
+            args.read_threads,  # Number of threads
+            args.read_threads * 2,  # Number of slots
+            1,  # The number of images
             inference_img.encode(),  # Image data
             None,  # Label data
             6,  # Make all rasters float32
             5,  # Make all labels int32
-            None,  # means
-            None,  # standard deviations
+            None if mus is None else mus.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),  # means
+            None if sigmas is None else sigmas.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),  # standard deviations
             args.radius,  # typical radius of component
             3,  # Inference mode
             args.window_size,
+            args.window_size,
             len(args.bands),
-            np.array(args.bands, dtype=np.int32).ctypes.data_as(ctypes.POINTER(ctypes.c_int32)))
+            np.array(args.bands, dtype=np.int32).ctypes.data_as(ctypes.POINTER(ctypes.c_int32)),
+            None,  # forbidden imagery value
+            None,  # forbidden label value
+            None,  # desired label value
+            ctypes.c_double(0.0),  # reroll probability
+            None,  # label lookup table
+            0,  # label lookup table size
+            0,  # label nodata
+            ctypes.c_int64(0),  # no block cache
+            None,  # no disk cache
+            ctypes.c_int64(0),
+            None,  # no chip store
+            None if args.image_nd is None else ctypes.byref(ctypes.c_double(args.image_nd)),  # imagery nodata
+            0,  # no augmentation
+            0,  # no look-ahead
+            None,  # no class-frequency targets
+            0,
+            0.0,  # no hard examples
+            1,  # one window at a time
+            0,  # no pair quotas
+            args.chip_size,
+            gdal_config_array(args.gdal_config),
+            None if cloud_img is None else cloud_img.encode(),  # cloud raster
+            ctypes.c_double(args.cloud_threshold))
+        print_gdal_config(libchips, ctx, args.gdal_config)
 
         window_gcd = gcd(args.window_size, 16)
         with rio.open(inference_img) as ds:
@@ -311,7 +443,7 @@ if __name__ == '__main__':
                 tiled=True,
                 blockxsize=args.window_size * (16 // window_gcd),
                 blockysize=args.window_size * (16 // window_gcd),
-                nodata=None,
+                nodata=None if cloud_img is None else 255,
                 bigtiff=True,
                 driver='GTiff'
             )
@@ -324,7 +456,7 @@ if __name__ == '__main__':
                 tiled=True,
                 blockxsize=args.window_size * (16 // window_gcd),
                 blockysize=args.window_size * (16 // window_gcd),
-                nodata=None,
+                nodata=None if cloud_img is None else np.nan,
                 bigtiff=True,
                 driver='GTiff'
             )
@@ -337,7 +469,7 @@ if __name__ == '__main__':
                 tiled=True,
                 blockxsize=args.window_size * (16 // window_gcd),
                 blockysize=args.window_size * (16 // window_gcd),
-                nodata=None,
+                nodata=None if cloud_img is None else np.nan,
                 bigtiff=True,
                 driver='GTiff'
             )
@@ -348,52 +480,71 @@ if __name__ == '__main__':
             with rio.open(tmp_pred_final, 'w', **profile_final) as ds_final, \
                     rio.open(tmp_pred_raw, 'w', **profile_raw) as ds_raw, \
                     rio.open(tmp_pred_reg, 'w', **profile_reg) as ds_reg:
-                width = libchips.get_width(0)
-                height = libchips.get_height(0)
+                width = libchips.get_width(ctx, 0)
+                height = libchips.get_height(ctx, 0)
                 print('x={} y={} n={}'.format(width, height, args.window_size))
-                for x_offset in range(0, width, args.window_size):
-                    if x_offset + args.window_size > width:
-                        x_offset = width - args.window_size - 1
-                    for y_offset in range(0, height, args.window_size):
-                        if y_offset + args.window_size > height:
-                            y_offset = height - args.window_size - 1
-                        window = rio.windows.Window(
-                            x_offset, y_offset, args.window_size, args.window_size)
-                        tensor = get_inference_window(
-                            libchips, x_offset, y_offset, copy.deepcopy(args))
-                        if tensor is not None:
-                            tensor = tensor.to(device)
-                            out = model(tensor)
-                            if isinstance(out, dict):
-                                if 'reg' in out:
-                                    reg_window = np.ones(
-                                        (window.width, window.height), dtype=np.float32)
-                                    reg: Any = out.get('reg')
-                                    reg_window = reg_window * reg.item()
-                                    ds_reg.write(
-                                        reg_window, window=window, indexes=1)
-                                out = out.get('out', out.get(
-                                    'seg', out.get('2seg', None)))
-                            if out is not None:
-                                out_torch = out
-                                out = out.cpu().numpy()
-                                if not args.no_raw:
-                                    for i in range(0, args.classes):
-                                        ds_raw.write(
-                                            out[0, i], window=window, indexes=i+1)
-                                if args.classes > 1:
-                                    out = torch.max(out_torch, 1)[
-                                        1].cpu().numpy().astype(np.uint8)
-                                    ds_final.write(
-                                        out[0], window=window, indexes=1)
-                                else:
-                                    out = np.array(
-                                        out > args.threshold, dtype=np.uint8)
-                                    ds_final.write(
-                                        out[0][0], window=window, indexes=1)
-                    print('{:02.2f}% complete'.format(
-                        (100.0 * x_offset / width)))
+                plan = inference_plan(width, height, args.window_size)
+                plan_xs = np.array([x for (x, _) in plan], dtype=np.int32)
+                plan_ys = np.array([y for (_, y) in plan], dtype=np.int32)
+                libchips.start_inference_plan(
+                    ctx, len(plan),
+                    plan_xs.ctypes.data_as(ctypes.POINTER(ctypes.c_int32)),
+                    plan_ys.ctypes.data_as(ctypes.POINTER(ctypes.c_int32)),
+                    33)
+                for (n, (x_offset, y_offset)) in enumerate(plan):
+                    window = rio.windows.Window(
+                        x_offset, y_offset, args.window_size, args.window_size)
+                    result, tensor = get_inference_window(
+                        libchips, ctx, copy.deepcopy(args))
+                    if result == 2:
+                        # Cloudy windows are skipped by libchips
+                        # without being read, and written as nodata
+                        ds_final.write(
+                            np.full((window.height, window.width), 255, dtype=np.uint8), window=window, indexes=1)
+                        ds_reg.write(
+                            np.full((window.height, window.width), np.nan, dtype=np.float32), window=window, indexes=1)
+                        if not args.no_raw:
+                            for i in range(0, args.classes):
+                                ds_raw.write(
+                                    np.full((window.height, window.width), np.nan, dtype=np.float32), window=window, indexes=i+1)
+                    if tensor is not None:
+                        tensor = tensor.to(device)
+                        out = model(tensor)
+                        if isinstance(out, dict):
+                            if 'reg' in out:
+                                reg_window = np.ones(
+                                    (window.width, window.height), dtype=np.float32)
+                                reg: Any = out.get('reg')
+                                reg_window = reg_window * reg.item()
+                                ds_reg.write(
+                                    reg_window, window=window, indexes=1)
+                            out = out.get('out', out.get(
+                                'seg', out.get('2seg', None)))
+                        if out is not None and out.shape[-1] != args.window_size:
+                            out = torch.nn.functional.interpolate(
+                                out, args.window_size, mode='bilinear', align_corners=False)
+                        if out is not None:
+                            out_torch = out
+                            out = out.cpu().numpy()
+                            if not args.no_raw:
+                                for i in range(0, args.classes):
+                                    ds_raw.write(
+                                        out[0, i], window=window, indexes=i+1)
+                            if args.classes > 1:
+                                out = torch.max(out_torch, 1)[
+                                    1].cpu().numpy().astype(np.uint8)
+                                ds_final.write(
+                                    out[0], window=window, indexes=1)
+                            else:
+                                out = np.array(
+                                    out > args.threshold, dtype=np.uint8)
+                                ds_final.write(
+                                    out[0][0], window=window, indexes=1)
+                    if n + 1 == len(plan) or plan[n + 1][0] != x_offset:
+                        print('{:02.2f}% complete'.format(
+                            (100.0 * (x_offset + args.window_size) / width)))
         finish_time = datetime.now()
+        libchips.stop(ctx)
         print(finish_time - start_time)
 
         if args.final_prediction_img is not None:
@@ -435,7 +586,6 @@ if __name__ == '__main__':
                 command = 'cp -f {} {}'.format(tmp_pred_reg, img)
                 os.system(command)
 
-    libchips.stop()
     libchips.deinit()
 
     if args.report and args.report_band:
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# =====================
+#
+# Copyright © 2020 Azavea
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the “Software”), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+import argparse
+import copy
+
+import numpy as np
+import rasterio as rio
+import rasterio.enums
+import rasterio.windows
+
+from s2cloudless import S2PixelCloudDetector
+
+
+def cli_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', required=True, type=str)
+    parser.add_argument('--output', required=True, type=str)
+    parser.add_argument('--bands', required=False, nargs='+', type=int,
+                        default=[1, 2, 4, 5, 8, 9, 10, 11, 12, 13],
+                        help='The (1-indexed) bands of the input holding B01, B02, B04, B05, B08, B8A, B09, B10, B11 and B12 (or all 13 L1C bands, in order)')
+    parser.add_argument('--resolution-divisor', required=False, default=1, type=int,
+                        help='Compute the probabilities at this fraction of the resolution of the input')
+    parser.add_argument('--rows', required=False, default=512, type=int,
+                        help='The number of output rows computed at once')
+    return parser
+
+
+# Compute s2cloudless cloud probabilities for a Sentinel-2 L1C image
+# (digital numbers), for use with --cloud-img.
+if __name__ == '__main__':
+    args = cli_parser().parse_args()
+    detector = S2PixelCloudDetector(all_bands=(len(args.bands) == 13))
+
+    with rio.open(args.input, 'r') as input_ds:
+        width = input_ds.width // args.resolution_divisor
+        height = input_ds.height // args.resolution_divisor
+        profile = copy.deepcopy(input_ds.profile)
+        profile.update(
+            dtype=rio.float32,
+            count=1,
+            width=width,
+            height=height,
+            transform=input_ds.transform * rio.Affine.scale(args.resolution_divisor, args.resolution_divisor),
+            nodata=None,
+            compress='deflate',
+            predictor=3,
+            tiled=True,
+            blockxsize=256,
+            blockysize=256
+        )
+
+        with rio.open(args.output, 'w', **profile) as output_ds:
+            for row in range(0, height, args.rows):
+                rows = min(args.rows, height - row)
+                window = rio.windows.Window(
+                    0, row * args.resolution_divisor,
+                    width * args.resolution_divisor, rows * args.resolution_divisor)
+                data = input_ds.read(args.bands, window=window, out_shape=(len(args.bands), rows, width),
+                                     resampling=rio.enums.Resampling.average)
+                data = np.transpose(data, axes=(1, 2, 0))[np.newaxis, ...].astype(np.float32) / 10000.0
+                probabilities = detector.get_cloud_probability_maps(data)[0]
+                output_ds.write(probabilities.astype(np.float32), window=rio.windows.Window(0, row, width, rows), indexes=1)
@@ -36,6 +36,7 @@ import copy
 import ctypes
 import glob
 import hashlib
+import json
 import math
 import os
 import random
@@ -102,6 +103,9 @@ if True:
     def get_batch(*argv):
         raise Exception()
 
+    def batch_to_device(*argv):
+        raise Exception()
+
     def train(*argv):
         raise Exception()
 
@@ -111,6 +115,74 @@ if True:
     def evaluate(*argv):
         raise Exception()
 
+    def gdal_config_array(*argv):
+        raise Exception()
+
+    def print_gdal_config(*argv):
+        raise Exception()
+
+# Native code
+if True:
+    def optional_pointer(value: Any, c_type: Any) -> Any:
+        """Given an optional value, return a pointer to a C copy of it suitable for passing to libchips
+
+        Arguments:
+            value {Any} -- The value (or None)
+            c_type {Any} -- The ctypes type of the value
+
+        Returns:
+            Any -- A pointer to the value, or None if the value is None
+        """
+        if value is None:
+            return None
+        return ctypes.byref(c_type(value))
+
+    def optional_array(array: Optional[np.ndarray], c_type: Any) -> Any:
+        """Given an optional numpy array, return a pointer to its data suitable for passing to libchips
+
+        Arguments:
+            array {Optional[np.ndarray]} -- The array (or None)
+            c_type {Any} -- The ctypes type of the elements of the array
+
+        Returns:
+            Any -- A pointer to the data, or None if the array is None
+        """
+        if array is None:
+            return None
+        return array.ctypes.data_as(ctypes.POINTER(c_type))
+
+    def gdal_path(uri: str) -> str:
+        """Given a URI, return a path through which GDAL can read it in place
+
+        Arguments:
+            uri {str} -- The URI (s3://, http(s):// or local)
+
+        Returns:
+            str -- The corresponding /vsis3/ or /vsicurl/ path, or the URI itself if it is local
+        """
+        parsed = urlparse(uri)
+        if parsed.scheme.startswith('s3'):
+            return '/vsis3/{}/{}'.format(parsed.netloc, parsed.path.lstrip('/'))
+        elif parsed.scheme.startswith('http'):
+            return '/vsicurl/{}'.format(uri)
+        else:
+            return uri
+
+    def file_checksum(filename: str) -> str:
+        """Return the SHA-256 checksum of a (possibly very large) file, read a mebibyte at a time
+
+        Arguments:
+            filename {str} -- The file to checksum
+
+        Returns:
+            str -- The checksum
+        """
+        h = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
 # Arguments
 if True:
     def hash_string(string: str) -> str:
@@ -152,11 +224,34 @@ if True:
                             default='https://raw.githubusercontent.com/geotrellis/deeplab-nlcd/master/python/code/training.py')
         parser.add_argument('--evaluation-code', required=False, type=str,
                             default='https://raw.githubusercontent.com/geotrellis/deeplab-nlcd/master/python/code/evaluation.py')
+        parser.add_argument('--gdal-config-code', required=False, type=str,
+                            default='https://raw.githubusercontent.com/geotrellis/deeplab-nlcd/master/python/code/gdal_config.py')
+        parser.add_argument('--augment-flips',
+                            help='Randomly flip training windows (imagery and labels together)',
+                            action='store_true')
+        parser.add_argument('--augment-rotations',
+                            help='Randomly rotate training windows by quarter turns (imagery and labels together)',
+                            action='store_true')
         parser.add_argument('--backend',
                             choices=['cpu', 'cuda'], default='cuda')
         parser.add_argument('--bands', required=True, nargs='+', type=int,
                             help='list of bands to train on (1 indexed)')
         parser.add_argument('--batch-size', default=16, type=int)
+        parser.add_argument('--block-cache-megabytes',
+                            default=0, type=int,
+                            help='Memory budget for decoded raster blocks cached by libchips (0 to disable)')
+        parser.add_argument('--chip-store',
+                            default=None, type=str,
+                            help='A local file holding pre-decoded chips (exported from the training data if it does not exist)')
+        parser.add_argument('--class-frequencies',
+                            default=None, nargs='+', type=float,
+                            help='Target fraction of training label pixels for each class, reached by having libchips reject windows of over-represented classes')
+        parser.add_argument('--cloud-img',
+                            default=None, nargs='+', type=str,
+                            help='Cloud rasters (e.g. s2cloudless probabilities or 0/1 cloud masks), one per training image, over which libchips skips cloudy windows')
+        parser.add_argument('--cloud-threshold',
+                            default=0.5, type=float,
+                            help='Mean value of a --cloud-img raster over a window above which the window is skipped')
         parser.add_argument('--epochs1', default=0, type=int)
         parser.add_argument('--epochs2', default=13, type=int)
         parser.add_argument('--epochs3', default=0, type=int)
@@ -166,6 +261,18 @@ if True:
         parser.add_argument('--forbidden-label-value',
                             default=None, type=int)
         parser.add_argument('--desired-label-value', default=None, type=int)
+        parser.add_argument('--disk-cache',
+                            default=None, type=str,
+                            help='A local directory in which libchips keeps decoded raster blocks across runs (useful with --stream)')
+        parser.add_argument('--disk-cache-megabytes',
+                            default=0, type=int,
+                            help='Disk budget for the decoded raster blocks kept in --disk-cache (0 to disable)')
+        parser.add_argument('--gdal-config',
+                            default=None, nargs='+', type=str,
+                            help='KEY=VALUE GDAL configuration options with which libchips reads, e.g. GDAL_CACHEMAX=1024 GDAL_NUM_THREADS=2 VSI_CACHE=TRUE VSI_CACHE_SIZE=67108864 GDAL_HTTP_MULTIRANGE=YES')
+        parser.add_argument('--hard-example-fraction',
+                            default=0.0, type=float,
+                            help='Fraction of training draws (and recenterings) steered towards windows with high reported losses (0 to disable)')
         parser.add_argument('--image-nd',
                             default=None, type=float,
                             help='image value to ignore - must be on the first band')
@@ -174,7 +281,7 @@ if True:
                             help='consult this: https://github.com/vdumoulin/conv_arithmetic/blob/master/README.md')
         parser.add_argument('--label-img',
                             required=True, nargs='+', type=str,
-                            help='labels to train')
+                            help='labels to train (rasters, or GeoJSON files whose features libchips burns into each window as it is read)')
         parser.add_argument('--label-map',
                             required=True, help='comma separated list of mappings to apply to training labels',
                             action=StoreDictKeyPair, default=None)
@@ -209,8 +316,24 @@ if True:
                             help='Model output location')
         parser.add_argument('--optimizer', default='adam',
                             choices=['sgd', 'adam', 'adamw'])
+        parser.add_argument('--pair-quotas',
+                            help='Draw from each training pair in proportion to its valid windows over every stretch of windows (not just on average), and sweep its center over it',
+                            action='store_true')
+        parser.add_argument('--prefetch-windows',
+                            default=0, type=int,
+                            help='The number of windows each reader chooses in advance and asks GDAL to prefetch (useful for remote imagery)')
         parser.add_argument('--radius', default=10000)
-        parser.add_argument('--read-threads', type=int)
+        parser.add_argument('--read-threads', type=int,
+                            help='The number of reader threads (defaults to the number of available cores)')
+        parser.add_argument('--read-timeout',
+                            default=60, type=int,
+                            help='The number of seconds to wait for a window before warning that the readers have stalled')
+        parser.add_argument('--region-windows',
+                            default=1, type=int,
+                            help='Have each reader read regions of this many windows square at once and slice training windows out of them (1 to read windows one at a time)')
+        parser.add_argument('--reduced-resolution-reads',
+                            help='Have libchips average windows down by the resolution divisor as it reads them (from overviews where available) instead of shipping full-resolution windows for the model to shrink',
+                            action='store_true')
         parser.add_argument('--reroll', default=0.25, type=float)
         parser.add_argument('--resolution-divisor', default=1, type=int)
         parser.add_argument('--s3-bucket',
@@ -221,6 +344,13 @@ if True:
                             help='prefix to apply when saving models to s3')
         parser.add_argument('--start-from',
                             help='The saved model to start the fourth phase from')
+        parser.add_argument('--stream',
+                            help='Read the imagery and labels in place (through /vsis3/ or /vsicurl/) instead of downloading them; '
+                            'set AWS_S3_ENDPOINT, AWS_HTTPS and AWS_VIRTUAL_HOSTING to use a local S3 stand-in',
+                            action='store_true')
+        parser.add_argument('--statistics',
+                            default=None, type=str,
+                            help='A JSON file of per-band means and standard deviations (computed by libchips if missing or stale, i.e. if the imagery contents, bands, window size or nodata value have changed); training normalizes batches with them on the device, and inference.py hands them to libchips')
         parser.add_argument('--training-img',
                             required=True, nargs='+', type=str,
                             help='The input that you are training to produce labels for')
@@ -240,21 +370,39 @@ if __name__ == '__main__':
     hashed_args = copy.deepcopy(args)
     hashed_args.script = sys.argv[0]
     del hashed_args.backend
+    del hashed_args.block_cache_megabytes
+    del hashed_args.chip_store
+    del hashed_args.disk_cache
+    del hashed_args.disk_cache_megabytes
+    del hashed_args.gdal_config
+    del hashed_args.gdal_config_code
     del hashed_args.no_eval
     del hashed_args.no_upload
+    del hashed_args.prefetch_windows
     del hashed_args.max_eval_windows
     del hashed_args.read_threads
+    del hashed_args.read_timeout
+    del hashed_args.region_windows
+    del hashed_args.stream
     del hashed_args.watchdog_seconds
     arg_hash = hash_string(str(hashed_args))
     print('provided args: {}'.format(hashed_args))
     print('hash: {}'.format(arg_hash))
 
     assert(args.window_size_labels % args.window_size_imagery == 0)
-    if args.window_size_labels != args.window_size_imagery:
-        import scipy.ndimage  # Get ready to use scipy.ndimage.zoom
+    if args.reduced_resolution_reads:
+        assert(args.window_size_imagery % args.resolution_divisor == 0)
+        args.chip_size = args.window_size_imagery // args.resolution_divisor
+    else:
+        args.chip_size = args.window_size_imagery
 
     tmp_mul = '/tmp/mul{}.tif'
     tmp_label = '/tmp/mask{}.tif'
+    tmp_cloud = '/tmp/cloud{}.tif'
+    if args.stream:
+        tmp_mul = '/tmp/mul{}.vrt'
+        tmp_label = '/tmp/mask{}.vrt'
+        tmp_cloud = '/tmp/cloud{}.vrt'
     tmp_libchips = '/tmp/libchips.so.1.1'
 
     args.band_count = len(args.bands)
@@ -263,6 +411,7 @@ if __name__ == '__main__':
     load_code(args.watchdog_code)
     load_code(args.training_code)
     load_code(args.evaluation_code)
+    load_code(args.gdal_config_code)
     load_code(args.architecture_code)
 
     # ---------------------------------
@@ -289,11 +438,19 @@ if __name__ == '__main__':
         else:
             args.class_weights = [1.0] * (len(args.label_map)-1)
     class_count = len(args.class_weights)
+    if args.class_frequencies is not None:
+        assert(len(args.class_frequencies) == class_count)
 
     if args.label_nd is None:
         args.label_nd = class_count
         print('\t WARNING: LABEL NODATA NOT SET, SETTING TO {}'.format(args.label_nd))
 
+    # Dense lookup table used by libchips to apply the label map
+    label_lut = np.full(max(args.label_map.keys()) + 1,
+                        args.label_nd, dtype=np.int32)
+    for k, v in args.label_map.items():
+        label_lut[k] = v
+
     if args.image_nd is None:
         print('\t WARNING: IMAGE NODATA NOT SET')
 
@@ -313,12 +470,49 @@ if __name__ == '__main__':
         text = read_text(args.label_img[0])
         args.label_img = list(
             filter(lambda line: len(line) > 0, text.split('\n')))
+    if args.cloud_img is not None and len(args.cloud_img) == 1 and args.cloud_img[0].endswith('.list'):
+        text = read_text(args.cloud_img[0])
+        args.cloud_img = list(
+            filter(lambda line: len(line) > 0, text.split('\n')))
+    if args.cloud_img is not None:
+        assert(len(args.cloud_img) == len(args.training_img))
+
+    # Vector labels are burned into each window by libchips, so they
+    # are fetched as they are rather than rasterized beforehand
+    if all(label_img.lower().endswith(('.geojson', '.json')) for label_img in args.label_img):
+        tmp_label = '/tmp/mask{}.geojson'
 
     # Image⨯label pairs
     args.pairs = list(zip(args.training_img, args.label_img))
+    if args.stream:
+        os.environ.setdefault('GDAL_DISABLE_READDIR_ON_OPEN', 'EMPTY_DIR')
+        os.environ.setdefault('VSI_CACHE', 'TRUE')
     for i in range(len(args.pairs)):
         training_img = args.training_img[i]
         label_img = args.label_img[i]
+        cloud_img = args.cloud_img[i] if args.cloud_img is not None else None
+
+        # Wrap each remote raster in a local VRT (only its metadata is
+        # fetched) so that libchips reads it in place; vector labels
+        # are small, so they are simply copied
+        if args.stream:
+            uris = [(training_img, tmp_mul.format(i)), (label_img, tmp_label.format(i))]
+            if cloud_img is not None:
+                uris.append((cloud_img, tmp_cloud.format(i)))
+            for uri, tmp in uris:
+                if tmp.endswith('.geojson'):
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    command = 'ogr2ogr -f GeoJSON {} {}'.format(tmp, gdal_path(uri))
+                else:
+                    command = 'gdal_translate -q -of VRT {} {}'.format(gdal_path(uri), tmp)
+                if os.system(command) != 0:
+                    raise Exception('Could not open {} in place'.format(uri))
+            args.training_img[i] = tmp_mul.format(i)
+            args.label_img[i] = tmp_label.format(i)
+            if cloud_img is not None:
+                args.cloud_img[i] = tmp_cloud.format(i)
+            continue
 
         if training_img.startswith('s3://'):
             tmp_mul_local = tmp_mul.format(i)
@@ -342,8 +536,19 @@ if __name__ == '__main__':
                 del s3
             args.label_img[i] = tmp_label_local
 
+        if cloud_img is not None and cloud_img.startswith('s3://'):
+            tmp_cloud_local = tmp_cloud.format(i)
+            if not os.path.exists(tmp_cloud_local):
+                s3 = boto3.client('s3')
+                bucket, prefix = parse_s3_url(cloud_img)
+                print('Cloud raster bucket and prefix: {}, {}'.format(
+                    bucket, prefix))
+                s3.download_file(bucket, prefix, tmp_cloud_local)
+                del s3
+            args.cloud_img[i] = tmp_cloud_local
+
     if not args.read_threads:
-        args.read_threads = len(args.pairs)
+        args.read_threads = len(os.sched_getaffinity(0))
 
     # ---------------------------------
     print('NATIVE CODE')
@@ -358,11 +563,44 @@ if __name__ == '__main__':
         args.libchips = tmp_libchips
 
     libchips = ctypes.CDLL(args.libchips)
-    libchips.recenter.argtypes = [ctypes.c_int]
+    libchips.recenter.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    libchips.get_width.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    libchips.get_height.argtypes = [ctypes.c_void_p, ctypes.c_int]
     libchips.get_next.argtypes = [
+        ctypes.c_void_p,
         ctypes.POINTER(ctypes.c_float),
         ctypes.POINTER(ctypes.c_int)
     ]
+    libchips.get_next_timeout.argtypes = [
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_float),
+        ctypes.POINTER(ctypes.c_int),
+        ctypes.c_int
+    ]
+    libchips.get_next_timeout.restype = ctypes.c_int
+    libchips.get_next_batch_timeout.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_void_p,
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_int32),
+        ctypes.c_int,
+        ctypes.c_int
+    ]
+    libchips.get_next_batch_timeout.restype = ctypes.c_int
+    libchips.lend_next_timeout.argtypes = [
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_void_p),
+        ctypes.POINTER(ctypes.c_void_p),
+        ctypes.c_int
+    ]
+    libchips.lend_next_timeout.restype = ctypes.c_int
+    libchips.release_chip.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    libchips.report_losses.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_int,
+        ctypes.POINTER(ctypes.c_int32),
+        ctypes.POINTER(ctypes.c_float)
+    ]
     libchips.start.argtypes = [
         ctypes.c_int, ctypes.c_int, ctypes.c_int,
         ctypes.c_char_p, ctypes.c_char_p,
@@ -371,25 +609,218 @@ if __name__ == '__main__':
         ctypes.c_int,
         ctypes.c_int,
         ctypes.c_int, ctypes.c_int,
-        ctypes.c_int, ctypes.POINTER(ctypes.c_int)]
+        ctypes.c_int, ctypes.POINTER(ctypes.c_int),
+        ctypes.POINTER(ctypes.c_double),
+        ctypes.POINTER(ctypes.c_int),
+        ctypes.POINTER(ctypes.c_int),
+        ctypes.c_double,
+        ctypes.POINTER(ctypes.c_int), ctypes.c_int, ctypes.c_int,
+        ctypes.c_int64,
+        ctypes.c_char_p, ctypes.c_int64,
+        ctypes.c_char_p,
+        ctypes.POINTER(ctypes.c_double),
+        ctypes.c_int, ctypes.c_int,
+        ctypes.POINTER(ctypes.c_double), ctypes.c_int,
+        ctypes.c_double, ctypes.c_int,
+        ctypes.c_int, ctypes.c_int,
+        ctypes.POINTER(ctypes.c_char_p),
+        ctypes.c_char_p, ctypes.c_double]
+    libchips.start.restype = ctypes.c_void_p
+    libchips.stop.argtypes = [ctypes.c_void_p]
+    libchips.export_chips.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+    libchips.export_chips.restype = ctypes.c_int
+    libchips.check_chips.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+    libchips.check_chips.restype = ctypes.c_int
+    libchips.compute_statistics.argtypes = [
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_double),
+        ctypes.POINTER(ctypes.c_double)
+    ]
+    libchips.compute_statistics.restype = ctypes.c_int
+    libchips.get_cache_stats.argtypes = [
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_uint64),
+        ctypes.POINTER(ctypes.c_uint64),
+        ctypes.POINTER(ctypes.c_uint64)
+    ]
+    libchips.get_disk_cache_stats.argtypes = [
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_uint64),
+        ctypes.POINTER(ctypes.c_uint64),
+        ctypes.POINTER(ctypes.c_uint64)
+    ]
+    libchips.get_data_types.argtypes = [
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_int),
+        ctypes.POINTER(ctypes.c_int)
+    ]
+    libchips.get_class_stats.argtypes = [
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_uint64),
+        ctypes.POINTER(ctypes.c_uint64)
+    ]
+    libchips.get_class_stats.restype = ctypes.c_int
+    libchips.get_pair_stats.argtypes = [
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_uint64),
+        ctypes.POINTER(ctypes.c_uint64)
+    ]
+    libchips.get_config_option.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_char_p,
+        ctypes.c_char_p,
+        ctypes.c_int
+    ]
+    libchips.get_config_option.restype = ctypes.c_int
+    libchips.get_stats.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_int,
+        ctypes.POINTER(ctypes.c_uint64)
+    ]
 
     libchips.init()
-    libchips.start(
+    optional_disk_cache = args.disk_cache.encode() if args.disk_cache else None
+    gdal_config = gdal_config_array(args.gdal_config)
+    cloud_template = tmp_cloud.replace('{}', '%d').encode() if args.cloud_img is not None else None
+
+    # Normalization statistics are keyed by the imagery, bands, window size and nodata value
+    statistics = None
+    if args.statistics:
+        statistics_key = hash_string(str([file_checksum(f) for f in args.training_img] +
+                                         [args.bands, args.window_size_imagery, args.image_nd]))
+        if os.path.exists(args.statistics):
+            with open(args.statistics, 'r') as f:
+                statistics = json.load(f)
+            if statistics.get('key') != statistics_key:
+                print('\t STATISTICS IN {} ARE STALE'.format(args.statistics))
+                statistics = None
+
+    # An existing chip store is checked against the current settings
+    # and data, and exported again if it does not match
+    if args.chip_store or (args.statistics and statistics is None):
+        ctx = libchips.start(
+            args.read_threads,  # Number of threads
+            args.read_threads * 2,  # Number of slots
+            len(args.pairs),  # The number of pairs
+            tmp_mul.replace('{}', '%d').encode(),  # Image data
+            tmp_label.replace('{}', '%d').encode(),  # Label data
+            0,  # Native imagery type
+            0,  # Native label type
+            None,  # means
+            None,  # standard deviations
+            args.radius,  # typical radius of a component
+            0,  # Stopped mode
+            args.window_size_imagery,
+            args.window_size_labels,
+            len(args.bands),
+            np.array(args.bands, dtype=np.int32).ctypes.data_as(ctypes.POINTER(ctypes.c_int32)),
+            None,  # forbidden imagery value
+            None,  # forbidden label value
+            None,  # desired label value
+            0.0,  # reroll probability
+            label_lut.ctypes.data_as(ctypes.POINTER(ctypes.c_int32)),  # so that stored labels have the training type
+            len(label_lut),
+            args.label_nd,
+            0,  # block cache bytes
+            optional_disk_cache,
+            args.disk_cache_megabytes << 20,
+            None,  # chip store
+            optional_pointer(args.image_nd, ctypes.c_double),
+            0,  # no augmentation
+            0,  # no look-ahead
+            None,  # no class-frequency targets
+            0,
+            0.0,  # no hard examples
+            1,  # one window at a time
+            0,  # no pair quotas
+            0,  # full-size windows
+            gdal_config,
+            None,  # every window is exported; cloudy ones are skipped as the store is read
+            0.0)
+        export_chips = args.chip_store and not libchips.check_chips(ctx, args.chip_store.encode())
+        if export_chips and os.path.exists(args.chip_store):
+            print('\t CHIP STORE {} IS STALE'.format(args.chip_store))
+        if export_chips:
+            print('\t EXPORTING CHIPS TO {}'.format(args.chip_store))
+            if not libchips.export_chips(ctx, args.chip_store.encode()):
+                print('\t WARNING: CHIP EXPORT FAILED, READING RASTERS DIRECTLY')
+                args.chip_store = None
+        if args.statistics and statistics is None:
+            print('\t COMPUTING STATISTICS')
+            mus = np.zeros(len(args.bands), dtype=np.float64)
+            sigmas = np.zeros(len(args.bands), dtype=np.float64)
+            if libchips.compute_statistics(ctx, optional_array(mus, ctypes.c_double), optional_array(sigmas, ctypes.c_double)):
+                statistics = {
+                    'key': statistics_key,
+                    'bands': args.bands,
+                    'mus': mus.tolist(),
+                    'sigmas': sigmas.tolist()
+                }
+                with open(args.statistics, 'w') as f:
+                    json.dump(statistics, f)
+            else:
+                print('\t WARNING: COULD NOT COMPUTE STATISTICS, NOT NORMALIZING')
+        libchips.stop(ctx)
+
+    # Normalization happens on the device (see batch_to_device)
+    args.mus = args.sigmas = None
+    if statistics is not None:
+        print('\t MEANS: {}'.format(statistics.get('mus')))
+        print('\t STANDARD DEVIATIONS: {}'.format(statistics.get('sigmas')))
+        args.mus = statistics.get('mus')
+        args.sigmas = statistics.get('sigmas')
+
+    augmentations = (1 if args.augment_flips else 0) | (2 if args.augment_rotations else 0)
+    class_frequencies = None
+    if args.class_frequencies is not None:
+        class_frequencies = np.array(args.class_frequencies, dtype=np.float64)
+    training_ctx = libchips.start(
         args.read_threads,  # Number of threads
         args.read_threads * 2,  # Number of slots
         len(args.pairs),  # The number of pairs
-        b'/tmp/mul%d.tif',  # Image data
-        b'/tmp/mask%d.tif',  # Label data
-        6,  # Make all rasters float32
-        5,  # Make all labels int32
-        None,  # means
+        tmp_mul.replace('{}', '%d').encode(),  # Image data
+        tmp_label.replace('{}', '%d').encode(),  # Label data
+        0,  # Native imagery type
+        0,  # Native label type
+        None,  # means (applied on the device)
         None,  # standard deviations
         args.radius,  # typical radius of a component
         1,  # Training mode
         args.window_size_imagery,
         args.window_size_labels,
         len(args.bands),
-        np.array(args.bands, dtype=np.int32).ctypes.data_as(ctypes.POINTER(ctypes.c_int32)))
+        np.array(args.bands, dtype=np.int32).ctypes.data_as(ctypes.POINTER(ctypes.c_int32)),
+        optional_pointer(args.forbidden_imagery_value, ctypes.c_double),
+        optional_pointer(args.forbidden_label_value, ctypes.c_int),
+        optional_pointer(args.desired_label_value, ctypes.c_int),
+        args.reroll,
+        label_lut.ctypes.data_as(ctypes.POINTER(ctypes.c_int32)),
+        len(label_lut),
+        args.label_nd,
+        args.block_cache_megabytes << 20,
+        optional_disk_cache,
+        args.disk_cache_megabytes << 20,
+        args.chip_store.encode() if args.chip_store else None,
+        optional_pointer(args.image_nd, ctypes.c_double),
+        augmentations,  # flips and/or quarter turns
+        args.prefetch_windows,
+        optional_array(class_frequencies, ctypes.c_double),
+        0 if class_frequencies is None else len(class_frequencies),
+        args.hard_example_fraction,
+        args.region_windows,
+        args.pair_quotas,
+        args.chip_size,
+        gdal_config,
+        cloud_template,
+        args.cloud_threshold)
+    imagery_data_type = ctypes.c_int()
+    label_data_type = ctypes.c_int()
+    libchips.get_data_types(training_ctx, ctypes.byref(imagery_data_type), ctypes.byref(label_data_type))
+    args.imagery_data_type = imagery_data_type.value
+    args.label_data_type = label_data_type.value
+    print('\t IMAGERY AND LABEL DATA TYPES: {} {}'.format(args.imagery_data_type, args.label_data_type))
+    print('\t GDAL CONFIGURATION:')
+    print_gdal_config(libchips, training_ctx, args.gdal_config)
 
     # ---------------------------------
     print('RECORDING RUN')
@@ -401,6 +832,9 @@ if __name__ == '__main__':
         s3 = boto3.client('s3')
         s3.upload_file('/tmp/args.txt', args.s3_bucket,
                        '{}/{}/training_args.txt'.format(args.s3_prefix, arg_hash))
+        if statistics is not None:
+            s3.upload_file(args.statistics, args.s3_bucket,
+                           '{}/{}/statistics.json'.format(args.s3_prefix, arg_hash))
         del s3
 
     # ---------------------------------
@@ -437,9 +871,11 @@ if __name__ == '__main__':
     natural_epoch_size = 0.0
     for i in range(len(args.pairs)):
         natural_epoch_size = natural_epoch_size + \
-            (libchips.get_width(i) * libchips.get_height(i))
+            (libchips.get_width(training_ctx, i) * libchips.get_height(training_ctx, i))
     natural_epoch_size = (6.0 * natural_epoch_size) / \
         (7.0 * args.window_size_imagery * args.window_size_imagery)
+    natural_epoch_size = natural_epoch_size * \
+        {0: 1, 1: 4, 2: 4, 3: 8}[augmentations]
     natural_epoch_size = int(natural_epoch_size)
     print('\t NATURAL EPOCH SIZE={}'.format(natural_epoch_size))
     args.max_epoch_size = min(args.max_epoch_size, natural_epoch_size)
@@ -474,7 +910,7 @@ if __name__ == '__main__':
         args.band_count,
         input_stride=args.input_stride,
         class_count=class_count,
-        divisor=args.resolution_divisor,
+        divisor=1 if args.reduced_resolution_reads else args.resolution_divisor,
         pretrained=True
     ).to(device)
 
@@ -512,6 +948,7 @@ if __name__ == '__main__':
               obj,
               args.epochs1,
               libchips,
+              training_ctx,
               device,
               copy.deepcopy(args),
               arg_hash)
@@ -552,6 +989,7 @@ if __name__ == '__main__':
               obj,
               args.epochs2,
               libchips,
+              training_ctx,
               device,
               copy.deepcopy(args),
               arg_hash)
@@ -584,6 +1022,7 @@ if __name__ == '__main__':
               obj,
               args.epochs3,
               libchips,
+              training_ctx,
               device,
               copy.deepcopy(args),
               arg_hash)
@@ -633,6 +1072,7 @@ if __name__ == '__main__':
           obj,
           args.epochs4,
           libchips,
+          training_ctx,
           device,
           copy.deepcopy(args),
           arg_hash,
@@ -652,32 +1092,56 @@ if __name__ == '__main__':
             s3.upload_file('weights.pth', s3_bucket, s3_prefix)
         del s3
 
-    libchips.stop()
+    libchips.stop(training_ctx)
 
     if not args.no_eval:
         print('\t EVALUATING')
-        libchips.start(
+        evaluation_ctx = libchips.start(
             args.read_threads,  # Number of threads
             args.read_threads * 2,  # The number of read slots
             len(args.pairs),  # The number of pairs
-            b'/tmp/mul%d.tif',  # Image data
-            b'/tmp/mask%d.tif',  # Label data
-            6,  # Make all rasters float32
-            5,  # Make all labels int32
-            None,  # means
+            tmp_mul.replace('{}', '%d').encode(),  # Image data
+            tmp_label.replace('{}', '%d').encode(),  # Label data
+            0,  # Native imagery type
+            0,  # Native label type
+            None,  # means (applied on the device)
             None,  # standard deviations
             args.radius,  # typical radius of a component
             2,  # Evaluation mode
             args.window_size_imagery,
             args.window_size_labels,
             len(args.bands),
-            np.array(args.bands, dtype=np.int32).ctypes.data_as(ctypes.POINTER(ctypes.c_int32)))
+            np.array(args.bands, dtype=np.int32).ctypes.data_as(ctypes.POINTER(ctypes.c_int32)),
+            optional_pointer(args.forbidden_imagery_value, ctypes.c_double),
+            optional_pointer(args.forbidden_label_value, ctypes.c_int),
+            optional_pointer(args.desired_label_value, ctypes.c_int),
+            args.reroll,
+            label_lut.ctypes.data_as(ctypes.POINTER(ctypes.c_int32)),
+            len(label_lut),
+            args.label_nd,
+            args.block_cache_megabytes << 20,
+            optional_disk_cache,
+            args.disk_cache_megabytes << 20,
+            args.chip_store.encode() if args.chip_store else None,
+            optional_pointer(args.image_nd, ctypes.c_double),
+            0,  # no augmentation
+            args.prefetch_windows,
+            None,  # evaluate on the natural class frequencies
+            0,
+            0.0,  # no hard examples
+            args.region_windows,
+            args.pair_quotas,
+            args.chip_size,
+            gdal_config,
+            cloud_template,
+            args.cloud_threshold)
         evaluate(model,
                  libchips,
+                 evaluation_ctx,
                  device,
                  copy.deepcopy(args),
                  arg_hash)
-        libchips.stop()
+        libchips.stop(evaluation_ctx)
 
     libchips.deinit()
     exit(0)
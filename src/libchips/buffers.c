@@ -0,0 +1,391 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#include <assert.h>
+#include <stdint.h>
+#include <string.h>
+
+#include <gdal.h>
+
+#include "buffers.h"
+
+/**
+ * Given a GDAL data type, return the word length of that type.
+ *
+ * @param GDALDataType dt The data type
+ * @return The word length
+ */
+int word_size(GDALDataType dt)
+{
+    switch (dt)
+    {
+    case GDT_Byte:
+        return 1;
+    case GDT_UInt16:
+        return 2;
+    case GDT_Int16:
+        return 2;
+    case GDT_UInt32:
+        return 4;
+    case GDT_Int32:
+        return 4;
+    case GDT_Float32:
+        return 4;
+    case GDT_Float64:
+        return 8;
+    case GDT_CInt16:
+        return 4;
+    case GDT_CInt32:
+        return 8;
+    case GDT_CFloat32:
+        return 8;
+    case GDT_CFloat64:
+        return 16;
+    default:
+        assert(0);
+    }
+}
+
+/**
+ * Determine whether a value can be stored in a word of the given
+ * type without loss.
+ *
+ * @param dt The data type
+ * @param value The value
+ * @return 1 if the value fits, 0 otherwise
+ */
+int word_holds(GDALDataType dt, double value)
+{
+    switch (dt)
+    {
+    case GDT_Byte:
+        return value >= 0 && value <= UINT8_MAX && value == (int64_t)value;
+    case GDT_UInt16:
+        return value >= 0 && value <= UINT16_MAX && value == (int64_t)value;
+    case GDT_Int16:
+        return value >= INT16_MIN && value <= INT16_MAX && value == (int64_t)value;
+    case GDT_UInt32:
+        return value >= 0 && value <= UINT32_MAX && value == (int64_t)value;
+    case GDT_Int32:
+        return value >= INT32_MIN && value <= INT32_MAX && value == (int64_t)value;
+    case GDT_Float32:
+    case GDT_Float64:
+        return 1;
+    default:
+        return 0;
+    }
+}
+
+#define CONTAINS(type)                                 \
+    {                                                  \
+        const type *words = (const type *)buffer;      \
+        for (uint64_t i = 0; i < n; ++i)               \
+        {                                              \
+            if (words[i] == value)                     \
+            {                                          \
+                return 1;                              \
+            }                                          \
+        }                                              \
+        return 0;                                      \
+    }
+
+/**
+ * Determine whether a buffer contains a particular value.
+ *
+ * @param buffer The buffer to search
+ * @param dt The data type of the words in the buffer
+ * @param n The number of words in the buffer
+ * @param value The value to look for
+ * @return 1 if the value is present, 0 otherwise
+ */
+int buffer_contains(const void *buffer, GDALDataType dt, uint64_t n, double value)
+{
+    switch (dt)
+    {
+    case GDT_Byte:
+        CONTAINS(uint8_t)
+    case GDT_UInt16:
+        CONTAINS(uint16_t)
+    case GDT_Int16:
+        CONTAINS(int16_t)
+    case GDT_UInt32:
+        CONTAINS(uint32_t)
+    case GDT_Int32:
+        CONTAINS(int32_t)
+    case GDT_Float32:
+        CONTAINS(float)
+    case GDT_Float64:
+        CONTAINS(double)
+    default:
+        assert(0);
+    }
+}
+
+#define REMAP(type)                                                     \
+    {                                                                   \
+        type *words = (type *)buffer;                                   \
+        for (uint64_t i = 0; i < n; ++i)                                \
+        {                                                               \
+            int64_t word = (int64_t)words[i];                           \
+            words[i] = (type)((word >= 0 && word < lut_size) ? lut[word] : nd); \
+        }                                                               \
+        return;                                                         \
+    }
+
+/**
+ * Remap the contents of a buffer through a lookup table.  Values
+ * outside of the table are replaced with the nodata value.
+ *
+ * @param buffer The buffer to remap (in place)
+ * @param dt The data type of the words in the buffer
+ * @param n The number of words in the buffer
+ * @param lut The lookup table
+ * @param lut_size The number of entries in the lookup table
+ * @param nd The value to use for words outside of the table
+ */
+void buffer_remap(void *buffer, GDALDataType dt, uint64_t n, const int *lut, int lut_size, int nd)
+{
+    switch (dt)
+    {
+    case GDT_Byte:
+        REMAP(uint8_t)
+    case GDT_UInt16:
+        REMAP(uint16_t)
+    case GDT_Int16:
+        REMAP(int16_t)
+    case GDT_UInt32:
+        REMAP(uint32_t)
+    case GDT_Int32:
+        REMAP(int32_t)
+    case GDT_Float32:
+        REMAP(float)
+    case GDT_Float64:
+        REMAP(double)
+    default:
+        assert(0);
+    }
+}
+
+#define HISTOGRAM(type)                                                     \
+    {                                                                       \
+        const type *words = (const type *)buffer;                           \
+        for (uint64_t i = 0; i < n; ++i)                                    \
+        {                                                                   \
+            int64_t word = (int64_t)words[i];                               \
+            if (lut != NULL)                                                \
+            {                                                               \
+                word = (word >= 0 && word < lut_size) ? lut[word] : nd;     \
+            }                                                               \
+            if (word >= 0 && word < class_count)                            \
+            {                                                               \
+                histogram[word]++;                                          \
+            }                                                               \
+        }                                                                   \
+        return;                                                             \
+    }
+
+/**
+ * Count the words of each class in a buffer of labels.  Classes are
+ * those of the (remapped, if there is a lookup table) labels; words
+ * outside of [0, class_count) are not counted.
+ *
+ * @param buffer The buffer of (unremapped) labels
+ * @param dt The data type of the words in the buffer
+ * @param n The number of words in the buffer
+ * @param lut The lookup table (or NULL)
+ * @param lut_size The number of entries in the lookup table
+ * @param nd The value of words outside of the table
+ * @param histogram The return-location for the class_count counts (zeroed first)
+ * @param class_count The number of classes
+ */
+void buffer_histogram(const void *buffer, GDALDataType dt, uint64_t n, const int *lut, int lut_size, int nd,
+                      uint64_t *histogram, int class_count)
+{
+    memset(histogram, 0, sizeof(uint64_t) * class_count);
+
+    switch (dt)
+    {
+    case GDT_Byte:
+        HISTOGRAM(uint8_t)
+    case GDT_UInt16:
+        HISTOGRAM(uint16_t)
+    case GDT_Int16:
+        HISTOGRAM(int16_t)
+    case GDT_UInt32:
+        HISTOGRAM(uint32_t)
+    case GDT_Int32:
+        HISTOGRAM(int32_t)
+    case GDT_Float32:
+        HISTOGRAM(float)
+    case GDT_Float64:
+        HISTOGRAM(double)
+    default:
+        assert(0);
+    }
+}
+
+#define NORMALIZE(type)                                                     \
+    {                                                                       \
+        type *words = (type *)buffer;                                       \
+        for (int band = 0; band < band_count; ++band)                       \
+        {                                                                   \
+            const double mu = mus[band];                                    \
+            const double scale = (sigmas[band] > 0) ? 1.0 / sigmas[band] : 1.0; \
+            for (uint64_t i = band * n; i < (band + 1) * n; ++i)            \
+            {                                                               \
+                if (words[i] != words[i] || (nd_check && words[i] == nd))   \
+                {                                                           \
+                    continue;                                               \
+                }                                                           \
+                words[i] = (type)((words[i] - mu) * scale);                 \
+            }                                                               \
+        }                                                                   \
+        return;                                                             \
+    }
+
+/**
+ * Normalize a band-sequential floating-point buffer in place, band by
+ * band, as (x - mu) / sigma.  NaNs and nodata words are left as they
+ * are so that they can still be recognized downstream.
+ *
+ * @param buffer The buffer to normalize (in place)
+ * @param dt The data type of the words in the buffer (GDT_Float32 or GDT_Float64)
+ * @param band_count The number of bands in the buffer
+ * @param n The number of words in each band
+ * @param mus The per-band means
+ * @param sigmas The per-band standard deviations
+ * @param nd_check Whether nodata words should be skipped
+ * @param nd The nodata value
+ */
+void buffer_normalize(void *buffer, GDALDataType dt, int band_count, uint64_t n,
+                      const double *mus, const double *sigmas,
+                      int nd_check, double nd)
+{
+    switch (dt)
+    {
+    case GDT_Float32:
+        NORMALIZE(float)
+    case GDT_Float64:
+        NORMALIZE(double)
+    default:
+        assert(0);
+    }
+}
+
+#define TRANSFORM(type)                                                     \
+    {                                                                       \
+        type *words = (type *)buffer;                                       \
+        type *copy = (type *)scratch;                                       \
+        for (int band = 0; band < band_count; ++band)                       \
+        {                                                                   \
+            type *plane = words + ((uint64_t)band * size * size);           \
+            memcpy(copy, plane, sizeof(type) * size * size);                \
+            for (int row = 0; row < size; ++row)                            \
+            {                                                               \
+                const int r = flip_y ? (size - 1 - row) : row;              \
+                for (int col = 0; col < size; ++col)                        \
+                {                                                           \
+                    const int c = flip_x ? (size - 1 - col) : col;          \
+                    plane[(row * size) + col] = transpose ? copy[(c * size) + r] : copy[(r * size) + c]; \
+                }                                                           \
+            }                                                               \
+        }                                                                   \
+        return;                                                             \
+    }
+
+/**
+ * Apply one of the eight symmetries of the square to each band of a
+ * band-sequential buffer of square windows, in place.  The window is
+ * first transposed (if bit 2 of the transform is set), then flipped
+ * left-to-right (bit 0) and top-to-bottom (bit 1), so that for
+ * instance 5 is a clockwise and 6 a counterclockwise quarter turn.
+ *
+ * @param buffer The buffer to transform (in place)
+ * @param scratch A buffer large enough to hold one band of the window
+ * @param dt The data type of the words in the buffer
+ * @param band_count The number of bands in the buffer
+ * @param size The width (and height) of the window
+ * @param transform The transform to apply (0 through 7)
+ */
+void buffer_transform(void *buffer, void *scratch, GDALDataType dt, int band_count, int size, int transform)
+{
+    const int flip_x = transform & 1;
+    const int flip_y = transform & 2;
+    const int transpose = transform & 4;
+
+    if (transform == 0)
+    {
+        return;
+    }
+
+    switch (word_size(dt))
+    {
+    case 1:
+        TRANSFORM(uint8_t)
+    case 2:
+        TRANSFORM(uint16_t)
+    case 4:
+        TRANSFORM(uint32_t)
+    case 8:
+        TRANSFORM(uint64_t)
+    default:
+        assert(0);
+    }
+}
+
+/**
+ * Copy a square window out of a larger square region, band by band.
+ * Both buffers are band-sequential, as written by
+ * GDALDatasetRasterIO.
+ *
+ * @param region The region
+ * @param region_size The width (and height) of the region
+ * @param window The return-location for the window
+ * @param window_size The width (and height) of the window
+ * @param x The x-offset of the window within the region
+ * @param y The y-offset of the window within the region
+ * @param dt The data type of the words in both buffers
+ * @param band_count The number of bands in both buffers
+ */
+void buffer_crop(const void *region, int region_size, void *window, int window_size, int x, int y, GDALDataType dt, int band_count)
+{
+    uint64_t word = word_size(dt);
+
+    for (int band = 0; band < band_count; ++band)
+    {
+        const uint8_t *src = (const uint8_t *)region + (uint64_t)band * region_size * region_size * word;
+        uint8_t *dst = (uint8_t *)window + (uint64_t)band * window_size * window_size * word;
+
+        for (int row = 0; row < window_size; ++row)
+        {
+            memcpy(dst + (uint64_t)row * window_size * word,
+                   src + ((uint64_t)(y + row) * region_size + x) * word,
+                   window_size * word);
+        }
+    }
+}
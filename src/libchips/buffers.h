@@ -0,0 +1,55 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#ifndef __BUFFERS_H__
+#define __BUFFERS_H__
+
+#include <stdint.h>
+
+#include <gdal.h>
+
+int word_size(GDALDataType dt);
+
+int word_holds(GDALDataType dt, double value);
+
+int buffer_contains(const void *buffer, GDALDataType dt, uint64_t n, double value);
+
+void buffer_remap(void *buffer, GDALDataType dt, uint64_t n, const int *lut, int lut_size, int nd);
+
+void buffer_histogram(const void *buffer, GDALDataType dt, uint64_t n, const int *lut, int lut_size, int nd,
+                      uint64_t *histogram, int class_count);
+
+void buffer_normalize(void *buffer, GDALDataType dt, int band_count, uint64_t n,
+                      const double *mus, const double *sigmas,
+                      int nd_check, double nd);
+
+void buffer_transform(void *buffer, void *scratch, GDALDataType dt, int band_count, int size, int transform);
+
+void buffer_crop(const void *region, int region_size, void *window, int window_size, int x, int y, GDALDataType dt, int band_count);
+
+#endif
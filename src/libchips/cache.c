@@ -0,0 +1,709 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <inttypes.h>
+#include <string.h>
+
+#include <dirent.h>
+#include <pthread.h>
+#include <sys/stat.h>
+#include <time.h>
+#include <unistd.h>
+
+#include <gdal.h>
+#include <cpl_vsi.h>
+
+#include "context.h"
+#include "buffers.h"
+#include "cache.h"
+
+#define BUCKETS (1 << 12)
+#define IDENTITY_BYTES (1 << 16)
+
+struct block
+{
+    uint64_t key;
+    int width;
+    int height;
+    uint64_t bytes;
+    void *data;
+    struct block *hash_next;
+    struct block *lru_prev;
+    struct block *lru_next;
+};
+
+struct block_cache
+{
+    char *directory; // where the blocks live (NULL if they are in memory)
+    pthread_mutex_t mutex;
+    struct block **buckets;
+    struct block *lru_head; // most recently used
+    struct block *lru_tail; // least recently used
+    uint64_t bytes;
+    uint64_t budget;
+    uint64_t hits;
+    uint64_t misses;
+};
+
+static void disk_scan(struct block_cache *cache);
+
+/**
+ * Initialize one decoded-block cache per pair, and optionally an
+ * on-disk cache of decoded blocks shared by all of the pairs.  The
+ * memory budget is divided evenly among the pairs.  Budgets of zero
+ * disable caching.
+ *
+ * @param ctx The context
+ * @param budget The total number of bytes of decoded blocks to keep in memory
+ * @param directory The directory in which to keep decoded blocks on disk (or NULL)
+ * @param disk_budget The number of bytes of decoded blocks to keep on disk
+ */
+void cache_init(struct context *ctx, uint64_t budget, const char *directory, uint64_t disk_budget)
+{
+    ctx->block_caches = NULL;
+    ctx->disk_cache = NULL;
+    ctx->disk_identities = NULL;
+
+    if (directory != NULL && disk_budget > 0)
+    {
+        if (mkdir(directory, 0755) != 0 && access(directory, W_OK) != 0)
+        {
+            fprintf(stderr, "COULD NOT USE %s FOR THE DISK CACHE\n", directory);
+        }
+        else
+        {
+            ctx->disk_cache = (struct block_cache *)calloc(1, sizeof(struct block_cache));
+            ctx->disk_cache->directory = strdup(directory);
+            pthread_mutex_init(&ctx->disk_cache->mutex, NULL);
+            ctx->disk_cache->buckets = (struct block **)calloc(BUCKETS, sizeof(struct block *));
+            ctx->disk_cache->budget = disk_budget;
+            disk_scan(ctx->disk_cache);
+
+            // Blocks are filed under the identity of the dataset that
+            // they came from, so that they can be shared across runs
+            ctx->disk_identities = (uint64_t *)calloc(ctx->L * 2, sizeof(uint64_t));
+            for (int pair = 0; pair < ctx->L; ++pair)
+            {
+                char filename[0xff];
+
+                sprintf(filename, ctx->imagery_template, pair);
+                ctx->disk_identities[(pair * 2) + imagery_block] = dataset_identity(filename, ctx->imagery_data_type);
+                if (ctx->label_template != NULL && ctx->label_vectors == NULL)
+                {
+                    sprintf(filename, ctx->label_template, pair);
+                    ctx->disk_identities[(pair * 2) + label_block] = dataset_identity(filename, ctx->label_data_type);
+                }
+            }
+        }
+    }
+
+    if (budget == 0 && ctx->disk_cache == NULL)
+    {
+        return;
+    }
+
+    ctx->block_caches = (struct block_cache *)calloc(ctx->L, sizeof(struct block_cache));
+    for (int pair = 0; pair < ctx->L; ++pair)
+    {
+        struct block_cache *cache = &ctx->block_caches[pair];
+        pthread_mutex_init(&cache->mutex, NULL);
+        cache->buckets = (struct block **)calloc(BUCKETS, sizeof(struct block *));
+        cache->budget = budget / ctx->L;
+    }
+}
+
+/**
+ * Release one cache (the blocks of an on-disk cache stay on disk).
+ */
+static void cache_free(struct block_cache *cache)
+{
+    struct block *block = cache->lru_head;
+    while (block != NULL)
+    {
+        struct block *next = block->lru_next;
+        free(block->data);
+        free(block);
+        block = next;
+    }
+    free(cache->buckets);
+    free(cache->directory);
+    pthread_mutex_destroy(&cache->mutex);
+}
+
+/**
+ * Release all cached blocks.
+ *
+ * @param ctx The context
+ */
+void cache_deinit(struct context *ctx)
+{
+    if (ctx->disk_cache != NULL)
+    {
+        cache_free(ctx->disk_cache);
+        free(ctx->disk_cache);
+        free(ctx->disk_identities);
+        ctx->disk_cache = NULL;
+        ctx->disk_identities = NULL;
+    }
+
+    if (ctx->block_caches == NULL)
+    {
+        return;
+    }
+
+    for (int pair = 0; pair < ctx->L; ++pair)
+    {
+        cache_free(&ctx->block_caches[pair]);
+    }
+    free(ctx->block_caches);
+    ctx->block_caches = NULL;
+}
+
+/**
+ * Report the cache hit and miss counts (summed over all pairs) and
+ * the number of bytes currently cached.
+ *
+ * @param ctx The context
+ * @param hits The return-location for the number of hits
+ * @param misses The return-location for the number of misses
+ * @param bytes The return-location for the number of bytes cached
+ */
+void cache_stats(struct context *ctx, uint64_t *hits, uint64_t *misses, uint64_t *bytes)
+{
+    *hits = *misses = *bytes = 0;
+    for (int pair = 0; ctx->block_caches != NULL && pair < ctx->L; ++pair)
+    {
+        struct block_cache *cache = &ctx->block_caches[pair];
+        pthread_mutex_lock(&cache->mutex);
+        *hits += cache->hits;
+        *misses += cache->misses;
+        *bytes += cache->bytes;
+        pthread_mutex_unlock(&cache->mutex);
+    }
+}
+
+/**
+ * Report the on-disk cache hit and miss counts and the number of
+ * bytes currently on disk.
+ *
+ * @param ctx The context
+ * @param hits The return-location for the number of hits
+ * @param misses The return-location for the number of misses
+ * @param bytes The return-location for the number of bytes on disk
+ */
+void cache_disk_stats(struct context *ctx, uint64_t *hits, uint64_t *misses, uint64_t *bytes)
+{
+    *hits = *misses = *bytes = 0;
+    if (ctx->disk_cache != NULL)
+    {
+        struct block_cache *cache = ctx->disk_cache;
+        pthread_mutex_lock(&cache->mutex);
+        *hits = cache->hits;
+        *misses = cache->misses;
+        *bytes = cache->bytes;
+        pthread_mutex_unlock(&cache->mutex);
+    }
+}
+
+static inline uint64_t block_key(int kind, int band, int block_x, int block_y)
+{
+    return ((uint64_t)kind << 63) | ((uint64_t)band << 48) | ((uint64_t)block_x << 24) | (uint64_t)block_y;
+}
+
+static inline uint64_t mix(uint64_t key)
+{
+    key = (key ^ (key >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    key = (key ^ (key >> 27)) * 0x94d049bb133111ebULL;
+    return key ^ (key >> 31);
+}
+
+static inline int bucket_of(uint64_t key)
+{
+    return (int)((key * 0x9e3779b97f4a7c15ULL) >> 52) & (BUCKETS - 1);
+}
+
+static void lru_unlink(struct block_cache *cache, struct block *block)
+{
+    if (block->lru_prev != NULL)
+    {
+        block->lru_prev->lru_next = block->lru_next;
+    }
+    else
+    {
+        cache->lru_head = block->lru_next;
+    }
+    if (block->lru_next != NULL)
+    {
+        block->lru_next->lru_prev = block->lru_prev;
+    }
+    else
+    {
+        cache->lru_tail = block->lru_prev;
+    }
+    block->lru_prev = block->lru_next = NULL;
+}
+
+static void lru_push_front(struct block_cache *cache, struct block *block)
+{
+    block->lru_prev = NULL;
+    block->lru_next = cache->lru_head;
+    if (cache->lru_head != NULL)
+    {
+        cache->lru_head->lru_prev = block;
+    }
+    cache->lru_head = block;
+    if (cache->lru_tail == NULL)
+    {
+        cache->lru_tail = block;
+    }
+}
+
+/**
+ * Find a block (the cache mutex must be held).  A found block becomes
+ * the most recently used one.
+ */
+static struct block *lookup(struct block_cache *cache, uint64_t key)
+{
+    for (struct block *block = cache->buckets[bucket_of(key)]; block != NULL; block = block->hash_next)
+    {
+        if (block->key == key)
+        {
+            lru_unlink(cache, block);
+            lru_push_front(cache, block);
+            return block;
+        }
+    }
+    return NULL;
+}
+
+/**
+ * Evict least recently used blocks until the given number of
+ * additional bytes fits in the budget (the cache mutex must be held).
+ */
+static void evict(struct block_cache *cache, uint64_t incoming)
+{
+    while (cache->lru_tail != NULL && cache->bytes + incoming > cache->budget)
+    {
+        struct block *victim = cache->lru_tail;
+        struct block **link = &cache->buckets[bucket_of(victim->key)];
+
+        while (*link != victim)
+        {
+            link = &(*link)->hash_next;
+        }
+        *link = victim->hash_next;
+        lru_unlink(cache, victim);
+        cache->bytes -= victim->bytes;
+        if (cache->directory != NULL)
+        {
+            char path[0x200];
+            sprintf(path, "%s/%016" PRIx64 ".block", cache->directory, victim->key);
+            unlink(path);
+        }
+        free(victim->data);
+        free(victim);
+    }
+}
+
+/**
+ * Insert a freshly decoded block (the cache mutex must be held).  If
+ * another thread inserted the same block in the meantime, the new
+ * copy is discarded and the existing one is returned.
+ */
+static struct block *insert(struct block_cache *cache, struct block *block)
+{
+    struct block *existing = lookup(cache, block->key);
+    int bucket = bucket_of(block->key);
+
+    if (existing != NULL)
+    {
+        free(block->data);
+        free(block);
+        return existing;
+    }
+
+    evict(cache, block->bytes);
+    block->hash_next = cache->buckets[bucket];
+    cache->buckets[bucket] = block;
+    lru_push_front(cache, block);
+    cache->bytes += block->bytes;
+
+    return block;
+}
+
+/**
+ * Summarize the identity of a dataset (its size and first bytes,
+ * which for a VRT include the paths of its sources) and the type to
+ * which it is decoded.
+ *
+ * @param filename The filename of the dataset
+ * @param data_type The type to which the dataset is decoded
+ * @return The identity
+ */
+uint64_t dataset_identity(const char *filename, GDALDataType data_type)
+{
+    VSIStatBufL stat;
+    uint64_t identity = 0xcbf29ce484222325ULL;
+    uint8_t *bytes = (uint8_t *)malloc(IDENTITY_BYTES);
+    size_t count = 0;
+    VSILFILE *file;
+
+    if (VSIStatL(filename, &stat) == 0)
+    {
+        identity = mix(identity ^ (uint64_t)stat.st_size);
+    }
+    if ((file = VSIFOpenL(filename, "rb")) != NULL)
+    {
+        count = VSIFReadL(bytes, 1, IDENTITY_BYTES, file);
+        VSIFCloseL(file);
+    }
+    for (size_t i = 0; i < count; ++i)
+    {
+        identity = (identity ^ bytes[i]) * 0x100000001b3ULL;
+    }
+    free(bytes);
+
+    return mix(identity ^ (uint64_t)data_type);
+}
+
+struct found_block
+{
+    struct block *block;
+    time_t mtime;
+};
+
+static int compare_mtimes(const void *a, const void *b)
+{
+    const struct found_block *found_a = (const struct found_block *)a;
+    const struct found_block *found_b = (const struct found_block *)b;
+    return (found_a->mtime > found_b->mtime) - (found_a->mtime < found_b->mtime);
+}
+
+/**
+ * Index the blocks already in the on-disk cache directory, oldest
+ * first, and trim them to the budget.
+ */
+static void disk_scan(struct block_cache *cache)
+{
+    DIR *dir = opendir(cache->directory);
+    struct dirent *entry;
+    struct found_block *found = NULL;
+    int count = 0;
+
+    if (dir == NULL)
+    {
+        return;
+    }
+    while ((entry = readdir(dir)) != NULL)
+    {
+        char path[0x200];
+        struct stat info;
+        uint64_t key;
+        char suffix[8];
+
+        if (sscanf(entry->d_name, "%16" SCNx64 "%7s", &key, suffix) != 2 || strcmp(suffix, ".block") != 0)
+        {
+            continue;
+        }
+        sprintf(path, "%s/%s", cache->directory, entry->d_name);
+        if (stat(path, &info) != 0)
+        {
+            continue;
+        }
+        found = (struct found_block *)realloc(found, sizeof(struct found_block) * (count + 1));
+        found[count].block = (struct block *)calloc(1, sizeof(struct block));
+        found[count].block->key = key;
+        found[count].block->bytes = info.st_size;
+        found[count].mtime = info.st_mtime;
+        count++;
+    }
+    closedir(dir);
+
+    qsort(found, count, sizeof(struct found_block), compare_mtimes);
+    for (int i = 0; i < count; ++i)
+    {
+        struct block *block = found[i].block;
+        int bucket = bucket_of(block->key);
+        block->hash_next = cache->buckets[bucket];
+        cache->buckets[bucket] = block;
+        lru_push_front(cache, block);
+        cache->bytes += block->bytes;
+    }
+    evict(cache, 0);
+    free(found);
+}
+
+/**
+ * Try to load a block from the on-disk cache.
+ *
+ * @return 1 if the block was loaded, 0 otherwise
+ */
+static int disk_load(struct context *ctx, int pair, int kind, struct block *block)
+{
+    struct block_cache *cache = ctx->disk_cache;
+    uint64_t key = mix(ctx->disk_identities[(pair * 2) + kind] ^ block->key);
+    char path[0x200];
+    FILE *file;
+    int loaded = 0;
+
+    pthread_mutex_lock(&cache->mutex);
+    if (lookup(cache, key) == NULL)
+    {
+        cache->misses++;
+        pthread_mutex_unlock(&cache->mutex);
+        return 0;
+    }
+    pthread_mutex_unlock(&cache->mutex);
+
+    sprintf(path, "%s/%016" PRIx64 ".block", cache->directory, key);
+    if ((file = fopen(path, "rb")) != NULL)
+    {
+        loaded = (fread(block->data, 1, block->bytes, file) == block->bytes);
+        fclose(file);
+    }
+
+    pthread_mutex_lock(&cache->mutex);
+    if (loaded)
+    {
+        cache->hits++;
+    }
+    else
+    {
+        cache->misses++;
+    }
+    pthread_mutex_unlock(&cache->mutex);
+
+    return loaded;
+}
+
+/**
+ * Write a freshly decoded block to the on-disk cache, evicting the
+ * least recently used blocks to stay within the budget.
+ */
+static void disk_store(struct context *ctx, int pair, int kind, const struct block *block)
+{
+    struct block_cache *cache = ctx->disk_cache;
+    uint64_t key = mix(ctx->disk_identities[(pair * 2) + kind] ^ block->key);
+    char path[0x200];
+    char temporary[0x200];
+    struct block *entry;
+    FILE *file;
+    int fd;
+
+    // Write under a temporary name so that readers never see a
+    // partial block
+    sprintf(path, "%s/%016" PRIx64 ".block", cache->directory, key);
+    sprintf(temporary, "%s/.partial.XXXXXX", cache->directory);
+    if ((fd = mkstemp(temporary)) < 0)
+    {
+        return;
+    }
+    if ((file = fdopen(fd, "wb")) == NULL)
+    {
+        close(fd);
+        unlink(temporary);
+        return;
+    }
+    if (fwrite(block->data, 1, block->bytes, file) != block->bytes || fclose(file) != 0 || rename(temporary, path) != 0)
+    {
+        unlink(temporary);
+        return;
+    }
+
+    entry = (struct block *)calloc(1, sizeof(struct block));
+    entry->key = key;
+    entry->bytes = block->bytes;
+    pthread_mutex_lock(&cache->mutex);
+    insert(cache, entry);
+    pthread_mutex_unlock(&cache->mutex);
+}
+
+/**
+ * Copy the part of a block that overlaps a window into the window
+ * buffer.
+ */
+static void copy_overlap(const struct block *block,
+                         int block_x0, int block_y0,
+                         int x, int y, int size,
+                         void *band_buffer, int word)
+{
+    int x0 = (block_x0 > x) ? block_x0 : x;
+    int y0 = (block_y0 > y) ? block_y0 : y;
+    int x1 = (block_x0 + block->width < x + size) ? block_x0 + block->width : x + size;
+    int y1 = (block_y0 + block->height < y + size) ? block_y0 + block->height : y + size;
+
+    for (int row = y0; row < y1; ++row)
+    {
+        const uint8_t *src = (const uint8_t *)block->data + ((uint64_t)(row - block_y0) * block->width + (x0 - block_x0)) * word;
+        uint8_t *dst = (uint8_t *)band_buffer + ((uint64_t)(row - y) * size + (x0 - x)) * word;
+        memcpy(dst, src, (uint64_t)(x1 - x0) * word);
+    }
+}
+
+/**
+ * Read a square window of one or more bands, assembling it from
+ * cached decoded blocks (in memory or on disk) where possible.  The
+ * result has the same (band, row, column) layout as
+ * GDALDatasetRasterIO.  If caching is disabled this is just
+ * GDALDatasetRasterIO.
+ *
+ * @param ctx The context
+ * @param pair The index of the pair being read
+ * @param kind imagery_block or label_block
+ * @param dataset The calling thread's handle to the dataset
+ * @param x The x-offset of the window (in pixels)
+ * @param y The y-offset of the window (in pixels)
+ * @param size The width and height of the window (in pixels)
+ * @param buffer The return-location for the window
+ * @param data_type The data type of the buffer
+ * @param count The number of bands to read
+ * @param band_list The bands to read (NULL means the first count bands)
+ * @return CE_None on success, otherwise the error from GDAL
+ */
+CPLErr cache_read(struct context *ctx, int pair, int kind,
+                  GDALDatasetH dataset,
+                  int x, int y, int size,
+                  void *buffer, GDALDataType data_type,
+                  int count, int *band_list)
+{
+    struct block_cache *cache;
+    int word = word_size(data_type);
+    int block_width, block_height;
+    int width, height;
+
+    if (ctx->block_caches == NULL)
+    {
+        return GDALDatasetRasterIO(dataset, GF_Read,
+                                   x, y, size, size,
+                                   buffer, size, size,
+                                   data_type, count, band_list,
+                                   0, 0, 0);
+    }
+
+    cache = &ctx->block_caches[pair];
+    width = GDALGetRasterXSize(dataset);
+    height = GDALGetRasterYSize(dataset);
+    GDALGetBlockSize(GDALGetRasterBand(dataset, 1), &block_width, &block_height);
+
+    for (int b = 0; b < count; ++b)
+    {
+        int band = (band_list != NULL) ? band_list[b] : b + 1;
+        void *band_buffer = (uint8_t *)buffer + (uint64_t)b * size * size * word;
+
+        for (int block_y = y / block_height; block_y * block_height < y + size; ++block_y)
+        {
+            for (int block_x = x / block_width; block_x * block_width < x + size; ++block_x)
+            {
+                uint64_t key = block_key(kind, band, block_x, block_y);
+                int block_x0 = block_x * block_width;
+                int block_y0 = block_y * block_height;
+                struct block *block;
+
+                pthread_mutex_lock(&cache->mutex);
+                block = lookup(cache, key);
+                if (block != NULL)
+                {
+                    cache->hits++;
+                    copy_overlap(block, block_x0, block_y0, x, y, size, band_buffer, word);
+                    pthread_mutex_unlock(&cache->mutex);
+                    continue;
+                }
+                cache->misses++;
+                pthread_mutex_unlock(&cache->mutex);
+
+                // Load or decode the block outside of the lock
+                block = (struct block *)calloc(1, sizeof(struct block));
+                block->key = key;
+                block->width = (block_x0 + block_width <= width) ? block_width : width - block_x0;
+                block->height = (block_y0 + block_height <= height) ? block_height : height - block_y0;
+                block->bytes = (uint64_t)block->width * block->height * word;
+                block->data = malloc(block->bytes);
+                if (ctx->disk_cache == NULL || !disk_load(ctx, pair, kind, block))
+                {
+                    CPLErr err = GDALRasterIO(GDALGetRasterBand(dataset, band), GF_Read,
+                                              block_x0, block_y0, block->width, block->height,
+                                              block->data, block->width, block->height,
+                                              data_type, 0, 0);
+                    if (err != CE_None)
+                    {
+                        free(block->data);
+                        free(block);
+                        return err;
+                    }
+                    if (ctx->disk_cache != NULL)
+                    {
+                        disk_store(ctx, pair, kind, block);
+                    }
+                }
+
+                pthread_mutex_lock(&cache->mutex);
+                block = insert(cache, block);
+                copy_overlap(block, block_x0, block_y0, x, y, size, band_buffer, word);
+                pthread_mutex_unlock(&cache->mutex);
+            }
+        }
+    }
+
+    return CE_None;
+}
+
+/**
+ * Read a square window of one or more bands into a smaller square
+ * buffer, averaging the pixels that fall into each buffer pixel (GDAL
+ * reads from overviews where the rasters have suitable ones).  These
+ * reads bypass the block caches, which hold full-resolution blocks.
+ *
+ * @param dataset The calling thread's handle to the dataset
+ * @param x The x-offset of the window (in pixels)
+ * @param y The y-offset of the window (in pixels)
+ * @param size The width and height of the window (in pixels)
+ * @param buffer The return-location for the reduced window
+ * @param buffer_size The width and height of the buffer (in pixels)
+ * @param data_type The data type of the buffer
+ * @param count The number of bands to read
+ * @param band_list The bands to read (NULL means the first count bands)
+ * @return CE_None on success, otherwise the error from GDAL
+ */
+CPLErr reduced_read(GDALDatasetH dataset,
+                    int x, int y, int size,
+                    void *buffer, int buffer_size, GDALDataType data_type,
+                    int count, int *band_list)
+{
+    GDALRasterIOExtraArg extra;
+
+    INIT_RASTERIO_EXTRA_ARG(extra);
+    extra.eResampleAlg = GRIORA_Average;
+    return GDALDatasetRasterIOEx(dataset, GF_Read,
+                                 x, y, size, size,
+                                 buffer, buffer_size, buffer_size,
+                                 data_type, count, band_list,
+                                 0, 0, 0, &extra);
+}
@@ -0,0 +1,65 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#ifndef __CACHE_H__
+#define __CACHE_H__
+
+#include <stdint.h>
+
+#include <gdal.h>
+
+struct context;
+
+enum block_kind
+{
+    imagery_block = 0,
+    label_block = 1,
+};
+
+void cache_init(struct context *ctx, uint64_t budget, const char *directory, uint64_t disk_budget);
+
+void cache_deinit(struct context *ctx);
+
+void cache_stats(struct context *ctx, uint64_t *hits, uint64_t *misses, uint64_t *bytes);
+
+void cache_disk_stats(struct context *ctx, uint64_t *hits, uint64_t *misses, uint64_t *bytes);
+
+CPLErr cache_read(struct context *ctx, int pair, int kind,
+                  GDALDatasetH dataset,
+                  int x, int y, int size,
+                  void *buffer, GDALDataType data_type,
+                  int count, int *band_list);
+
+uint64_t dataset_identity(const char *filename, GDALDataType data_type);
+
+CPLErr reduced_read(GDALDatasetH dataset,
+                    int x, int y, int size,
+                    void *buffer, int buffer_size, GDALDataType data_type,
+                    int count, int *band_list);
+
+#endif
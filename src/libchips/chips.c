@@ -37,8 +37,22 @@
 
 #include <gdal.h>
 
-#include "globals.h"
+#include "context.h"
+#include "config.h"
+#include "buffers.h"
+#include "cache.h"
+#include "classes.h"
+#include "clouds.h"
+#include "hard.h"
+#include "pairs.h"
+#include "plan.h"
 #include "reader.h"
+#include "slots.h"
+#include "statistics.h"
+#include "store.h"
+#include "telemetry.h"
+#include "vectors.h"
+#include "windows.h"
 #include "macros.h"
 
 /**
@@ -58,62 +72,143 @@ void deinit()
 }
 
 /**
- * Given a GDAL data type, return the word length of that type.
+ * Get the width of the dataset.
  *
- * @param GDALDataType dt The data type
- * @return The word length
+ * @param ctx The context (from start)
+ * @param index The index of the dataset in question
+ * @return The width of the dataset
  */
-static int word_size(GDALDataType dt)
+int get_width(struct context *ctx, int index)
 {
-    switch (dt)
-    {
-    case GDT_Byte:
-        return 1;
-    case GDT_UInt16:
-        return 2;
-    case GDT_Int16:
-        return 2;
-    case GDT_UInt32:
-        return 4;
-    case GDT_Int32:
-        return 4;
-    case GDT_Float32:
-        return 4;
-    case GDT_Float64:
-        return 8;
-    case GDT_CInt16:
-        return 4;
-    case GDT_CInt32:
-        return 8;
-    case GDT_CFloat32:
-        return 8;
-    case GDT_CFloat64:
-        return 16;
-    default:
-        assert(0);
-    }
+    return ctx->widths[index];
 }
 
 /**
- * Get the width of the dataset.
+ * Get the height of the dataset.
  *
+ * @param ctx The context (from start)
  * @param index The index of the dataset in question
- * @return The width of the dataset
+ * @return The height of the dataset
  */
-int get_width(int index)
+int get_height(struct context *ctx, int index)
 {
-    return widths[index];
+    return ctx->heights[index];
 }
 
 /**
- * Get the height of the dataset.
+ * Get the types in which imagery and labels are delivered (these
+ * are the native types of the rasters if GDT_Unknown was given to
+ * start).
  *
- * @param index The index of the dataset in question
- * @return The height of the dataset
+ * @param ctx The context (from start)
+ * @param imagery_data_type The return-location for the imagery data type
+ * @param label_data_type The return-location for the label data type
+ */
+void get_data_types(struct context *ctx, int *imagery_data_type, int *label_data_type)
+{
+    *imagery_data_type = ctx->imagery_data_type;
+    *label_data_type = ctx->label_data_type;
+}
+
+/**
+ * Get the decoded-block cache counters.
+ *
+ * @param ctx The context (from start)
+ * @param hits The return-location for the number of block reads served from the cache
+ * @param misses The return-location for the number of blocks that had to be decoded
+ * @param bytes The return-location for the number of bytes currently cached
+ */
+void get_cache_stats(struct context *ctx, uint64_t *hits, uint64_t *misses, uint64_t *bytes)
+{
+    cache_stats(ctx, hits, misses, bytes);
+}
+
+/**
+ * Get the on-disk block cache counters.
+ *
+ * @param ctx The context (from start)
+ * @param hits The return-location for the number of blocks loaded from disk
+ * @param misses The return-location for the number of blocks not found on disk
+ * @param bytes The return-location for the number of bytes currently on disk
+ */
+void get_disk_cache_stats(struct context *ctx, uint64_t *hits, uint64_t *misses, uint64_t *bytes)
+{
+    cache_disk_stats(ctx, hits, misses, bytes);
+}
+
+/**
+ * Get the sampler counters (see enum stat in telemetry.h): windows
+ * read, bytes read, rejected windows, failed reads, nanoseconds
+ * spent by readers waiting for an empty slot, nanoseconds spent by
+ * consumers waiting for a full slot, the number of full slots, and
+ * the number of windows read after being advised to GDAL.
+ * The counters are cumulative since start.  The consumer wait
+ * belongs to no reader thread and is only reported in the totals.
+ *
+ * @param ctx The context (from start)
+ * @param thread The reader thread whose counters are wanted (or -1 for the totals over all of them)
+ * @param stats The return-location for the counters (an array of 8 uint64_t)
+ */
+void get_stats(struct context *ctx, int thread, uint64_t *stats)
+{
+    telemetry_collect(ctx, thread, stats);
+}
+
+/**
+ * Get the per-class counters of class-frequency sampling: the label
+ * words of each class in the windows read, and in the windows
+ * accepted.  The ratio of the two is the acceptance rate of each
+ * class, and the accepted counts show how closely the targets are
+ * being met.  The counters are cumulative since start.
+ *
+ * @param ctx The context (from start)
+ * @param seen The return-location for the counts in windows read (an array of class_count uint64_t, or NULL)
+ * @param accepted The return-location for the counts in windows accepted (an array of class_count uint64_t, or NULL)
+ * @return The number of classes (0 if class-frequency sampling is off)
  */
-int get_height(int index)
+int get_class_stats(struct context *ctx, uint64_t *seen, uint64_t *accepted)
 {
-    return heights[index];
+    classes_collect(ctx, seen, accepted);
+    return ctx->class_count;
+}
+
+/**
+ * Get the per-pair counters: the number of times each pair was drawn,
+ * and the number of windows from each pair handed to the consumers.
+ * The counters are cumulative since start.
+ *
+ * @param ctx The context (from start)
+ * @param drawn The return-location for the draws of each pair (an array of L uint64_t, or NULL)
+ * @param delivered The return-location for the windows delivered from each pair (an array of L uint64_t, or NULL)
+ */
+void get_pair_stats(struct context *ctx, uint64_t *drawn, uint64_t *delivered)
+{
+    for (int pair = 0; pair < ctx->L; ++pair)
+    {
+        if (drawn != NULL)
+        {
+            drawn[pair] = __atomic_load_n(&ctx->pair_draws[pair], __ATOMIC_RELAXED);
+        }
+        if (delivered != NULL)
+        {
+            delivered[pair] = __atomic_load_n(&ctx->pair_deliveries[pair], __ATOMIC_RELAXED);
+        }
+    }
+}
+
+/**
+ * Get the effective value of a GDAL configuration option, as the
+ * threads of the context see it (GDAL_CACHEMAX in bytes).
+ *
+ * @param ctx The context (from start)
+ * @param key The name of the option
+ * @param value The return-location for the value (empty if the option is unset)
+ * @param size The size of the return-location (in bytes)
+ * @return 1 if the option is set, otherwise 0
+ */
+int get_config_option(struct context *ctx, const char *key, char *value, int size)
+{
+    return config_effective(ctx, key, value, size);
 }
 
 /**
@@ -146,289 +241,611 @@ void get_statistics(const char *imagery_filename,
  * Get an (inference) chip.  This can be used only if operation_mode 3 (inference)
  * is active.
  *
+ * @param ctx The context (from start)
  * @param imagery_buffer The return-pointer for the imagery data
- * @param x The x-offset for the window (in pixels)
- * @param y The y-offset for the window (in pixels)
+ * @param x The x-offset for the window (in pixels, need not be a multiple of the window size)
+ * @param y The y-offset for the window (in pixels, need not be a multiple of the window size)
  * @param attempts The maximum number of attempts to make to read the window
  * @return 1 for success, 0 for failure
  */
-int get_inference_chip(void *imagery_buffer,
+int get_inference_chip(struct context *ctx, void *imagery_buffer,
                        int x, int y,
                        int attempts)
 {
-    int id = 0;
-    int x_windows = x / window_size_imagery;
-    int y_windows = y / window_size_imagery;
+    int pair = 0;
 
-    if ((operation_mode != inference) || EMPTY_WINDOW)
+    if (ctx->operation_mode != inference)
     {
-        uint64_t num_bytes = word_size(imagery_data_type) * band_count * window_size_imagery * window_size_imagery;
+        uint64_t num_bytes = word_size(ctx->imagery_data_type) * ctx->band_count * ctx->imagery_output_size * ctx->imagery_output_size;
         memset(imagery_buffer, 0, num_bytes);
         return 0;
     }
 
-    for (int i = 0; i < attempts; ++i)
-    {
-        CPLErr err = CE_None;
-
-        // Read imagery
-        err = GDALDatasetRasterIO(imagery_datasets[id], 0,
-                                  x_windows * window_size_imagery,
-                                  y_windows * window_size_imagery,
-                                  window_size_imagery, window_size_imagery,
-                                  imagery_buffer,
-                                  window_size_imagery, window_size_imagery,
-                                  imagery_data_type, band_count, bands,
-                                  0, 0, 0);
-        if (err != CE_None)
-        {
-            continue;
-        }
-        else
-        {
-            break;
-        }
-    }
+    return plan_read(ctx, ctx->imagery_datasets[pair], ctx->imagery_first_bands[pair],
+                     x, y, imagery_buffer, attempts);
+}
 
-    return 1;
+/**
+ * Hand the full plan of inference windows to the library, which then
+ * reads them ahead of the caller using its N threads and M slots.
+ * This can be used only if operation_mode 3 (inference) is active,
+ * and only once per context.
+ *
+ * @param ctx The context (from start)
+ * @param count The number of windows in the plan
+ * @param xs The x-offsets of the windows (in pixels, need not be multiples of the window size)
+ * @param ys The y-offsets of the windows (in pixels, need not be multiples of the window size)
+ * @param attempts The maximum number of attempts to make to read each window
+ * @return 1 for success, 0 for failure
+ */
+int start_inference_plan(struct context *ctx, int count, const int *xs, const int *ys, int attempts)
+{
+    return plan_start(ctx, count, xs, ys, attempts);
 }
 
 /**
- * Recenter
+ * Get the next chip of the inference plan, in plan order.
+ *
+ * @param ctx The context (from start)
+ * @param imagery_buffer The return-pointer for the imagery data
+ * @return 1 for success, 0 for failure (or an empty window), 2 for a window skipped as cloudy (see cloud_filename_template), -1 once the plan is exhausted
  */
-void recenter(int verbose)
+int get_next_inference_chip(struct context *ctx, void *imagery_buffer)
 {
-    for (int id = 0; id < N; ++id)
+    return plan_next(ctx, imagery_buffer);
+}
+
+/**
+ * Move the center around which each pair is sampled to a random
+ * valid window (from the next band of the pair, if pair quotas are
+ * on) or, for a fraction of the pairs (see _hard_fraction), to one
+ * of the windows of the pair with high reported losses.
+ *
+ * @param ctx The context (from start)
+ * @param verbose Whether to report the new centers
+ */
+void recenter(struct context *ctx, int verbose)
+{
+    struct timespec tp;
+    clock_gettime(CLOCK_REALTIME, &tp);
+
+    for (int pair = 0; pair < ctx->L; ++pair)
     {
-        struct timespec tp;
-        clock_gettime(CLOCK_REALTIME, &tp);
-        int x_windows = -1;
-        int y_windows = -1;
+        int x_windows = 0;
+        int y_windows = 0;
 
-        pthread_mutex_lock(&dataset_mutexes[id]);
-        while (BAD_WINDOW || EMPTY_WINDOW)
+        if (!(ctx->hard_fraction > ((double)rand_r((unsigned int *)&tp.tv_nsec) / RAND_MAX) &&
+              hard_center(ctx, pair, (unsigned int *)&tp.tv_nsec, &x_windows, &y_windows)))
         {
-            x_windows = rand_r((unsigned int *)&tp.tv_nsec) % (widths[id] / window_size_imagery);
-            y_windows = rand_r((unsigned int *)&tp.tv_nsec) % (heights[id] / window_size_imagery);
+            if (ctx->pair_quotas)
+            {
+                choose_stratified_window(ctx, pair, ctx->center_rounds[pair]++, (unsigned int *)&tp.tv_nsec, &x_windows, &y_windows);
+            }
+            else
+            {
+                choose_window(ctx, pair, (unsigned int *)&tp.tv_nsec, &x_windows, &y_windows);
+            }
         }
-        center_xs[id] = x_windows;
-        center_ys[id] = y_windows;
-        pthread_mutex_unlock(&dataset_mutexes[id]);
+        ctx->center_xs[pair] = x_windows;
+        ctx->center_ys[pair] = y_windows;
     }
 
     if (verbose)
     {
         fprintf(stderr, "RECENTERED:");
-        for (int id = 0; id < N; ++id)
+        for (int pair = 0; pair < ctx->L; ++pair)
         {
-            int center_x = center_xs[id] * window_size_imagery;
-            int center_y = center_ys[id] * window_size_imagery;
-            fprintf(stderr, " {id = %d: x = %d y = %d}", id, center_x, center_y);
+            int center_x = ctx->center_xs[pair] * ctx->window_size_imagery;
+            int center_y = ctx->center_ys[pair] * ctx->window_size_imagery;
+            fprintf(stderr, " {pair = %d: x = %d y = %d}", pair, center_x, center_y);
         }
         fprintf(stderr, "\n");
     }
 }
 
 /**
- * Get the next available window.
+ * Copy the next available window, and where it came from, out of
+ * its slot.
  *
+ * @param ctx The context
  * @param imagery_buffer The return-location for the imagery data
- * @param label_buffer The return-location for the label data
+ * @param label_buffer The return-location for the label data (or NULL)
+ * @param origin The return-location for the pair, x offset and y offset of the window (or NULL)
+ * @param milliseconds The maximum time to wait (negative to wait indefinitely)
+ * @return 1 for success, 0 if no window became available in time
  */
-void get_next(void *imagery_buffer, void *label_buffer)
+static int next_window(struct context *ctx, void *imagery_buffer, void *label_buffer, int *origin, int milliseconds)
 {
-    for (;; ++current)
+    int slot = claim_full_slot(ctx, milliseconds);
+
+    if (slot < 0)
     {
-        int slot = current % M;
+        return 0;
+    }
 
-        if (pthread_mutex_trylock(&slot_mutexes[slot]) == 0)
+    uint64_t num_imagery_bytes = word_size(ctx->imagery_data_type) * ctx->band_count * ctx->imagery_output_size * ctx->imagery_output_size;
+    memcpy(imagery_buffer, ctx->imagery_slots[slot], num_imagery_bytes);
+    if (label_buffer != NULL)
+    {
+        uint64_t num_label_bytes = word_size(ctx->label_data_type) * 1 * ctx->window_size_labels * ctx->window_size_labels;
+        memcpy(label_buffer, ctx->label_slots[slot], num_label_bytes);
+    }
+    if (origin != NULL)
+    {
+        memcpy(origin, &ctx->slot_origins[3 * slot], sizeof(int) * 3);
+    }
+    release_slot(ctx, slot);
+
+    return 1;
+}
+
+/**
+ * Get the next available window, waiting at most the given amount of
+ * time for one to become available.
+ *
+ * @param ctx The context (from start)
+ * @param imagery_buffer The return-location for the imagery data
+ * @param label_buffer The return-location for the label data
+ * @param milliseconds The maximum time to wait (negative to wait indefinitely)
+ * @return 1 for success, 0 if no window became available in time
+ */
+int get_next_timeout(struct context *ctx, void *imagery_buffer, void *label_buffer, int milliseconds)
+{
+    return next_window(ctx, imagery_buffer, label_buffer, NULL, milliseconds);
+}
+
+/**
+ * Fill a contiguous (n, band_count, window_size_imagery,
+ * window_size_imagery) imagery buffer and (n, window_size_labels,
+ * window_size_labels) label buffer with the next n available
+ * windows, waiting at most the given amount of time for each one.
+ * The buffers can be anywhere in host memory (including pinned
+ * memory owned by the caller).  The pair, x offset and y offset (in
+ * imagery pixels) of each window are written to origins, so that
+ * per-window losses can be given back with report_losses.
+ *
+ * @param ctx The context (from start)
+ * @param imagery_buffer The return-location for the imagery data
+ * @param label_buffer The return-location for the label data (or NULL)
+ * @param origins The return-location for the (n, 3) origins of the windows (or NULL)
+ * @param n The number of windows to fetch
+ * @param milliseconds The maximum time to wait for each window (negative to wait indefinitely)
+ * @return The number of windows actually written
+ */
+int get_next_batch_timeout(struct context *ctx, void *imagery_buffer, void *label_buffer, int *origins, int n, int milliseconds)
+{
+    uint64_t num_imagery_bytes = word_size(ctx->imagery_data_type) * ctx->band_count * ctx->imagery_output_size * ctx->imagery_output_size;
+    uint64_t num_label_bytes = word_size(ctx->label_data_type) * 1 * ctx->window_size_labels * ctx->window_size_labels;
+    int i;
+
+    for (i = 0; i < n; ++i)
+    {
+        void *label_chip = (label_buffer != NULL) ? (uint8_t *)label_buffer + i * num_label_bytes : NULL;
+        int *origin = (origins != NULL) ? origins + (3 * i) : NULL;
+        if (!next_window(ctx, (uint8_t *)imagery_buffer + i * num_imagery_bytes, label_chip, origin, milliseconds))
         {
-            if (ready[slot] != 1)
-            {
-                pthread_mutex_unlock(&slot_mutexes[slot]);
-                continue;
-            }
-            else if (ready[slot] == 1)
-            {
-                uint64_t num_imagery_bytes = word_size(imagery_data_type) * band_count * window_size_imagery * window_size_imagery;
-                memcpy(imagery_buffer, imagery_slots[slot], num_imagery_bytes);
-                if (label_buffer != NULL)
-                {
-                    uint64_t num_label_bytes = word_size(label_data_type) * 1 * window_size_labels * window_size_labels;
-                    memcpy(label_buffer, label_slots[slot], num_label_bytes);
-                }
-                ready[slot] = 0;
-                pthread_mutex_unlock(&slot_mutexes[slot]);
-                break;
-            }
+            break;
         }
     }
+
+    return i;
+}
+
+/**
+ * Fill contiguous imagery and label buffers with the next n
+ * available windows.
+ *
+ * @param ctx The context (from start)
+ * @param imagery_buffer The return-location for the imagery data
+ * @param label_buffer The return-location for the label data (or NULL)
+ * @param n The number of windows to fetch
+ */
+void get_next_batch(struct context *ctx, void *imagery_buffer, void *label_buffer, int n)
+{
+    get_next_batch_timeout(ctx, imagery_buffer, label_buffer, NULL, n, -1);
+}
+
+/**
+ * Get the next available window.
+ *
+ * @param ctx The context (from start)
+ * @param imagery_buffer The return-location for the imagery data
+ * @param label_buffer The return-location for the label data
+ */
+void get_next(struct context *ctx, void *imagery_buffer, void *label_buffer)
+{
+    get_next_timeout(ctx, imagery_buffer, label_buffer, -1);
+}
+
+/**
+ * Lend the next available window to the caller without copying it,
+ * waiting at most the given amount of time for one to become
+ * available.  The slot holding the window is out of the ring until
+ * it is given back with release_chip, so the caller should release
+ * each window promptly (and before calling stop), or the readers
+ * will run out of slots.
+ *
+ * @param ctx The context (from start)
+ * @param imagery_buffer The return-location for a pointer to the imagery data
+ * @param label_buffer The return-location for a pointer to the label data (or NULL)
+ * @param milliseconds The maximum time to wait (negative to wait indefinitely)
+ * @return The slot to release, or -1 if no window became available in time
+ */
+int lend_next_timeout(struct context *ctx, void **imagery_buffer, void **label_buffer, int milliseconds)
+{
+    int slot = claim_full_slot(ctx, milliseconds);
+
+    if (slot < 0)
+    {
+        return -1;
+    }
+
+    lend_slot(ctx, slot);
+    *imagery_buffer = ctx->imagery_slots[slot];
+    if (label_buffer != NULL)
+    {
+        *label_buffer = ctx->label_slots[slot];
+    }
+
+    return slot;
 }
 
 /**
- * Given imagery and label filenames, start the reader threads.
+ * Return a lent window to the ring.
  *
- * @param _N The number of reader threads to create
+ * @param ctx The context (from start)
+ * @param slot The slot returned by lend_next_timeout
+ */
+void release_chip(struct context *ctx, int slot)
+{
+    if (slot < 0 || slot >= ctx->M)
+    {
+        fprintf(stderr, "NO SUCH SLOT %d\n", slot);
+        return;
+    }
+    if (!return_lent_slot(ctx, slot))
+    {
+        fprintf(stderr, "SLOT %d IS NOT LENT\n", slot);
+    }
+}
+
+/**
+ * Get the origin of a lent window.
+ *
+ * @param ctx The context (from start)
+ * @param slot The slot returned by lend_next_timeout
+ * @param origin The return-location for the pair, x offset and y offset (in imagery pixels) of the window
+ */
+void get_chip_origin(struct context *ctx, int slot, int *origin)
+{
+    if (slot < 0 || slot >= ctx->M)
+    {
+        fprintf(stderr, "NO SUCH SLOT %d\n", slot);
+        return;
+    }
+    memcpy(origin, &ctx->slot_origins[3 * slot], sizeof(int) * 3);
+}
+
+/**
+ * Report the losses of windows that the model has trained on.  The
+ * windows with the highest losses are remembered, and a fraction of
+ * later draws (and recenterings) revisit them (see _hard_fraction).
+ *
+ * @param ctx The context (from start)
+ * @param n The number of windows
+ * @param origins The (n, 3) origins of the windows (from get_next_batch_timeout)
+ * @param losses The loss of each window
+ */
+void report_losses(struct context *ctx, int n, const int *origins, const float *losses)
+{
+    hard_report(ctx, n, origins, losses);
+}
+
+/**
+ * Export every whole, non-empty window of every pair into a chip
+ * store that can later be passed to start.  The current
+ * configuration (bands, data types, window sizes) is used and N
+ * threads do the reading, so the library should be started in
+ * stopped mode (operation mode 0) first.
+ *
+ * @param ctx The context (from start)
+ * @param store_filename The filename of the store (the index is written next to it)
+ * @return 1 for success, 0 for failure
+ */
+int export_chips(struct context *ctx, const char *store_filename)
+{
+    if (ctx->operation_mode != stopped)
+    {
+        return 0;
+    }
+    return store_export(ctx, store_filename);
+}
+
+/**
+ * Check whether a chip store exists and was exported with the
+ * current configuration (bands, data types, window sizes) from the
+ * current imagery and labels, so that it can be used without being
+ * exported again.
+ *
+ * @param ctx The context (from start)
+ * @param store_filename The filename of the store
+ * @return 1 if the store matches, otherwise 0
+ */
+int check_chips(struct context *ctx, const char *store_filename)
+{
+    return store_matches(ctx, store_filename);
+}
+
+/**
+ * Compute the exact per-band mean and standard deviation of the
+ * imagery over every whole, non-empty window of every pair (NaNs and
+ * the imagery nodata value are ignored).  N threads do the reading,
+ * so the library should be started in stopped mode (operation mode
+ * 0) first.
+ *
+ * @param ctx The context (from start)
+ * @param mus The return-location for the per-band means
+ * @param sigmas The return-location for the per-band standard deviations
+ * @return 1 for success, 0 for failure
+ */
+int compute_statistics(struct context *ctx, double *mus, double *sigmas)
+{
+    if (ctx->operation_mode != stopped)
+    {
+        return 0;
+    }
+    return statistics_compute(ctx, mus, sigmas);
+}
+
+/**
+ * Given imagery and label filenames, start the reader threads.  Each
+ * call creates an independent context (with its own reader threads
+ * and slots), so several samplers can run at once.
+ *
+ * @param _N The number of reader threads to create (any reader can read any pair)
  * @param _M The number of slots
  * @param _L The number of imagery, label pairs
- * @param imagery_filename_template The filename template for the imagery
- * @param label_filename_template The filename template for the labels
- * @param mus Return-location for the (approximate) means of the bands
- * @param sigmas return-location for the (approximate) standard deviations of the bands
+ * @param imagery_filename_template The filename template for the imagery (%d is replaced with the pair index)
+ * @param label_filename_template The filename template for the labels (or NULL)
+ * @param _imagery_data_type The type in which imagery is delivered (GDT_Unknown for the native type of the rasters)
+ * @param _label_data_type The type in which labels are delivered (GDT_Unknown for the native type, widened if remapped labels do not fit)
+ * @param mus The per-band means with which imagery is normalized (or NULL for no normalization)
+ * @param sigmas The per-band standard deviations with which imagery is normalized (or NULL)
  * @param _radius The approximate radius (in pixels) of the typical component of the image
  * @param _operation_mode 1 for training mode, 2 for evaluation mode, 3 for inference mode
  * @param _window_size_imagery The desired window size for imagery
  * @param _window_size_labels The desired window size for labels
  * @param _band_count The number of bands
  * @param _bands An array of integers containing the desired bands
+ * @param _forbidden_imagery_value Pointer to an imagery value that disqualifies a window (or NULL)
+ * @param _forbidden_label_value Pointer to a label value that disqualifies a window (or NULL)
+ * @param _desired_label_value Pointer to a label value that windows should contain (or NULL)
+ * @param _reroll The probability of rejecting a window without the desired label value
+ * @param _label_lut Lookup table applied to labels after they are read (or NULL)
+ * @param _label_lut_size The number of entries in the lookup table
+ * @param _label_nd The label used for values not covered by the lookup table
+ * @param cache_bytes The memory budget (in bytes) for cached decoded blocks (0 to disable)
+ * @param disk_cache_directory A directory in which to keep decoded blocks across runs (or NULL)
+ * @param disk_cache_bytes The disk budget (in bytes) for cached decoded blocks (0 to disable)
+ * @param store_filename A chip store from which to serve windows instead of reading the rasters (or NULL)
+ * @param _imagery_nd Pointer to the imagery nodata value, which is neither normalized nor counted in statistics (or NULL)
+ * @param _augmentations Random flips (1) and/or quarter turns (2) to apply to each window (0 for none)
+ * @param _lookahead The number of windows each reader chooses in advance and advises GDAL of (0 for none)
+ * @param _class_frequencies The target fraction of label words of each (remapped) class, towards which readers steer by rejecting windows (or NULL)
+ * @param _class_count The number of class frequencies
+ * @param _hard_fraction The fraction of window draws and recenterings guided by the losses given to report_losses (0 for none)
+ * @param _region_windows The width (and height), in windows, of the regions that readers read at once and slice windows out of (1 or less to read windows one at a time)
+ * @param _pair_quotas Whether to draw pairs by quota (in proportion to their valid windows over any stretch of draws) and sweep their centers over them, rather than at random
+ * @param _imagery_output_size The width (and height) to which imagery windows are reduced as they are read, averaging (and using overviews where available) (0 or less for the full window size)
+ * @param gdal_config A NULL-terminated array of KEY=VALUE GDAL configuration options with which the threads of the context read, e.g. GDAL_NUM_THREADS or VSI_CACHE_SIZE (GDAL_CACHEMAX resizes the process-wide block cache) (or NULL)
+ * @param cloud_filename_template The filename template for per-pair cloud rasters, e.g. s2cloudless probabilities or 0/1 cloud masks covering the same extent as the imagery at any resolution (or NULL)
+ * @param _cloud_threshold The mean value of a cloud raster over a window above which the window is skipped before its imagery is read (by reader threads and by the inference plan)
+ * @return The context, which must be passed to every other call and finally to stop
  */
-void start(int _N,
-           int _M,
-           int _L,
-           const char *imagery_filename_template,
-           const char *label_filename_template,
-           GDALDataType _imagery_data_type, GDALDataType _label_data_type,
-           double *mus, double *sigmas,
-           int _radius,
-           int _operation_mode,
-           int _window_size_imagery,
-           int _window_size_labels,
-           int _band_count, int *_bands)
+struct context *start(int _N,
+                      int _M,
+                      int _L,
+                      const char *imagery_filename_template,
+                      const char *label_filename_template,
+                      GDALDataType _imagery_data_type, GDALDataType _label_data_type,
+                      double *mus, double *sigmas,
+                      int _radius,
+                      int _operation_mode,
+                      int _window_size_imagery,
+                      int _window_size_labels,
+                      int _band_count, int *_bands,
+                      double *_forbidden_imagery_value,
+                      int *_forbidden_label_value,
+                      int *_desired_label_value,
+                      double _reroll,
+                      int *_label_lut, int _label_lut_size, int _label_nd,
+                      int64_t cache_bytes,
+                      const char *disk_cache_directory, int64_t disk_cache_bytes,
+                      const char *store_filename,
+                      double *_imagery_nd,
+                      int _augmentations,
+                      int _lookahead,
+                      double *_class_frequencies,
+                      int _class_count,
+                      double _hard_fraction,
+                      int _region_windows,
+                      int _pair_quotas,
+                      int _imagery_output_size,
+                      const char **gdal_config,
+                      const char *cloud_filename_template,
+                      double _cloud_threshold)
 {
-    // Set globals
-    N = _N;
-    M = _M;
-    L = _L;
-    imagery_data_type = _imagery_data_type;
-    label_data_type = _label_data_type;
-    operation_mode = _operation_mode;
-    window_size_imagery = _window_size_imagery;
-    window_size_labels = _window_size_labels;
-    band_count = _band_count;
-    bands = (int *)malloc(sizeof(int) * band_count);
-    radius = _radius;
-    memcpy(bands, _bands, sizeof(int) * band_count);
-
-    // Per-thread arrays (except for width and height)
-    imagery_datasets = (GDALDatasetH *)malloc(sizeof(GDALDatasetH) * N);
-    imagery_first_bands = (GDALRasterBandH *)malloc(sizeof(GDALRasterBandH) * N);
-    label_datasets = (GDALDatasetH *)malloc(sizeof(GDALDatasetH) * N);
-    widths = (int *)malloc(sizeof(int) * N);
-    heights = (int *)malloc(sizeof(int) * N);
-    center_xs = (int *)malloc(sizeof(int) * N);
-    center_ys = (int *)malloc(sizeof(int) * N);
+    struct context *ctx = (struct context *)calloc(1, sizeof(struct context));
+
+    // The rasters are opened here with the same options as in the threads
+    config_init(ctx, gdal_config);
+    config_apply(ctx);
+
+    // Set configuration
+    ctx->N = _N;
+    ctx->M = _M;
+    ctx->L = _L;
+    ctx->imagery_data_type = pairs_data_type(imagery_filename_template, _imagery_data_type, GDT_Float32);
+    ctx->label_data_type = pairs_data_type(label_filename_template, _label_data_type, GDT_Int32);
+    ctx->operation_mode = _operation_mode;
+    ctx->window_size_imagery = _window_size_imagery;
+    ctx->window_size_labels = _window_size_labels;
+    ctx->imagery_output_size = _imagery_output_size > 0 ? _imagery_output_size : _window_size_imagery;
+    ctx->band_count = _band_count;
+    ctx->bands = (int *)malloc(sizeof(int) * ctx->band_count);
+    ctx->radius = _radius;
+    memcpy(ctx->bands, _bands, sizeof(int) * ctx->band_count);
+    ctx->forbidden_imagery_check = (_forbidden_imagery_value != NULL);
+    ctx->forbidden_imagery_value = ctx->forbidden_imagery_check ? *_forbidden_imagery_value : 0;
+    ctx->forbidden_label_check = (_forbidden_label_value != NULL);
+    ctx->forbidden_label_value = ctx->forbidden_label_check ? *_forbidden_label_value : 0;
+    ctx->desired_label_check = (_desired_label_value != NULL);
+    ctx->desired_label_value = ctx->desired_label_check ? *_desired_label_value : 0;
+    ctx->reroll = _reroll;
+    if (_label_lut != NULL)
     {
-        char imagery_filename[0xff];
-
-        sprintf(imagery_filename, imagery_filename_template, 0);
-        imagery_datasets[0] = GDALOpen(imagery_filename, GA_ReadOnly);
-        imagery_first_bands[0] = GDALGetRasterBand(imagery_datasets[0], 1);
+        ctx->label_lut_size = _label_lut_size;
+        ctx->label_lut = (int *)malloc(sizeof(int) * ctx->label_lut_size);
+        memcpy(ctx->label_lut, _label_lut, sizeof(int) * ctx->label_lut_size);
     }
-    widths[0] = GDALGetRasterXSize(imagery_datasets[0]);
-    heights[0] = GDALGetRasterYSize(imagery_datasets[0]);
-    threads = (pthread_t *)malloc(sizeof(pthread_t) * N);
-    dataset_mutexes = (pthread_mutex_t *)malloc(sizeof(pthread_mutex_t) * N);
-
-    // Per-slot arrays
-    slot_mutexes = (pthread_mutex_t *)malloc(sizeof(pthread_mutex_t) * M);
-    imagery_slots = malloc(sizeof(void *) * M);
-    label_slots = malloc(sizeof(void *) * M);
-    ready = calloc(M, sizeof(int));
-
-    // Fill arrays
-    for (int64_t i = 0; i < M; ++i)
+    ctx->label_nd = _label_nd;
+    if (_label_data_type == GDT_Unknown && ctx->label_lut != NULL)
     {
-        uint64_t num_imagery_bytes = word_size(imagery_data_type) * band_count * window_size_imagery * window_size_imagery;
-        uint64_t num_label_bytes = word_size(label_data_type) * 1 * window_size_labels * window_size_labels;
-        imagery_slots[i] = malloc(num_imagery_bytes);
-        label_slots[i] = malloc(num_label_bytes);
-        pthread_mutex_init(&slot_mutexes[i], NULL);
+        // Native labels are widened if the remapped ones would not fit
+        for (int i = 0; i < ctx->label_lut_size; ++i)
+        {
+            if (!word_holds(ctx->label_data_type, ctx->label_lut[i]) || !word_holds(ctx->label_data_type, ctx->label_nd))
+            {
+                ctx->label_data_type = GDT_Int32;
+                break;
+            }
+        }
     }
-    for (int i = 0; mus && sigmas && (i < band_count); ++i)
+    ctx->imagery_nd_check = (_imagery_nd != NULL);
+    ctx->imagery_nd = ctx->imagery_nd_check ? *_imagery_nd : 0;
+    ctx->augmentations = _augmentations;
+    ctx->lookahead = _lookahead > 0 ? _lookahead : 0;
+    ctx->region_windows = _region_windows > 1 ? _region_windows : 1;
+    if (ctx->imagery_output_size != ctx->window_size_imagery && ctx->region_windows > 1)
     {
-        GDALRasterBandH band = GDALGetRasterBand(imagery_datasets[0], bands[i]);
-        GDALGetRasterStatistics(band, 1, 1, NULL, NULL, mus + i, sigmas + i);
+        fprintf(stderr, "REGION READS ARE NOT REDUCED, READING WINDOWS ONE AT A TIME\n");
+        ctx->region_windows = 1;
     }
-    for (int64_t i = 0; i < N; ++i)
+    ctx->pair_quotas = _pair_quotas;
+    if (mus != NULL && sigmas != NULL)
     {
-        char imagery_or_label_filename[0xff];
-
-        pthread_mutex_init(&dataset_mutexes[i], NULL);
-        if (i != 0)
+        if (ctx->imagery_data_type == GDT_Float32 || ctx->imagery_data_type == GDT_Float64)
         {
-            sprintf(imagery_or_label_filename, imagery_filename_template, i % L);
-            imagery_datasets[i] = GDALOpen(imagery_or_label_filename, GA_ReadOnly);
-            imagery_first_bands[i] = GDALGetRasterBand(imagery_datasets[i], 1);
-            widths[i] = GDALGetRasterXSize(imagery_datasets[i]);
-            heights[i] = GDALGetRasterYSize(imagery_datasets[i]);
+            ctx->normalization_mus = (double *)malloc(sizeof(double) * ctx->band_count);
+            ctx->normalization_sigmas = (double *)malloc(sizeof(double) * ctx->band_count);
+            memcpy(ctx->normalization_mus, mus, sizeof(double) * ctx->band_count);
+            memcpy(ctx->normalization_sigmas, sigmas, sizeof(double) * ctx->band_count);
         }
-        if (label_filename_template != NULL)
+        else
+        {
+            fprintf(stderr, "NORMALIZATION REQUIRES FLOATING-POINT IMAGERY\n");
+        }
+    }
+
+    // Per-pair arrays
+    clouds_init(ctx, cloud_filename_template, _cloud_threshold);
+    pairs_init(ctx, imagery_filename_template, label_filename_template);
+    vectors_init(ctx);
+    ctx->threads = NULL;
+    ctx->thread_args = (struct thread_arg *)malloc(sizeof(struct thread_arg) * ctx->N);
+    for (int i = 0; i < ctx->N; ++i)
+    {
+        ctx->thread_args[i].ctx = ctx;
+        ctx->thread_args[i].id = i;
+    }
+    pthread_mutex_init(&ctx->work_mutex, NULL);
+    ctx->store_fd = -1;
+    windows_init(ctx);
+    cache_init(ctx, cache_bytes, disk_cache_directory, disk_cache_bytes);
+    telemetry_init(ctx);
+    classes_init(ctx, _class_frequencies, _class_count);
+    hard_init(ctx, _hard_fraction);
+    if (store_filename != NULL && RUNNING)
+    {
+        if (ctx->imagery_output_size == ctx->window_size_imagery)
         {
-            sprintf(imagery_or_label_filename, label_filename_template, i % L);
-            label_datasets[i] = GDALOpen(imagery_or_label_filename, GA_ReadOnly);
+            store_open(ctx, store_filename);
         }
         else
         {
-            label_datasets[i] = NULL;
+            fprintf(stderr, "CHIP STORES HOLD FULL-SIZE WINDOWS, READING THE RASTERS INSTEAD\n");
         }
     }
 
-    // Start threads
-    recenter(0);
-    for (int64_t i = 0; i < N; ++i)
+    // Per-slot arrays
+    ctx->imagery_slots = malloc(sizeof(void *) * ctx->M);
+    ctx->label_slots = malloc(sizeof(void *) * ctx->M);
+    slots_init(ctx);
+
+    // Fill arrays
+    for (int64_t i = 0; i < ctx->M; ++i)
     {
-        pthread_create(&threads[i], NULL, reader, (void *)i);
+        uint64_t num_imagery_bytes = word_size(ctx->imagery_data_type) * ctx->band_count * ctx->imagery_output_size * ctx->imagery_output_size;
+        uint64_t num_label_bytes = word_size(ctx->label_data_type) * 1 * ctx->window_size_labels * ctx->window_size_labels;
+        ctx->imagery_slots[i] = malloc(num_imagery_bytes);
+        ctx->label_slots[i] = malloc(num_label_bytes);
     }
 
-    return;
+    // Start threads (only training and evaluation have readers;
+    // bulk jobs and inference plans start their own threads)
+    recenter(ctx, 0);
+    if (RUNNING)
+    {
+        ctx->threads = (pthread_t *)malloc(sizeof(pthread_t) * ctx->N);
+        for (int i = 0; i < ctx->N; ++i)
+        {
+            pthread_create(&ctx->threads[i], NULL, reader, &ctx->thread_args[i]);
+        }
+    }
+
+    config_clear(ctx);
+    return ctx;
 }
 
 /**
- * Stop the reader threads.
+ * Stop the reader threads and release the context.
+ *
+ * @param ctx The context (from start)
  */
-void stop()
+void stop(struct context *ctx)
 {
-    operation_mode = stopped;
-    for (int i = 0; i < N; ++i)
+    ctx->operation_mode = stopped;
+    slots_wake(ctx);
+    plan_stop(ctx);
+    for (int i = 0; ctx->threads != NULL && i < ctx->N; ++i)
     {
-        pthread_join(threads[i], NULL);
-        GDALClose(imagery_datasets[i]);
-        if (label_datasets[i] != NULL)
-        {
-            GDALClose(label_datasets[i]);
-        }
+        pthread_join(ctx->threads[i], NULL);
     }
-    for (int i = 0; i < M; ++i)
+    store_close(ctx);
+    telemetry_deinit(ctx);
+    classes_deinit(ctx);
+    hard_deinit(ctx);
+    cache_deinit(ctx);
+    windows_deinit(ctx);
+    vectors_deinit(ctx);
+    pairs_deinit(ctx);
+    clouds_deinit(ctx);
+    config_deinit(ctx);
+    for (int i = 0; i < ctx->M; ++i)
     {
-        free(imagery_slots[i]);
-        free(label_slots[i]);
-        ready[i] = 0;
+        free(ctx->imagery_slots[i]);
+        free(ctx->label_slots[i]);
     }
-
-    free(bands);
-    free(threads);
-    free(slot_mutexes);
-    free(dataset_mutexes);
-    free(imagery_datasets);
-    free(imagery_first_bands);
-    free(label_datasets);
-    free(imagery_slots);
-    free(label_slots);
-    free(ready);
-    free(widths);
-    free(heights);
-    free(center_xs);
-    free(center_ys);
-
-    N = M = L = 0;
-    bands = NULL;
-    threads = NULL;
-    slot_mutexes = NULL;
-    dataset_mutexes = NULL;
-    imagery_datasets = NULL;
-    imagery_first_bands = NULL;
-    label_datasets = NULL;
-    imagery_slots = NULL;
-    label_slots = NULL;
-    ready = NULL;
+    slots_deinit(ctx);
+
+    free(ctx->bands);
+    free(ctx->normalization_mus);
+    free(ctx->normalization_sigmas);
+    free(ctx->label_lut);
+    free(ctx->threads);
+    free(ctx->thread_args);
+    free(ctx->imagery_slots);
+    free(ctx->label_slots);
+    pthread_mutex_destroy(&ctx->work_mutex);
+    free(ctx);
 }
@@ -29,13 +29,31 @@
 #ifndef __CHIPS_H__
 #define __CHIPS_H__
 
+#include <stdint.h>
+
+struct context;
+
 void init();
 
 void deinit();
 
-int get_width();
+int get_width(struct context *ctx, int index);
+
+int get_height(struct context *ctx, int index);
+
+void get_data_types(struct context *ctx, int *imagery_data_type, int *label_data_type);
+
+void get_cache_stats(struct context *ctx, uint64_t *hits, uint64_t *misses, uint64_t *bytes);
+
+void get_disk_cache_stats(struct context *ctx, uint64_t *hits, uint64_t *misses, uint64_t *bytes);
 
-int get_height();
+void get_stats(struct context *ctx, int thread, uint64_t *stats);
+
+int get_class_stats(struct context *ctx, uint64_t *seen, uint64_t *accepted);
+
+void get_pair_stats(struct context *ctx, uint64_t *drawn, uint64_t *delivered);
+
+int get_config_option(struct context *ctx, const char *key, char *value, int size);
 
 void get_statistics(const char *imagery_filename,
                     int band_count,
@@ -43,26 +61,70 @@ void get_statistics(const char *imagery_filename,
                     double *mus,
                     double *sigmas);
 
-int get_inference_chip(void *imagery_buffer,
+int get_inference_chip(struct context *ctx, void *imagery_buffer,
                        int x, int y,
                        int attempts);
 
-void recenter(int verbose);
+int start_inference_plan(struct context *ctx, int count, const int *xs, const int *ys, int attempts);
+
+int get_next_inference_chip(struct context *ctx, void *imagery_buffer);
+
+void recenter(struct context *ctx, int verbose);
+
+int get_next_timeout(struct context *ctx, void *imagery_buffer, void *label_buffer, int milliseconds);
+
+void get_next(struct context *ctx, void *imagery_buffer, void *label_buffer);
+
+int get_next_batch_timeout(struct context *ctx, void *imagery_buffer, void *label_buffer, int *origins, int n, int milliseconds);
+
+void get_next_batch(struct context *ctx, void *imagery_buffer, void *label_buffer, int n);
+
+int lend_next_timeout(struct context *ctx, void **imagery_buffer, void **label_buffer, int milliseconds);
+
+void release_chip(struct context *ctx, int slot);
+
+void get_chip_origin(struct context *ctx, int slot, int *origin);
+
+void report_losses(struct context *ctx, int n, const int *origins, const float *losses);
+
+struct context *start(int _N,
+                      int _M,
+                      int _L,
+                      const char *imagery_filename, const char *label_filename,
+                      int _imagery_data_type, int _label_data_type,
+                      double *mus, double *sigmas,
+                      int _radius,
+                      int _operation_mode,
+                      int _window_size_imagery,
+                      int _window_size_labels,
+                      int _band_count, int *_bands,
+                      double *_forbidden_imagery_value,
+                      int *_forbidden_label_value,
+                      int *_desired_label_value,
+                      double _reroll,
+                      int *_label_lut, int _label_lut_size, int _label_nd,
+                      int64_t cache_bytes,
+                      const char *disk_cache_directory, int64_t disk_cache_bytes,
+                      const char *store_filename,
+                      double *_imagery_nd,
+                      int _augmentations,
+                      int _lookahead,
+                      double *_class_frequencies,
+                      int _class_count,
+                      double _hard_fraction,
+                      int _region_windows,
+                      int _pair_quotas,
+                      int _imagery_output_size,
+                      const char **gdal_config,
+                      const char *cloud_filename_template,
+                      double _cloud_threshold);
+
+int export_chips(struct context *ctx, const char *store_filename);
 
-void get_next(void *imagery_buffer, void *label_buffer);
+int check_chips(struct context *ctx, const char *store_filename);
 
-void start(int _N,
-           int _M,
-           int _L,
-           const char *imagery_filename, const char *label_filename,
-           int _imagery_data_type, int _label_data_type,
-           double *mus, double *sigmas,
-           int _radius,
-           int _operation_mode,
-           int _window_size_imagery,
-           int _window_size_labels,
-           int _band_count, int *_bands);
+int compute_statistics(struct context *ctx, double *mus, double *sigmas);
 
-void stop();
+void stop(struct context *ctx);
 
 #endif
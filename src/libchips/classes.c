@@ -0,0 +1,185 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+
+#include "context.h"
+#include "classes.h"
+
+/**
+ * Set up class-frequency sampling.  The targets are the fractions of
+ * accepted label words that should belong to each class; they are
+ * normalized to sum to one.
+ *
+ * @param ctx The context
+ * @param targets The target frequency of each class (or NULL to accept windows regardless of their classes)
+ * @param class_count The number of classes
+ */
+void classes_init(struct context *ctx, const double *targets, int class_count)
+{
+    double sum = 0;
+
+    ctx->class_count = 0;
+    if (targets == NULL || class_count <= 0)
+    {
+        return;
+    }
+    for (int i = 0; i < class_count; ++i)
+    {
+        sum += (targets[i] > 0) ? targets[i] : 0;
+    }
+    if (!(sum > 0))
+    {
+        fprintf(stderr, "CLASS FREQUENCIES MUST NOT ALL BE ZERO\n");
+        return;
+    }
+
+    ctx->class_count = class_count;
+    ctx->class_targets = (double *)malloc(sizeof(double) * class_count);
+    ctx->class_seen = (uint64_t *)calloc(class_count, sizeof(uint64_t));
+    ctx->class_accepted = (uint64_t *)calloc(class_count, sizeof(uint64_t));
+    for (int i = 0; i < class_count; ++i)
+    {
+        ctx->class_targets[i] = ((targets[i] > 0) ? targets[i] : 0) / sum;
+    }
+}
+
+/**
+ * Release the class-frequency tables.
+ *
+ * @param ctx The context
+ */
+void classes_deinit(struct context *ctx)
+{
+    free(ctx->class_targets);
+    free(ctx->class_seen);
+    free(ctx->class_accepted);
+    ctx->class_targets = NULL;
+    ctx->class_seen = NULL;
+    ctx->class_accepted = NULL;
+    ctx->class_count = 0;
+}
+
+/**
+ * Decide whether to keep a window, given the classes of its labels.
+ *
+ * This is rejection sampling from the natural class distribution
+ * (estimated from every window read so far) towards the target one.
+ * Each class is weighted by the ratio of its target frequency to its
+ * natural frequency, and a window is accepted with probability equal
+ * to the mean weight of its label words over the largest weight.
+ * Windows made of under-represented classes are therefore always
+ * kept, and those made of over-represented ones are thinned out.
+ *
+ * @param ctx The context
+ * @param histogram The class histogram of the window's labels (from buffer_histogram)
+ * @param state The state of the calling thread's random number generator
+ * @return 1 if the window should be kept, 0 if it should be rejected
+ */
+int classes_accept(struct context *ctx, const uint64_t *histogram, unsigned int *state)
+{
+    double total = 0;
+    double words = 0;
+    double weighted = 0;
+    double max_weight = 0;
+
+    for (int i = 0; i < ctx->class_count; ++i)
+    {
+        if (histogram[i] > 0)
+        {
+            __atomic_fetch_add(&ctx->class_seen[i], histogram[i], __ATOMIC_RELAXED);
+        }
+        total += (double)__atomic_load_n(&ctx->class_seen[i], __ATOMIC_RELAXED);
+    }
+
+    for (int i = 0; i < ctx->class_count; ++i)
+    {
+        uint64_t seen = __atomic_load_n(&ctx->class_seen[i], __ATOMIC_RELAXED);
+        double weight;
+
+        if (seen == 0)
+        {
+            continue;
+        }
+        weight = ctx->class_targets[i] * total / seen;
+        if (weight > max_weight)
+        {
+            max_weight = weight;
+        }
+        words += histogram[i];
+        weighted += histogram[i] * weight;
+    }
+
+    // Windows without any labelled words carry no class information
+    if (!(words > 0) || !(max_weight > 0))
+    {
+        return 1;
+    }
+    return (weighted / (words * max_weight)) > ((double)rand_r(state) / RAND_MAX);
+}
+
+/**
+ * Count the classes of a window that has been accepted.
+ *
+ * @param ctx The context
+ * @param histogram The class histogram of the window's labels
+ */
+void classes_record(struct context *ctx, const uint64_t *histogram)
+{
+    for (int i = 0; i < ctx->class_count; ++i)
+    {
+        if (histogram[i] > 0)
+        {
+            __atomic_fetch_add(&ctx->class_accepted[i], histogram[i], __ATOMIC_RELAXED);
+        }
+    }
+}
+
+/**
+ * Read the per-class counters.
+ *
+ * @param ctx The context
+ * @param seen The return-location for the label words of each class in windows read (or NULL)
+ * @param accepted The return-location for the label words of each class in windows accepted (or NULL)
+ */
+void classes_collect(struct context *ctx, uint64_t *seen, uint64_t *accepted)
+{
+    for (int i = 0; i < ctx->class_count; ++i)
+    {
+        if (seen != NULL)
+        {
+            seen[i] = __atomic_load_n(&ctx->class_seen[i], __ATOMIC_RELAXED);
+        }
+        if (accepted != NULL)
+        {
+            accepted[i] = __atomic_load_n(&ctx->class_accepted[i], __ATOMIC_RELAXED);
+        }
+    }
+}
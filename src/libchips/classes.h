@@ -26,41 +26,21 @@
  * OTHER DEALINGS IN THE SOFTWARE.
  */
 
+#ifndef __CLASSES_H__
+#define __CLASSES_H__
+
 #include <stdint.h>
 
-#include <pthread.h>
+struct context;
+
+void classes_init(struct context *ctx, const double *targets, int class_count);
 
-#include <gdal.h>
+void classes_deinit(struct context *ctx);
 
-#include "globals.h"
+int classes_accept(struct context *ctx, const uint64_t *histogram, unsigned int *state);
 
-// Global variables
-int N = 0;
-int M = 0;
-int L = 0;
-GDALDataType imagery_data_type = -1;
-GDALDataType label_data_type = -1;
-int operation_mode = stopped;
-int window_size_imagery = 0;
-int window_size_labels = 0;
-int band_count = 0;
-int *bands = NULL;
-int *widths = NULL;
-int *heights = NULL;
-int radius = 0;
-int *center_xs = NULL;
-int *center_ys = NULL;
-uint64_t current = 0;
+void classes_record(struct context *ctx, const uint64_t *histogram);
 
-// Thread-related variables
-pthread_mutex_t *dataset_mutexes = NULL;
-pthread_t *threads = NULL;
-GDALDatasetH *imagery_datasets = NULL;
-GDALRasterBandH *imagery_first_bands = NULL;
-GDALDatasetH *label_datasets = NULL;
+void classes_collect(struct context *ctx, uint64_t *seen, uint64_t *accepted);
 
-// Slot-related variables
-pthread_mutex_t *slot_mutexes = NULL;
-void **imagery_slots = NULL;
-void **label_slots = NULL;
-int *ready = NULL;
+#endif
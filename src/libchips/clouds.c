@@ -0,0 +1,128 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#include <stdlib.h>
+#include <string.h>
+#include <math.h>
+
+#include <gdal.h>
+
+#include "context.h"
+#include "pairs.h"
+#include "clouds.h"
+
+/**
+ * Remember the per-pair cloud rasters and the threshold above which
+ * their mean over a window makes it cloudy.
+ *
+ * @param ctx The context
+ * @param cloud_filename_template The filename template for the cloud rasters (or NULL)
+ * @param threshold The mean cloud value above which a window is skipped
+ */
+void clouds_init(struct context *ctx, const char *cloud_filename_template, double threshold)
+{
+    ctx->cloud_template = (cloud_filename_template != NULL) ? strdup(cloud_filename_template) : NULL;
+    ctx->cloud_threshold = threshold;
+}
+
+/**
+ * Forget the cloud rasters.  Their handles belong to the readers and
+ * are closed with the other pair handles.
+ *
+ * @param ctx The context
+ */
+void clouds_deinit(struct context *ctx)
+{
+    free(ctx->cloud_template);
+    ctx->cloud_template = NULL;
+}
+
+/**
+ * Whether a window of the imagery is too cloudy to use.  The first
+ * band of the pair's cloud raster (a cloud probability or a 0/1 cloud
+ * mask, at any resolution, covering the same extent as the imagery)
+ * is averaged over the footprint of the window in a single read,
+ * which GDAL can serve from overviews, so no imagery is read or
+ * decoded for a cloudy window.
+ *
+ * @param ctx The context
+ * @param id The id of the calling thread
+ * @param pair The index of the pair
+ * @param x The x-offset of the window (in imagery pixels)
+ * @param y The y-offset of the window (in imagery pixels)
+ * @return 1 if the mean cloud value over the window exceeds the threshold, otherwise 0
+ */
+int clouds_cover(struct context *ctx, int id, int pair, int x, int y)
+{
+    GDALDatasetH imagery_dataset, label_dataset, clouds;
+    GDALRasterBandH first_band;
+    GDALRasterIOExtraArg extra;
+    double x_scale, y_scale;
+    int x0, y0, x1, y1;
+    double mean = 0;
+
+    if (ctx->cloud_template == NULL)
+    {
+        return 0;
+    }
+    reader_handles(ctx, id, pair, &imagery_dataset, &first_band, &label_dataset);
+    if ((clouds = ctx->reader_cloud_datasets[id * ctx->L + pair]) == NULL)
+    {
+        return 0;
+    }
+
+    // The footprint of the window in the cloud raster
+    x_scale = (double)GDALGetRasterXSize(clouds) / ctx->widths[pair];
+    y_scale = (double)GDALGetRasterYSize(clouds) / ctx->heights[pair];
+    INIT_RASTERIO_EXTRA_ARG(extra);
+    extra.eResampleAlg = GRIORA_Average;
+    extra.bFloatingPointWindowValidity = 1;
+    extra.dfXOff = x * x_scale;
+    extra.dfYOff = y * y_scale;
+    extra.dfXSize = ctx->window_size_imagery * x_scale;
+    extra.dfYSize = ctx->window_size_imagery * y_scale;
+    x0 = (int)floor(extra.dfXOff);
+    y0 = (int)floor(extra.dfYOff);
+    x1 = (int)ceil(extra.dfXOff + extra.dfXSize);
+    y1 = (int)ceil(extra.dfYOff + extra.dfYSize);
+    x1 = (x1 < GDALGetRasterXSize(clouds)) ? x1 : GDALGetRasterXSize(clouds);
+    y1 = (y1 < GDALGetRasterYSize(clouds)) ? y1 : GDALGetRasterYSize(clouds);
+    if (x1 <= x0 || y1 <= y0)
+    {
+        return 0;
+    }
+
+    if (GDALRasterIOEx(GDALGetRasterBand(clouds, 1), GF_Read,
+                       x0, y0, x1 - x0, y1 - y0,
+                       &mean, 1, 1, GDT_Float64,
+                       0, 0, &extra) != CE_None)
+    {
+        return 0;
+    }
+    return (mean > ctx->cloud_threshold);
+}
@@ -0,0 +1,214 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+#include <unistd.h>
+
+#include <gdal.h>
+#include <cpl_conv.h>
+
+#include "context.h"
+#include "config.h"
+
+/**
+ * Parse a GDAL_CACHEMAX value the way GDAL does: a percentage of
+ * physical memory, a number of megabytes (below 100000) or a number
+ * of bytes.
+ *
+ * @param value The value
+ * @return The number of bytes, or -1 if the value cannot be parsed
+ */
+static int64_t cache_max_bytes(const char *value)
+{
+    char *end = NULL;
+    double number = strtod(value, &end);
+
+    if (end == value || number < 0)
+    {
+        return -1;
+    }
+    else if (*end == '%')
+    {
+        double physical = (double)sysconf(_SC_PHYS_PAGES) * (double)sysconf(_SC_PAGESIZE);
+        return (int64_t)(physical * number / 100.0);
+    }
+    else if (number < 100000)
+    {
+        return (int64_t)number << 20;
+    }
+    else
+    {
+        return (int64_t)number;
+    }
+}
+
+/**
+ * Keep the GDAL configuration options with which the threads of the
+ * context read.  GDAL_CACHEMAX sizes GDAL's (process-wide) block
+ * cache, so it is applied once, here; the rest are applied to each
+ * thread of the context as it starts.
+ *
+ * @param ctx The context
+ * @param options A NULL-terminated array of KEY=VALUE strings (or NULL)
+ */
+void config_init(struct context *ctx, const char **options)
+{
+    int count = 0;
+
+    while (options != NULL && options[count] != NULL)
+    {
+        count++;
+    }
+    ctx->config_keys = (char **)calloc(count + 1, sizeof(char *));
+    ctx->config_values = (char **)calloc(count + 1, sizeof(char *));
+    ctx->config_count = 0;
+
+    for (int i = 0; i < count; ++i)
+    {
+        const char *equals = strchr(options[i], '=');
+        char *key;
+
+        if (equals == NULL || equals == options[i])
+        {
+            fprintf(stderr, "IGNORING MALFORMED CONFIGURATION OPTION %s\n", options[i]);
+            continue;
+        }
+        key = strndup(options[i], equals - options[i]);
+
+        if (!strcmp(key, "GDAL_CACHEMAX"))
+        {
+            int64_t bytes = cache_max_bytes(equals + 1);
+            if (bytes >= 0)
+            {
+                GDALSetCacheMax64(bytes);
+            }
+            else
+            {
+                fprintf(stderr, "IGNORING BAD GDAL_CACHEMAX %s\n", equals + 1);
+            }
+            free(key);
+            continue;
+        }
+
+        ctx->config_keys[ctx->config_count] = key;
+        ctx->config_values[ctx->config_count] = strdup(equals + 1);
+        ctx->config_count++;
+    }
+}
+
+/**
+ * Free the configuration options.
+ *
+ * @param ctx The context
+ */
+void config_deinit(struct context *ctx)
+{
+    for (int i = 0; i < ctx->config_count; ++i)
+    {
+        free(ctx->config_keys[i]);
+        free(ctx->config_values[i]);
+    }
+    free(ctx->config_keys);
+    free(ctx->config_values);
+    ctx->config_keys = ctx->config_values = NULL;
+    ctx->config_count = 0;
+}
+
+/**
+ * Set the configuration options for the calling thread only, so that
+ * contexts with different options (and the caller's own use of GDAL)
+ * do not disturb one another.
+ *
+ * @param ctx The context
+ */
+void config_apply(struct context *ctx)
+{
+    for (int i = 0; i < ctx->config_count; ++i)
+    {
+        CPLSetThreadLocalConfigOption(ctx->config_keys[i], ctx->config_values[i]);
+    }
+}
+
+/**
+ * Unset the configuration options of the calling thread (for the
+ * caller's thread, after start has opened the rasters).
+ *
+ * @param ctx The context
+ */
+void config_clear(struct context *ctx)
+{
+    for (int i = 0; i < ctx->config_count; ++i)
+    {
+        CPLSetThreadLocalConfigOption(ctx->config_keys[i], NULL);
+    }
+}
+
+/**
+ * Get the value of a configuration option as the threads of the
+ * context see it: the value given to start if there was one,
+ * otherwise the process-wide value (from the environment or
+ * CPLSetConfigOption).  GDAL_CACHEMAX is reported in bytes as GDAL
+ * actually uses it.
+ *
+ * @param ctx The context
+ * @param key The name of the option
+ * @param value The return-location for the value (empty if the option is unset)
+ * @param size The size of the return-location
+ * @return 1 if the option is set, otherwise 0
+ */
+int config_effective(struct context *ctx, const char *key, char *value, int size)
+{
+    const char *found = NULL;
+    char cache_max[0x20];
+
+    if (!strcmp(key, "GDAL_CACHEMAX"))
+    {
+        sprintf(cache_max, "%lld", (long long)GDALGetCacheMax64());
+        found = cache_max;
+    }
+    for (int i = 0; found == NULL && i < ctx->config_count; ++i)
+    {
+        if (!strcmp(key, ctx->config_keys[i]))
+        {
+            found = ctx->config_values[i];
+        }
+    }
+    if (found == NULL)
+    {
+        found = CPLGetConfigOption(key, NULL);
+    }
+
+    if (size > 0)
+    {
+        snprintf(value, size, "%s", found != NULL ? found : "");
+    }
+    return found != NULL;
+}
@@ -0,0 +1,212 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#ifndef __CONTEXT_H__
+#define __CONTEXT_H__
+
+#include <stdint.h>
+#include <pthread.h>
+
+#include <gdal.h>
+
+#include "store.h"
+
+enum op_mode
+{
+    stopped = 0,
+    training = 1,
+    evaluation = 2,
+    inference = 3,
+};
+
+// Geometric augmentations applied by the reader threads (bit flags)
+enum augmentation
+{
+    augment_flips = 1,
+    augment_rotations = 2,
+};
+
+struct context;
+struct vector_labels;
+
+// The argument given to each thread of a context
+struct thread_arg
+{
+    struct context *ctx;
+    uint64_t id;
+};
+
+// Everything belonging to one started instance of the library
+struct context
+{
+    // Configuration
+    int N;
+    int M;
+    int L;
+    GDALDataType imagery_data_type;
+    GDALDataType label_data_type;
+    int operation_mode;
+    int window_size_imagery;
+    int imagery_output_size;
+    int window_size_labels;
+    int band_count;
+    int *bands;
+    int *widths;
+    int *heights;
+    int radius;
+    int *center_xs;
+    int *center_ys;
+    int augmentations;
+    int lookahead;
+    int region_windows;
+
+    // Window-rejection variables
+    int forbidden_imagery_check;
+    double forbidden_imagery_value;
+    int forbidden_label_check;
+    double forbidden_label_value;
+    int desired_label_check;
+    double desired_label_value;
+    double reroll;
+
+    // Class-frequency-sampling variables
+    int class_count;
+    double *class_targets;
+    uint64_t *class_seen;
+    uint64_t *class_accepted;
+
+    // Hard-example-sampling variables
+    double hard_fraction;
+    struct hard_example *hard_examples;
+    int hard_count;
+    pthread_mutex_t hard_mutex;
+
+    // Label-remapping variables
+    int *label_lut;
+    int label_lut_size;
+    int label_nd;
+
+    // Normalization variables
+    double *normalization_mus;
+    double *normalization_sigmas;
+    int imagery_nd_check;
+    double imagery_nd;
+
+    // Pair-related variables
+    char *imagery_template;
+    char *label_template;
+    struct vector_labels *label_vectors;
+    char *cloud_template;
+    double cloud_threshold;
+    GDALDatasetH *imagery_datasets;
+    GDALRasterBandH *imagery_first_bands;
+    uint64_t *pair_weights;
+    int pair_quotas;
+    uint64_t *pair_draws;
+    uint64_t pair_draw_total;
+    uint64_t *pair_deliveries;
+    int *center_rounds;
+    pthread_mutex_t pair_mutex;
+
+    // GDAL configuration variables (applied to each thread)
+    char **config_keys;
+    char **config_values;
+    int config_count;
+
+    // Thread-related variables
+    pthread_t *threads;
+    struct thread_arg *thread_args;
+    GDALDatasetH *reader_imagery_datasets;
+    GDALRasterBandH *reader_imagery_first_bands;
+    GDALDatasetH *reader_label_datasets;
+    GDALDatasetH *reader_cloud_datasets;
+    uint64_t *reader_last_used;
+    uint64_t *reader_generations;
+    uint64_t *reader_ticks;
+    int *reader_open_counts;
+
+    // Work shared out among the threads of bulk (stopped-mode) jobs
+    pthread_mutex_t work_mutex;
+    int64_t work_next;
+    int64_t *work_offsets;
+    double *work_counts;
+    double *work_means;
+    double *work_m2s;
+
+    // Cache-related variables
+    struct block_cache *block_caches;
+    struct block_cache *disk_cache;
+    uint64_t *disk_identities;
+
+    // Window-related variables
+    uint8_t **window_bitmaps;
+    int64_t **valid_windows;
+    int64_t *valid_window_counts;
+
+    // Store-related variables
+    struct store_header store_header;
+    struct store_entry *store_entries;
+    int store_fd;
+    void *store_map;
+    uint64_t store_map_bytes;
+    int64_t *store_records[3];
+    int64_t store_record_counts[3];
+
+    // Telemetry-related variables
+    uint64_t *reader_stats;
+    uint64_t consumer_wait_ns;
+
+    // Inference-plan-related variables
+    int plan_count;
+    int *plan_xs;
+    int *plan_ys;
+    int plan_attempts;
+    int64_t plan_claimed;
+    int64_t plan_consumed;
+    int64_t *plan_filled;
+    int *plan_results;
+    pthread_mutex_t plan_mutex;
+    pthread_cond_t plan_progress;
+    pthread_t *plan_threads;
+
+    // Slot-related variables
+    pthread_mutex_t slot_mutex;
+    pthread_cond_t slot_filled;
+    pthread_cond_t slot_emptied;
+    void **imagery_slots;
+    void **label_slots;
+    int *slot_origins;
+    int *slot_lent;
+    int *empty_slots;
+    int empty_count;
+    int *full_slots;
+    int full_head;
+    int full_count;
+};
+
+#endif
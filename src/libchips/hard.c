@@ -0,0 +1,251 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#include <stdlib.h>
+#include <stdint.h>
+#include <math.h>
+#include <pthread.h>
+
+#include "context.h"
+#include "hard.h"
+#include "macros.h"
+
+/**
+ * Set up the hard-example table.
+ *
+ * @param ctx The context
+ * @param fraction The fraction of draws (and of recenterings) taken from the table
+ */
+void hard_init(struct context *ctx, double fraction)
+{
+    ctx->hard_fraction = fraction > 0 ? (fraction < 1 ? fraction : 1) : 0;
+    ctx->hard_examples = (struct hard_example *)malloc(sizeof(struct hard_example) * MAX_HARD_EXAMPLES);
+    ctx->hard_count = 0;
+    pthread_mutex_init(&ctx->hard_mutex, NULL);
+}
+
+/**
+ * Release the hard-example table.
+ *
+ * @param ctx The context
+ */
+void hard_deinit(struct context *ctx)
+{
+    pthread_mutex_destroy(&ctx->hard_mutex);
+    free(ctx->hard_examples);
+    ctx->hard_examples = NULL;
+    ctx->hard_count = 0;
+}
+
+/**
+ * Swap two entries of the table.
+ */
+static void swap(struct hard_example *examples, int i, int j)
+{
+    struct hard_example tmp = examples[i];
+    examples[i] = examples[j];
+    examples[j] = tmp;
+}
+
+/**
+ * Restore the heap property (the lowest loss at the root) after the
+ * loss of one entry has changed.  Must be called with the table
+ * locked.
+ *
+ * @param ctx The context
+ * @param i The index of the changed entry
+ */
+static void sift(struct context *ctx, int i)
+{
+    struct hard_example *examples = ctx->hard_examples;
+
+    while (i > 0 && examples[i].loss < examples[(i - 1) / 2].loss)
+    {
+        swap(examples, i, (i - 1) / 2);
+        i = (i - 1) / 2;
+    }
+    while (1)
+    {
+        int smallest = i;
+        int left = (2 * i) + 1;
+        int right = (2 * i) + 2;
+
+        if (left < ctx->hard_count && examples[left].loss < examples[smallest].loss)
+        {
+            smallest = left;
+        }
+        if (right < ctx->hard_count && examples[right].loss < examples[smallest].loss)
+        {
+            smallest = right;
+        }
+        if (smallest == i)
+        {
+            break;
+        }
+        swap(examples, i, smallest);
+        i = smallest;
+    }
+}
+
+/**
+ * Record the losses of windows.  The table keeps the
+ * MAX_HARD_EXAMPLES windows with the highest losses, in a heap with
+ * the lowest of them at the root so that it is the one displaced by
+ * a harder window.  A window that is already in the table takes its
+ * latest loss, so windows that the model has learned fall out of it.
+ *
+ * @param ctx The context
+ * @param n The number of windows
+ * @param origins The pair, x offset and y offset (in imagery pixels) of each window
+ * @param losses The loss of each window
+ */
+void hard_report(struct context *ctx, int n, const int *origins, const float *losses)
+{
+    pthread_mutex_lock(&ctx->hard_mutex);
+    for (int k = 0; k < n; ++k)
+    {
+        int pair = origins[(3 * k) + 0];
+        int x_windows = origins[(3 * k) + 1] / ctx->window_size_imagery;
+        int y_windows = origins[(3 * k) + 2] / ctx->window_size_imagery;
+        float loss = losses[k];
+        int i;
+
+        if (pair < 0 || pair >= ctx->L || !isfinite(loss))
+        {
+            continue;
+        }
+        for (i = 0; i < ctx->hard_count; ++i)
+        {
+            struct hard_example *example = &ctx->hard_examples[i];
+            if (example->pair == pair && example->x_windows == x_windows && example->y_windows == y_windows)
+            {
+                break;
+            }
+        }
+        if (i == ctx->hard_count)
+        {
+            if (ctx->hard_count == MAX_HARD_EXAMPLES)
+            {
+                if (loss <= ctx->hard_examples[0].loss)
+                {
+                    continue;
+                }
+                i = 0;
+            }
+            else
+            {
+                ctx->hard_count++;
+            }
+            ctx->hard_examples[i].pair = pair;
+            ctx->hard_examples[i].x_windows = x_windows;
+            ctx->hard_examples[i].y_windows = y_windows;
+        }
+        ctx->hard_examples[i].loss = loss;
+        sift(ctx, i);
+    }
+    pthread_mutex_unlock(&ctx->hard_mutex);
+}
+
+/**
+ * Draw a window from the table, favoring high losses: the hardest of
+ * HARD_EXAMPLE_TOURNAMENT entries drawn uniformly is taken.
+ *
+ * @param ctx The context
+ * @param state The random state of the calling thread
+ * @param pair The return-location for the pair
+ * @param x_windows The return-location for the x offset (in windows)
+ * @param y_windows The return-location for the y offset (in windows)
+ * @return 1 if a window was drawn, 0 if the table is empty
+ */
+int hard_draw(struct context *ctx, unsigned int *state, int *pair, int *x_windows, int *y_windows)
+{
+    int best = -1;
+
+    pthread_mutex_lock(&ctx->hard_mutex);
+    if (ctx->hard_count > 0)
+    {
+        for (int k = 0; k < HARD_EXAMPLE_TOURNAMENT; ++k)
+        {
+            int i = rand_r(state) % ctx->hard_count;
+            if (best < 0 || ctx->hard_examples[i].loss > ctx->hard_examples[best].loss)
+            {
+                best = i;
+            }
+        }
+        *pair = ctx->hard_examples[best].pair;
+        *x_windows = ctx->hard_examples[best].x_windows;
+        *y_windows = ctx->hard_examples[best].y_windows;
+    }
+    pthread_mutex_unlock(&ctx->hard_mutex);
+
+    return (best >= 0);
+}
+
+/**
+ * Choose a center for a pair among its windows in the table, with
+ * probability proportional to their losses.
+ *
+ * @param ctx The context
+ * @param pair The pair
+ * @param state The random state of the calling thread
+ * @param x_windows The return-location for the x offset of the center (in windows)
+ * @param y_windows The return-location for the y offset of the center (in windows)
+ * @return 1 if a center was chosen, 0 if the table holds no (positive-loss) windows of the pair
+ */
+int hard_center(struct context *ctx, int pair, unsigned int *state, int *x_windows, int *y_windows)
+{
+    double total = 0;
+    double r;
+    int chosen = 0;
+
+    pthread_mutex_lock(&ctx->hard_mutex);
+    for (int i = 0; i < ctx->hard_count; ++i)
+    {
+        if (ctx->hard_examples[i].pair == pair && ctx->hard_examples[i].loss > 0)
+        {
+            total += ctx->hard_examples[i].loss;
+        }
+    }
+    r = total * ((double)rand_r(state) / RAND_MAX);
+    for (int i = 0; i < ctx->hard_count && total > 0; ++i)
+    {
+        if (ctx->hard_examples[i].pair == pair && ctx->hard_examples[i].loss > 0)
+        {
+            *x_windows = ctx->hard_examples[i].x_windows;
+            *y_windows = ctx->hard_examples[i].y_windows;
+            chosen = 1;
+            if ((r -= ctx->hard_examples[i].loss) <= 0)
+            {
+                break;
+            }
+        }
+    }
+    pthread_mutex_unlock(&ctx->hard_mutex);
+
+    return chosen;
+}
@@ -0,0 +1,53 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#ifndef __HARD_H__
+#define __HARD_H__
+
+struct context;
+
+// A window remembered for its high loss
+struct hard_example
+{
+    int pair;
+    int x_windows;
+    int y_windows;
+    float loss;
+};
+
+void hard_init(struct context *ctx, double fraction);
+
+void hard_deinit(struct context *ctx);
+
+void hard_report(struct context *ctx, int n, const int *origins, const float *losses);
+
+int hard_draw(struct context *ctx, unsigned int *state, int *pair, int *x_windows, int *y_windows);
+
+int hard_center(struct context *ctx, int pair, unsigned int *state, int *x_windows, int *y_windows);
+
+#endif
@@ -31,32 +31,39 @@
 
 #define unlikely(x) __builtin_expect(!!(x), 0)
 
-#define UNLOCK(index, useconds)                     \
-    {                                               \
-        pthread_mutex_unlock(&slot_mutexes[index]); \
-        usleep(useconds);                           \
-    }
-#define UNLOCK_BREAK(index, useconds) \
-    {                                 \
-        UNLOCK(index, useconds)       \
-        break;                        \
-    }
-#define UNLOCK_CONTINUE(index, useconds) \
-    {                                    \
-        UNLOCK(index, useconds)          \
-        continue;                        \
-    }
-
-#define EMPTY_WINDOW (GDAL_DATA_COVERAGE_STATUS_EMPTY & GDALGetDataCoverageStatus(           \
-                                                            imagery_first_bands[id],         \
-                                                            window_size_imagery * x_windows, \
-                                                            window_size_imagery * y_windows, \
-                                                            window_size_imagery,             \
-                                                            window_size_imagery,             \
+#define RUNNING (ctx->operation_mode == training || ctx->operation_mode == evaluation)
+
+// The maximum number of pairs that one reader holds open at once
+#define MAX_OPEN_PAIRS (64)
+
+// The number of nearby draws a reader makes before choosing any valid window
+#define MAX_WINDOW_DRAWS (64)
+
+// How long (in microseconds) a reader that found nothing to read waits before trying again,
+// doubling with each further fruitless attempt up to MAX_FRUITLESS_READ_BACKOFF_US
+#define FRUITLESS_READ_BACKOFF_US (1000)
+#define MAX_FRUITLESS_READ_BACKOFF_US (128000)
+
+// The number of high-loss windows remembered by the hard-example sampler
+#define MAX_HARD_EXAMPLES (4096)
+
+// The number of remembered windows compared in each hard-example draw
+#define HARD_EXAMPLE_TOURNAMENT (4)
+
+// The attribute of vector label features that holds their label (features without it are labeled 1)
+#define VECTOR_LABEL_FIELD "label"
+
+#define EMPTY_WINDOW (GDAL_DATA_COVERAGE_STATUS_EMPTY & GDALGetDataCoverageStatus(                \
+                                                            first_band,                           \
+                                                            ctx->window_size_imagery * x_windows, \
+                                                            ctx->window_size_imagery * y_windows, \
+                                                            ctx->window_size_imagery,             \
+                                                            ctx->window_size_imagery,             \
                                                             0, NULL))
-#define BAD_WINDOW ((x_windows < 0 || x_windows > ((widths[id] / window_size_imagery) - 1) || \
-                     (y_windows < 0 || y_windows > ((heights[id] / window_size_imagery) - 1))))
+#define BAD_WINDOW ((x_windows < 0 || x_windows > ((ctx->widths[pair] / ctx->window_size_imagery) - 1) || \
+                     (y_windows < 0 || y_windows > ((ctx->heights[pair] / ctx->window_size_imagery) - 1))))
 #define BAD_TRAINING_WINDOW (((x_windows + y_windows) % 7) == 0)
 #define BAD_EVALUATION_WINDOW (((x_windows + y_windows) % 7) != 0)
+#define BAD_SPLIT_WINDOW ((ctx->operation_mode == training) ? BAD_TRAINING_WINDOW : BAD_EVALUATION_WINDOW)
 
 #endif
@@ -53,13 +53,20 @@ int main(int argc, char **argv)
     }
 
     init();
-    start(N, M, L,
-          "/tmp/mul%d.tif", "/tmp/mask%d.tif",
-          6, 5,
-          mus, sigmas,
-          10000,
-          1, window_size, window_size, BAND_COUNT, bands);
-    fprintf(stderr, "%d %d\n", get_width(0), get_height(0));
+    struct context *ctx = start(N, M, L,
+                                "/tmp/mul%d.tif", "/tmp/mask%d.tif",
+                                6, 5,
+                                NULL, NULL,
+                                10000,
+                                1, window_size, window_size, BAND_COUNT, bands,
+                                NULL, NULL, NULL, 0.0,
+                                NULL, 0, 0,
+                                0, NULL, 0,
+                                NULL, NULL,
+                                0, 0,
+                                NULL, 0,
+                                0.0, 1, 0, 0, NULL, NULL, 0.0);
+    fprintf(stderr, "%d %d\n", get_width(ctx, 0), get_height(ctx, 0));
 
     get_statistics("/tmp/mul0.tif", BAND_COUNT, bands, mus, sigmas);
     for (int i = 0; i < BAND_COUNT; ++i)
@@ -70,10 +77,10 @@ int main(int argc, char **argv)
 
     for (int i = 0; i < 1000; ++i)
     {
-        get_next(imagery_buffer, label_buffer);
+        get_next(ctx, imagery_buffer, label_buffer);
         if (i % 100 == 1)
         {
-            recenter(1);
+            recenter(ctx, 1);
         }
 
         if (imagery_buffer[0] != 0.0)
@@ -87,7 +94,7 @@ int main(int argc, char **argv)
     }
     fprintf(stderr, "\n");
 
-    stop();
+    stop(ctx);
     deinit();
 
     free(imagery_buffer);
@@ -0,0 +1,407 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+#include <pthread.h>
+
+#include <gdal.h>
+
+#include "context.h"
+#include "pairs.h"
+#include "macros.h"
+
+/**
+ * Open the imagery (and possibly label) datasets of every pair once
+ * for the main thread, record their sizes, and prepare the (lazily
+ * populated) per-reader handle tables.
+ *
+ * @param ctx The context
+ * @param imagery_filename_template The filename template for the imagery
+ * @param label_filename_template The filename template for the labels (or NULL)
+ */
+void pairs_init(struct context *ctx, const char *imagery_filename_template,
+                const char *label_filename_template)
+{
+    ctx->imagery_template = strdup(imagery_filename_template);
+    ctx->label_template = (label_filename_template != NULL) ? strdup(label_filename_template) : NULL;
+
+    // Per-pair arrays
+    ctx->imagery_datasets = (GDALDatasetH *)malloc(sizeof(GDALDatasetH) * ctx->L);
+    ctx->imagery_first_bands = (GDALRasterBandH *)malloc(sizeof(GDALRasterBandH) * ctx->L);
+    ctx->widths = (int *)malloc(sizeof(int) * ctx->L);
+    ctx->heights = (int *)malloc(sizeof(int) * ctx->L);
+    ctx->center_xs = (int *)malloc(sizeof(int) * ctx->L);
+    ctx->center_ys = (int *)malloc(sizeof(int) * ctx->L);
+    ctx->pair_weights = (uint64_t *)malloc(sizeof(uint64_t) * ctx->L);
+    ctx->pair_draws = (uint64_t *)calloc(ctx->L, sizeof(uint64_t));
+    ctx->pair_draw_total = 0;
+    ctx->pair_deliveries = (uint64_t *)calloc(ctx->L, sizeof(uint64_t));
+    ctx->center_rounds = (int *)calloc(ctx->L, sizeof(int));
+    pthread_mutex_init(&ctx->pair_mutex, NULL);
+    for (int pair = 0; pair < ctx->L; ++pair)
+    {
+        char imagery_filename[0xff];
+
+        sprintf(imagery_filename, ctx->imagery_template, pair);
+        ctx->imagery_datasets[pair] = GDALOpen(imagery_filename, GA_ReadOnly);
+        ctx->imagery_first_bands[pair] = GDALGetRasterBand(ctx->imagery_datasets[pair], 1);
+        ctx->widths[pair] = GDALGetRasterXSize(ctx->imagery_datasets[pair]);
+        ctx->heights[pair] = GDALGetRasterYSize(ctx->imagery_datasets[pair]);
+    }
+    pairs_reweight(ctx);
+
+    // Per-reader, per-pair arrays
+    ctx->reader_imagery_datasets = (GDALDatasetH *)calloc(ctx->N * ctx->L, sizeof(GDALDatasetH));
+    ctx->reader_imagery_first_bands = (GDALRasterBandH *)calloc(ctx->N * ctx->L, sizeof(GDALRasterBandH));
+    ctx->reader_label_datasets = (GDALDatasetH *)calloc(ctx->N * ctx->L, sizeof(GDALDatasetH));
+    ctx->reader_cloud_datasets = (GDALDatasetH *)calloc(ctx->N * ctx->L, sizeof(GDALDatasetH));
+    ctx->reader_last_used = (uint64_t *)calloc(ctx->N * ctx->L, sizeof(uint64_t));
+    ctx->reader_generations = (uint64_t *)calloc(ctx->N * ctx->L, sizeof(uint64_t));
+    ctx->reader_open_counts = (int *)calloc(ctx->N, sizeof(int));
+    ctx->reader_ticks = (uint64_t *)calloc(ctx->N, sizeof(uint64_t));
+}
+
+/**
+ * Resolve a requested data type.  GDT_Unknown asks for the native
+ * type of the first band of the first pair, provided that it is one
+ * of the (real) types that the library handles; otherwise (and for
+ * labels that are vector data) the fallback is used.
+ *
+ * @param filename_template The filename template of the rasters
+ * @param requested The requested data type (or GDT_Unknown)
+ * @param fallback The data type to use if the native one cannot be
+ * @return The data type in which the rasters are to be read
+ */
+GDALDataType pairs_data_type(const char *filename_template, GDALDataType requested, GDALDataType fallback)
+{
+    GDALDataType native = GDT_Unknown;
+    GDALDatasetH dataset;
+    char filename[0xff];
+
+    if (requested != GDT_Unknown || filename_template == NULL)
+    {
+        return requested;
+    }
+
+    sprintf(filename, filename_template, 0);
+    if ((dataset = GDALOpenEx(filename, GDAL_OF_RASTER | GDAL_OF_READONLY, NULL, NULL, NULL)) != NULL)
+    {
+        native = GDALGetRasterDataType(GDALGetRasterBand(dataset, 1));
+        GDALClose(dataset);
+    }
+
+    switch (native)
+    {
+    case GDT_Byte:
+    case GDT_UInt16:
+    case GDT_Int16:
+    case GDT_UInt32:
+    case GDT_Int32:
+    case GDT_Float32:
+    case GDT_Float64:
+        return native;
+    default:
+        return fallback;
+    }
+}
+
+/**
+ * Close all datasets and release the pair tables.
+ *
+ * @param ctx The context
+ */
+void pairs_deinit(struct context *ctx)
+{
+    for (int i = 0; i < ctx->N * ctx->L; ++i)
+    {
+        if (ctx->reader_imagery_datasets[i] != NULL)
+        {
+            GDALClose(ctx->reader_imagery_datasets[i]);
+        }
+        if (ctx->reader_label_datasets[i] != NULL)
+        {
+            GDALClose(ctx->reader_label_datasets[i]);
+        }
+        if (ctx->reader_cloud_datasets[i] != NULL)
+        {
+            GDALClose(ctx->reader_cloud_datasets[i]);
+        }
+    }
+    for (int pair = 0; pair < ctx->L; ++pair)
+    {
+        GDALClose(ctx->imagery_datasets[pair]);
+    }
+
+    free(ctx->imagery_template);
+    free(ctx->label_template);
+    free(ctx->imagery_datasets);
+    free(ctx->imagery_first_bands);
+    free(ctx->widths);
+    free(ctx->heights);
+    free(ctx->center_xs);
+    free(ctx->center_ys);
+    free(ctx->pair_weights);
+    free(ctx->pair_draws);
+    free(ctx->pair_deliveries);
+    free(ctx->center_rounds);
+    pthread_mutex_destroy(&ctx->pair_mutex);
+    free(ctx->reader_imagery_datasets);
+    free(ctx->reader_imagery_first_bands);
+    free(ctx->reader_label_datasets);
+    free(ctx->reader_cloud_datasets);
+    free(ctx->reader_last_used);
+    free(ctx->reader_generations);
+    free(ctx->reader_open_counts);
+    free(ctx->reader_ticks);
+
+    ctx->imagery_template = ctx->label_template = NULL;
+    ctx->imagery_datasets = NULL;
+    ctx->imagery_first_bands = NULL;
+    ctx->widths = ctx->heights = NULL;
+    ctx->center_xs = ctx->center_ys = NULL;
+    ctx->pair_weights = NULL;
+    ctx->pair_draws = ctx->pair_deliveries = NULL;
+    ctx->center_rounds = NULL;
+    ctx->reader_imagery_datasets = NULL;
+    ctx->reader_imagery_first_bands = NULL;
+    ctx->reader_label_datasets = NULL;
+    ctx->reader_cloud_datasets = NULL;
+    ctx->reader_last_used = NULL;
+    ctx->reader_generations = NULL;
+    ctx->reader_open_counts = NULL;
+    ctx->reader_ticks = NULL;
+}
+
+/**
+ * Compute the cumulative sampling weights of the pairs.  Each pair is
+ * weighted by the number of valid windows that it contains (or by
+ * the number of whole windows before those are known).
+ *
+ * @param ctx The context
+ */
+void pairs_reweight(struct context *ctx)
+{
+    uint64_t total = 0;
+
+    for (int pair = 0; pair < ctx->L; ++pair)
+    {
+        if (ctx->valid_window_counts != NULL)
+        {
+            total += ctx->valid_window_counts[pair];
+        }
+        else
+        {
+            total += (uint64_t)(ctx->widths[pair] / ctx->window_size_imagery) * (ctx->heights[pair] / ctx->window_size_imagery);
+        }
+        ctx->pair_weights[pair] = total;
+    }
+}
+
+/**
+ * Choose the pair that is furthest behind its quota.  Each pair's
+ * quota is its share of the total weight times the number of draws
+ * made so far, so every stretch of draws (however short) covers the
+ * pairs in proportion to their weights.  The deficits carry over
+ * from one epoch to the next.
+ *
+ * @param ctx The context
+ * @param total The total weight of the pairs (not 0)
+ * @return The index of the chosen pair
+ */
+static int choose_pair_by_quota(struct context *ctx, uint64_t total)
+{
+    double best_deficit = 0;
+    int best = -1;
+
+    pthread_mutex_lock(&ctx->pair_mutex);
+    for (int pair = 0; pair < ctx->L; ++pair)
+    {
+        uint64_t weight = ctx->pair_weights[pair] - ((pair > 0) ? ctx->pair_weights[pair - 1] : 0);
+        double deficit = ((double)weight / total) * (ctx->pair_draw_total + 1) - ctx->pair_draws[pair];
+
+        if (weight > 0 && (best < 0 || deficit > best_deficit))
+        {
+            best = pair;
+            best_deficit = deficit;
+        }
+    }
+    ctx->pair_draws[best]++;
+    ctx->pair_draw_total++;
+    pthread_mutex_unlock(&ctx->pair_mutex);
+
+    return best;
+}
+
+/**
+ * Choose a pair at random with probability proportional to its
+ * weight, or (if pair quotas are on) by quota.
+ *
+ * @param ctx The context
+ * @param state The random state of the calling thread
+ * @return The index of the chosen pair
+ */
+int choose_pair(struct context *ctx, unsigned int *state)
+{
+    uint64_t total = ctx->pair_weights[ctx->L - 1];
+    uint64_t r;
+    int lo = 0;
+    int hi = ctx->L - 1;
+
+    if (total == 0)
+    {
+        return rand_r(state) % ctx->L;
+    }
+    if (ctx->pair_quotas)
+    {
+        return choose_pair_by_quota(ctx, total);
+    }
+
+    r = (((uint64_t)rand_r(state) << 31) | (uint64_t)rand_r(state)) % total;
+    while (lo < hi)
+    {
+        int mid = (lo + hi) / 2;
+        if (ctx->pair_weights[mid] > r)
+        {
+            hi = mid;
+        }
+        else
+        {
+            lo = mid + 1;
+        }
+    }
+    __atomic_fetch_add(&ctx->pair_draws[lo], 1, __ATOMIC_RELAXED);
+
+    return lo;
+}
+
+/**
+ * Count a window of a pair that has been handed to the consumers.
+ *
+ * @param ctx The context
+ * @param pair The pair
+ */
+void pairs_delivered(struct context *ctx, int pair)
+{
+    __atomic_fetch_add(&ctx->pair_deliveries[pair], 1, __ATOMIC_RELAXED);
+}
+
+/**
+ * Close the least-recently-used pair handles of a reader.
+ *
+ * @param ctx The context
+ * @param id The id of the reader
+ */
+static void close_least_recently_used(struct context *ctx, int id)
+{
+    int victim = -1;
+
+    for (int pair = 0; pair < ctx->L; ++pair)
+    {
+        int i = id * ctx->L + pair;
+        if (ctx->reader_imagery_datasets[i] != NULL && (victim < 0 || ctx->reader_last_used[i] < ctx->reader_last_used[id * ctx->L + victim]))
+        {
+            victim = pair;
+        }
+    }
+    if (victim >= 0)
+    {
+        int i = id * ctx->L + victim;
+        GDALClose(ctx->reader_imagery_datasets[i]);
+        if (ctx->reader_label_datasets[i] != NULL)
+        {
+            GDALClose(ctx->reader_label_datasets[i]);
+        }
+        if (ctx->reader_cloud_datasets[i] != NULL)
+        {
+            GDALClose(ctx->reader_cloud_datasets[i]);
+        }
+        ctx->reader_imagery_datasets[i] = NULL;
+        ctx->reader_imagery_first_bands[i] = NULL;
+        ctx->reader_label_datasets[i] = NULL;
+        ctx->reader_cloud_datasets[i] = NULL;
+        ctx->reader_open_counts[id]--;
+    }
+}
+
+/**
+ * Get the handles through which a reader reads a pair, opening them
+ * (and the handle to the pair's cloud raster, if any) if needed.
+ * Each reader has its own handles to every pair, so no locking is
+ * needed, but the number of pairs that a reader holds open at once is
+ * bounded by MAX_OPEN_PAIRS.
+ *
+ * @param ctx The context
+ * @param id The id of the reader
+ * @param pair The index of the pair
+ * @param imagery_dataset The return-location for the imagery dataset
+ * @param imagery_first_band The return-location for the first imagery band
+ * @param label_dataset The return-location for the label dataset (NULL if there are no labels)
+ */
+void reader_handles(struct context *ctx, int id, int pair,
+                    GDALDatasetH *imagery_dataset,
+                    GDALRasterBandH *imagery_first_band,
+                    GDALDatasetH *label_dataset)
+{
+    int i = id * ctx->L + pair;
+
+    if (ctx->reader_imagery_datasets[i] == NULL)
+    {
+        char filename[0xff];
+
+        if (ctx->reader_open_counts[id] >= MAX_OPEN_PAIRS)
+        {
+            close_least_recently_used(ctx, id);
+        }
+        sprintf(filename, ctx->imagery_template, pair);
+        ctx->reader_imagery_datasets[i] = GDALOpen(filename, GA_ReadOnly);
+        ctx->reader_imagery_first_bands[i] = GDALGetRasterBand(ctx->reader_imagery_datasets[i], 1);
+        if (ctx->label_template != NULL && ctx->label_vectors == NULL)
+        {
+            sprintf(filename, ctx->label_template, pair);
+            ctx->reader_label_datasets[i] = GDALOpen(filename, GA_ReadOnly);
+        }
+        if (ctx->cloud_template != NULL)
+        {
+            sprintf(filename, ctx->cloud_template, pair);
+            ctx->reader_cloud_datasets[i] = GDALOpen(filename, GA_ReadOnly);
+        }
+        ctx->reader_open_counts[id]++;
+
+        // Distinguishes these handles from earlier ones to the pair,
+        // which may have had the same addresses
+        ctx->reader_generations[i] = ++ctx->reader_ticks[id];
+    }
+    ctx->reader_last_used[i] = ++ctx->reader_ticks[id];
+
+    *imagery_dataset = ctx->reader_imagery_datasets[i];
+    *imagery_first_band = ctx->reader_imagery_first_bands[i];
+    *label_dataset = ctx->reader_label_datasets[i];
+}
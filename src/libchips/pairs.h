@@ -26,50 +26,29 @@
  * OTHER DEALINGS IN THE SOFTWARE.
  */
 
-#ifndef __GLOBALS_H__
-#define __GLOBALS_H__
-
-#include <pthread.h>
+#ifndef __PAIRS_H__
+#define __PAIRS_H__
 
 #include <gdal.h>
 
-enum op_mode
-{
-    stopped = 0,
-    training = 1,
-    evaluation = 2,
-    inference = 3,
-};
+struct context;
+
+void pairs_init(struct context *ctx, const char *imagery_filename_template,
+                const char *label_filename_template);
+
+void pairs_deinit(struct context *ctx);
+
+GDALDataType pairs_data_type(const char *filename_template, GDALDataType requested, GDALDataType fallback);
+
+void pairs_reweight(struct context *ctx);
 
-// Global variables
-extern int N;
-extern int M;
-extern int L;
-extern GDALDataType imagery_data_type;
-extern GDALDataType label_data_type;
-extern int operation_mode;
-extern int window_size_imagery;
-extern int window_size_labels;
-extern int band_count;
-extern int *bands;
-extern int *widths;
-extern int *heights;
-extern int radius;
-extern int *center_xs;
-extern int *center_ys;
-extern uint64_t current;
+int choose_pair(struct context *ctx, unsigned int *state);
 
-// Thread-related variables
-extern pthread_mutex_t *dataset_mutexes;
-extern pthread_t *threads;
-extern GDALDatasetH *imagery_datasets;
-extern GDALRasterBandH *imagery_first_bands;
-extern GDALDatasetH *label_datasets;
+void pairs_delivered(struct context *ctx, int pair);
 
-// Slot-related variables
-extern pthread_mutex_t *slot_mutexes;
-extern void **imagery_slots;
-extern void **label_slots;
-extern int *ready;
+void reader_handles(struct context *ctx, int id, int pair,
+                    GDALDatasetH *imagery_dataset,
+                    GDALRasterBandH *imagery_first_band,
+                    GDALDatasetH *label_dataset);
 
 #endif
@@ -0,0 +1,275 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+#include <pthread.h>
+
+#include <gdal.h>
+
+#include "context.h"
+#include "config.h"
+#include "buffers.h"
+#include "cache.h"
+#include "clouds.h"
+#include "pairs.h"
+#include "plan.h"
+
+#define PLANNING (ctx->operation_mode == inference)
+
+/**
+ * Read one inference window at its exact offset (which need not be a
+ * multiple of the window size), reducing and normalizing it if so
+ * configured.
+ * Windows that are empty or cannot be read are zero-filled.
+ *
+ * @param ctx The context
+ * @param dataset The calling thread's handle to the imagery
+ * @param first_band The first band of that handle
+ * @param x The x-offset of the window (in pixels)
+ * @param y The y-offset of the window (in pixels)
+ * @param buffer The return-location for the imagery
+ * @param attempts The maximum number of attempts to make to read the window
+ * @return 1 for success, 0 for failure (or an empty window)
+ */
+int plan_read(struct context *ctx, GDALDatasetH dataset, GDALRasterBandH first_band,
+              int x, int y, void *buffer, int attempts)
+{
+    int size = ctx->window_size_imagery;
+    int output_size = ctx->imagery_output_size;
+    CPLErr err = CE_Failure;
+
+    if (!(GDAL_DATA_COVERAGE_STATUS_EMPTY & GDALGetDataCoverageStatus(first_band, x, y, size, size, 0, NULL)))
+    {
+        for (int i = 0; i < attempts && err != CE_None; ++i)
+        {
+            err = reduced_read(dataset, x, y, size,
+                               buffer, output_size,
+                               ctx->imagery_data_type, ctx->band_count, ctx->bands);
+        }
+    }
+    if (err != CE_None)
+    {
+        memset(buffer, 0, word_size(ctx->imagery_data_type) * ctx->band_count * output_size * output_size);
+        return 0;
+    }
+
+    if (ctx->normalization_mus != NULL)
+    {
+        buffer_normalize(buffer, ctx->imagery_data_type, ctx->band_count, output_size * output_size,
+                         ctx->normalization_mus, ctx->normalization_sigmas, ctx->imagery_nd_check, ctx->imagery_nd);
+    }
+    return 1;
+}
+
+/**
+ * The code behind the inference read-ahead threads.  Each one claims
+ * the next window of the plan, waits until its slot is free, and
+ * reads the window into it.
+ *
+ * @param _arg The context and id of this particular thread (a struct thread_arg)
+ * @return Unused
+ */
+static void *plan_reader(void *_arg)
+{
+    struct context *ctx = ((struct thread_arg *)_arg)->ctx;
+    uint64_t id = ((struct thread_arg *)_arg)->id;
+    GDALDatasetH dataset = NULL;
+    GDALRasterBandH first_band = NULL;
+    GDALDatasetH label_dataset = NULL;
+
+    config_apply(ctx);
+    reader_handles(ctx, id, 0, &dataset, &first_band, &label_dataset);
+
+    while (1)
+    {
+        int64_t index;
+        int slot;
+        int result;
+
+        // Claim the next window once its slot has been consumed
+        pthread_mutex_lock(&ctx->plan_mutex);
+        while (PLANNING && ctx->plan_claimed < ctx->plan_count && ctx->plan_claimed >= ctx->plan_consumed + ctx->M)
+        {
+            pthread_cond_wait(&ctx->plan_progress, &ctx->plan_mutex);
+        }
+        if (!PLANNING || ctx->plan_claimed >= ctx->plan_count)
+        {
+            pthread_mutex_unlock(&ctx->plan_mutex);
+            break;
+        }
+        index = ctx->plan_claimed++;
+        pthread_mutex_unlock(&ctx->plan_mutex);
+
+        slot = index % ctx->M;
+        if (clouds_cover(ctx, id, 0, ctx->plan_xs[index], ctx->plan_ys[index]))
+        {
+            // Skip cloudy windows without reading them
+            memset(ctx->imagery_slots[slot], 0, word_size(ctx->imagery_data_type) * ctx->band_count * ctx->imagery_output_size * ctx->imagery_output_size);
+            result = 2;
+        }
+        else
+        {
+            result = plan_read(ctx, dataset, first_band, ctx->plan_xs[index], ctx->plan_ys[index],
+                               ctx->imagery_slots[slot], ctx->plan_attempts);
+        }
+
+        pthread_mutex_lock(&ctx->plan_mutex);
+        ctx->plan_results[slot] = result;
+        ctx->plan_filled[slot] = index;
+        pthread_cond_broadcast(&ctx->plan_progress);
+        pthread_mutex_unlock(&ctx->plan_mutex);
+    }
+
+    return NULL;
+}
+
+/**
+ * Start reading a plan of inference windows ahead of the consumer,
+ * using the context's N threads and M slots.
+ *
+ * @param ctx The context
+ * @param count The number of windows in the plan
+ * @param xs The x-offsets of the windows (in pixels)
+ * @param ys The y-offsets of the windows (in pixels)
+ * @param attempts The maximum number of attempts to make to read each window
+ * @return 1 on success, 0 on failure
+ */
+int plan_start(struct context *ctx, int count, const int *xs, const int *ys, int attempts)
+{
+    if (!PLANNING || ctx->M < 1 || ctx->plan_threads != NULL)
+    {
+        fprintf(stderr, "CANNOT START AN INFERENCE PLAN\n");
+        return 0;
+    }
+
+    ctx->plan_count = count;
+    ctx->plan_xs = (int *)malloc(sizeof(int) * count);
+    ctx->plan_ys = (int *)malloc(sizeof(int) * count);
+    memcpy(ctx->plan_xs, xs, sizeof(int) * count);
+    memcpy(ctx->plan_ys, ys, sizeof(int) * count);
+    ctx->plan_attempts = attempts;
+    ctx->plan_claimed = ctx->plan_consumed = 0;
+    ctx->plan_filled = (int64_t *)malloc(sizeof(int64_t) * ctx->M);
+    ctx->plan_results = (int *)malloc(sizeof(int) * ctx->M);
+    for (int i = 0; i < ctx->M; ++i)
+    {
+        ctx->plan_filled[i] = -1;
+    }
+    pthread_mutex_init(&ctx->plan_mutex, NULL);
+    pthread_cond_init(&ctx->plan_progress, NULL);
+
+    ctx->plan_threads = (pthread_t *)malloc(sizeof(pthread_t) * ctx->N);
+    for (int i = 0; i < ctx->N; ++i)
+    {
+        pthread_create(&ctx->plan_threads[i], NULL, plan_reader, &ctx->thread_args[i]);
+    }
+    return 1;
+}
+
+/**
+ * Get the next window of the plan (in plan order), waiting for it to
+ * be read if necessary.
+ *
+ * @param ctx The context
+ * @param buffer The return-location for the imagery
+ * @return 1 for success, 0 for failure (or an empty window), 2 for a window skipped as cloudy, -1 if the plan is exhausted
+ */
+int plan_next(struct context *ctx, void *buffer)
+{
+    int64_t index;
+    int slot;
+    int result;
+
+    if (ctx->plan_threads == NULL)
+    {
+        return -1;
+    }
+
+    pthread_mutex_lock(&ctx->plan_mutex);
+    index = ctx->plan_consumed;
+    slot = index % ctx->M;
+    while (PLANNING && index < ctx->plan_count && ctx->plan_filled[slot] != index)
+    {
+        pthread_cond_wait(&ctx->plan_progress, &ctx->plan_mutex);
+    }
+    if (!PLANNING || index >= ctx->plan_count)
+    {
+        pthread_mutex_unlock(&ctx->plan_mutex);
+        return -1;
+    }
+    pthread_mutex_unlock(&ctx->plan_mutex);
+
+    // The slot cannot be reused until plan_consumed moves past it
+    memcpy(buffer, ctx->imagery_slots[slot], word_size(ctx->imagery_data_type) * ctx->band_count * ctx->imagery_output_size * ctx->imagery_output_size);
+    result = ctx->plan_results[slot];
+
+    pthread_mutex_lock(&ctx->plan_mutex);
+    ctx->plan_consumed++;
+    pthread_cond_broadcast(&ctx->plan_progress);
+    pthread_mutex_unlock(&ctx->plan_mutex);
+
+    return result;
+}
+
+/**
+ * Stop the read-ahead threads (the operation mode must already have
+ * been changed) and release the plan.
+ *
+ * @param ctx The context
+ */
+void plan_stop(struct context *ctx)
+{
+    if (ctx->plan_threads == NULL)
+    {
+        return;
+    }
+
+    pthread_mutex_lock(&ctx->plan_mutex);
+    pthread_cond_broadcast(&ctx->plan_progress);
+    pthread_mutex_unlock(&ctx->plan_mutex);
+    for (int i = 0; i < ctx->N; ++i)
+    {
+        pthread_join(ctx->plan_threads[i], NULL);
+    }
+    pthread_cond_destroy(&ctx->plan_progress);
+    pthread_mutex_destroy(&ctx->plan_mutex);
+
+    free(ctx->plan_threads);
+    free(ctx->plan_xs);
+    free(ctx->plan_ys);
+    free(ctx->plan_filled);
+    free(ctx->plan_results);
+    ctx->plan_threads = NULL;
+    ctx->plan_xs = ctx->plan_ys = NULL;
+    ctx->plan_filled = NULL;
+    ctx->plan_results = NULL;
+    ctx->plan_count = 0;
+}
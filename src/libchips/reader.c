@@ -26,182 +26,624 @@
  * OTHER DEALINGS IN THE SOFTWARE.
  */
 
+#include <stdio.h>
+#include <stdlib.h>
 #include <stdint.h>
+#include <string.h>
+#include <unistd.h>
 
 #include <gdal.h>
 
-#include "globals.h"
+#include "context.h"
+#include "config.h"
 #include "reader.h"
+#include "buffers.h"
+#include "cache.h"
+#include "classes.h"
+#include "clouds.h"
+#include "hard.h"
+#include "pairs.h"
+#include "slots.h"
+#include "store.h"
+#include "telemetry.h"
+#include "vectors.h"
+#include "windows.h"
 #include "macros.h"
 
+// The transforms (see buffer_transform) that make up each combination
+// of augmentations
+static const int flip_transforms[] = {0, 1, 2, 3};
+static const int rotation_transforms[] = {0, 5, 3, 6};
+static const int all_transforms[] = {0, 1, 2, 3, 4, 5, 6, 7};
+
+/**
+ * Choose a random transform from among those allowed by the
+ * augmentation flags.
+ *
+ * @param augmentations The augmentation flags
+ * @param state The random state of the calling thread
+ * @return The transform (0 through 7)
+ */
+static int choose_transform(int augmentations, unsigned int *state)
+{
+    if ((augmentations & augment_flips) && (augmentations & augment_rotations))
+    {
+        return all_transforms[rand_r(state) % 8];
+    }
+    else if (augmentations & augment_flips)
+    {
+        return flip_transforms[rand_r(state) % 4];
+    }
+    else if (augmentations & augment_rotations)
+    {
+        return rotation_transforms[rand_r(state) % 4];
+    }
+    return 0;
+}
+
+/**
+ * Count a fruitless attempt to find something to read and wait
+ * (longer after each consecutive one), so that a reader with nothing
+ * to read does not spin.
+ *
+ * @param ctx The context
+ * @param id The id of the calling reader thread
+ * @param fruitless The number of consecutive fruitless attempts (incremented here)
+ */
+static void back_off(struct context *ctx, int id, int *fruitless)
+{
+    useconds_t wait = FRUITLESS_READ_BACKOFF_US;
+
+    for (int i = 0; i < *fruitless && wait < MAX_FRUITLESS_READ_BACKOFF_US; ++i)
+    {
+        wait *= 2;
+    }
+    wait = (wait < MAX_FRUITLESS_READ_BACKOFF_US) ? wait : MAX_FRUITLESS_READ_BACKOFF_US;
+    (*fruitless)++;
+    telemetry_add(ctx, id, stat_failures, 1);
+    usleep(wait);
+}
+
+// A window chosen ahead of time
+struct upcoming_window
+{
+    int pair;
+    int x_windows;
+    int y_windows;
+    uint64_t advised_generation; // of this reader's handles to the pair when advised (0 if not advised)
+};
+
+/**
+ * Choose a pair (weighted by size), then a suitable training or
+ * evaluation window near the center of the pair, falling back to any
+ * valid window of the pair if none is found quickly.  A fraction of
+ * the draws instead revisit windows with high reported losses.
+ *
+ * @param ctx The context
+ * @param state The random state of the calling thread
+ * @param window The return-location for the pair and window
+ * @return 1 if a window was found, 0 otherwise
+ */
+static int draw_window(struct context *ctx, unsigned int *state, struct upcoming_window *window)
+{
+    int wradius = ctx->radius / ctx->window_size_imagery;
+    int pair = -1;
+    int x_windows = -1;
+    int y_windows = -1;
+
+    if (ctx->hard_fraction > ((double)rand_r(state) / RAND_MAX) &&
+        hard_draw(ctx, state, &pair, &x_windows, &y_windows) &&
+        window_valid(ctx, pair, x_windows, y_windows))
+    {
+        window->pair = pair;
+        window->x_windows = x_windows;
+        window->y_windows = y_windows;
+        window->advised_generation = 0;
+        return 1;
+    }
+    pair = choose_pair(ctx, state);
+    x_windows = y_windows = -1;
+
+    for (int draws = 0; draws < MAX_WINDOW_DRAWS && !window_valid(ctx, pair, x_windows, y_windows); ++draws)
+    {
+        const int rand_x = rand_r(state) % (2 * wradius);
+        const int rand_y = rand_r(state) % (2 * wradius);
+        x_windows = ctx->center_xs[pair] + rand_x - wradius;
+        y_windows = ctx->center_ys[pair] + rand_y - wradius;
+    }
+    if (!window_valid(ctx, pair, x_windows, y_windows) &&
+        !choose_window(ctx, pair, state, &x_windows, &y_windows))
+    {
+        return 0;
+    }
+
+    window->pair = pair;
+    window->x_windows = x_windows;
+    window->y_windows = y_windows;
+    window->advised_generation = 0;
+    return 1;
+}
+
+/**
+ * Tell GDAL that a window will soon be read, so that drivers for
+ * remote data can start fetching it while other windows are decoded.
+ *
+ * @param ctx The context
+ * @param id The id of the calling reader thread
+ * @param window The window that will be read
+ */
+static void advise_window(struct context *ctx, int id, struct upcoming_window *window)
+{
+    GDALDatasetH imagery_dataset = NULL;
+    GDALRasterBandH first_band = NULL;
+    GDALDatasetH label_dataset = NULL;
+
+    reader_handles(ctx, id, window->pair, &imagery_dataset, &first_band, &label_dataset);
+    GDALDatasetAdviseRead(imagery_dataset,
+                          window->x_windows * ctx->window_size_imagery,
+                          window->y_windows * ctx->window_size_imagery,
+                          ctx->window_size_imagery, ctx->window_size_imagery,
+                          ctx->window_size_imagery, ctx->window_size_imagery,
+                          ctx->imagery_data_type, ctx->band_count, ctx->bands,
+                          NULL);
+    if (label_dataset != NULL)
+    {
+        GDALDatasetAdviseRead(label_dataset,
+                              window->x_windows * ctx->window_size_labels,
+                              window->y_windows * ctx->window_size_labels,
+                              ctx->window_size_labels, ctx->window_size_labels,
+                              ctx->window_size_labels, ctx->window_size_labels,
+                              ctx->label_data_type, 1, NULL,
+                              NULL);
+    }
+    window->advised_generation = ctx->reader_generations[id * ctx->L + window->pair];
+}
+
+// A square block of neighboring windows read in one go (see
+// _region_windows), from which windows are handed out one at a time
+struct region
+{
+    int pair;
+    int x_windows;
+    int y_windows;
+    int size;
+    int has_labels;
+    int *order;
+    int remaining;
+    void *imagery;
+    void *labels;
+};
+
+/**
+ * Read a new region around a freshly drawn window: the imagery and
+ * labels of up to region_windows by region_windows windows, in one
+ * read each.  The valid windows of the region (those that are
+ * whole, non-empty, in the current split and not cloudy) are queued
+ * in a random order, and nothing is read if there are none.
+ *
+ * @param ctx The context
+ * @param id The id of the calling reader thread
+ * @param state The random state of the calling thread
+ * @param region The region to refill
+ * @return 1 if the region was read, 0 otherwise
+ */
+static int read_region(struct context *ctx, int id, unsigned int *state, struct region *region)
+{
+    struct upcoming_window window;
+    GDALDatasetH imagery_dataset = NULL;
+    GDALRasterBandH first_band = NULL;
+    GDALDatasetH label_dataset = NULL;
+    int columns, rows, size;
+
+    region->remaining = 0;
+    if (!draw_window(ctx, state, &window))
+    {
+        return 0;
+    }
+
+    // Place the region around the window, within the raster
+    columns = ctx->widths[window.pair] / ctx->window_size_imagery;
+    rows = ctx->heights[window.pair] / ctx->window_size_imagery;
+    size = ctx->region_windows;
+    size = (size < columns) ? size : columns;
+    size = (size < rows) ? size : rows;
+    region->pair = window.pair;
+    region->size = size;
+    region->x_windows = window.x_windows - (size / 2);
+    region->x_windows = (region->x_windows < columns - size) ? region->x_windows : columns - size;
+    region->x_windows = (region->x_windows > 0) ? region->x_windows : 0;
+    region->y_windows = window.y_windows - (size / 2);
+    region->y_windows = (region->y_windows < rows - size) ? region->y_windows : rows - size;
+    region->y_windows = (region->y_windows > 0) ? region->y_windows : 0;
+
+    // Queue the valid windows in a random order
+    for (int i = 0; i < size * size; ++i)
+    {
+        int x_windows = region->x_windows + (i % size);
+        int y_windows = region->y_windows + (i / size);
+
+        if (!window_valid(ctx, region->pair, x_windows, y_windows))
+        {
+            continue;
+        }
+        if (clouds_cover(ctx, id, region->pair, x_windows * ctx->window_size_imagery, y_windows * ctx->window_size_imagery))
+        {
+            telemetry_add(ctx, id, stat_windows, 1);
+            telemetry_add(ctx, id, stat_rejections, 1);
+            continue;
+        }
+        int j = rand_r(state) % (region->remaining + 1);
+        region->order[region->remaining++] = region->order[j];
+        region->order[j] = i;
+    }
+    if (region->remaining == 0)
+    {
+        return 0;
+    }
+
+    reader_handles(ctx, id, region->pair, &imagery_dataset, &first_band, &label_dataset);
+    region->has_labels = (label_dataset != NULL || ctx->label_vectors != NULL);
+    if (region->has_labels &&
+        (ctx->label_vectors != NULL
+             ? vectors_read(ctx, region->pair,
+                            region->x_windows * ctx->window_size_labels, region->y_windows * ctx->window_size_labels,
+                            size * ctx->window_size_labels, region->labels)
+             : cache_read(ctx, region->pair, label_block, label_dataset,
+                          region->x_windows * ctx->window_size_labels, region->y_windows * ctx->window_size_labels,
+                          size * ctx->window_size_labels,
+                          region->labels, ctx->label_data_type, 1, NULL)) != CE_None)
+    {
+        fprintf(stderr, "FAILED LABEL REGION READ AT %d %d IN PAIR %d\n",
+                region->x_windows * ctx->window_size_labels, region->y_windows * ctx->window_size_labels, region->pair);
+        telemetry_add(ctx, id, stat_failures, 1);
+        region->remaining = 0;
+        return 0;
+    }
+    if (cache_read(ctx, region->pair, imagery_block, imagery_dataset,
+                   region->x_windows * ctx->window_size_imagery, region->y_windows * ctx->window_size_imagery,
+                   size * ctx->window_size_imagery,
+                   region->imagery, ctx->imagery_data_type, ctx->band_count, ctx->bands) != CE_None)
+    {
+        fprintf(stderr, "FAILED IMAGERY REGION READ AT %d %d IN PAIR %d\n",
+                region->x_windows * ctx->window_size_imagery, region->y_windows * ctx->window_size_imagery, region->pair);
+        telemetry_add(ctx, id, stat_failures, 1);
+        region->remaining = 0;
+        return 0;
+    }
+
+    return 1;
+}
+
 /**
  * The code behind the reader threads.
  *
- * @param _id The id of this particular thread
+ * @param _arg The context and id of this particular thread (a struct thread_arg)
  * @return Unused
  */
-void *reader(void *_id)
+void *reader(void *_arg)
 {
-    uint64_t id = (uint64_t)_id;
+    struct context *ctx = ((struct thread_arg *)_arg)->ctx;
+    uint64_t id = ((struct thread_arg *)_arg)->id;
+    int pair = 0;
+    GDALDatasetH imagery_dataset = NULL;
+    GDALRasterBandH first_band = NULL;
+    GDALDatasetH label_dataset = NULL;
     int x_windows = 0;
     int y_windows = 0;
     int slot = -1;
     CPLErr err = CE_None;
     unsigned int state = (unsigned long)id;
+    uint64_t num_imagery_words = ctx->band_count * ctx->imagery_output_size * ctx->imagery_output_size;
+    uint64_t num_label_words = 1 * ctx->window_size_labels * ctx->window_size_labels;
+    void *scratch = NULL;
+    uint64_t *histogram = NULL;
+    int upcoming_capacity = ctx->lookahead + 1;
+    struct upcoming_window *upcoming = (struct upcoming_window *)malloc(sizeof(struct upcoming_window) * upcoming_capacity);
+    int upcoming_head = 0;
+    int upcoming_count = 0;
+    struct region region = {0};
+    int fruitless = 0;
 
-    while (operation_mode == training || operation_mode == evaluation)
+    config_apply(ctx);
+    if (ctx->augmentations)
     {
-        // Find an unused data slot
-        for (slot = rand_r(&state) % M; (operation_mode == training || operation_mode == evaluation); slot = (slot + 1) % M)
-        {
-            // If slot is unlocked and slot is empty, read
-            if ((pthread_mutex_trylock(&slot_mutexes[slot]) == 0) && (ready[slot] == 0))
-            {
-                goto read_things;
-            }
-            UNLOCK_CONTINUE(slot, 100);
-        }
+        uint64_t imagery_plane_bytes = word_size(ctx->imagery_data_type) * ctx->imagery_output_size * ctx->imagery_output_size;
+        uint64_t label_plane_bytes = word_size(ctx->label_data_type) * ctx->window_size_labels * ctx->window_size_labels;
+        scratch = malloc(imagery_plane_bytes > label_plane_bytes ? imagery_plane_bytes : label_plane_bytes);
+    }
+    if (ctx->class_count > 0)
+    {
+        histogram = (uint64_t *)malloc(sizeof(uint64_t) * ctx->class_count);
+    }
+    if (ctx->region_windows > 1 && ctx->store_map == NULL)
+    {
+        uint64_t region_imagery_words = num_imagery_words * ctx->region_windows * ctx->region_windows;
+        uint64_t region_label_words = num_label_words * ctx->region_windows * ctx->region_windows;
+        region.order = (int *)malloc(sizeof(int) * ctx->region_windows * ctx->region_windows);
+        region.imagery = malloc(region_imagery_words * word_size(ctx->imagery_data_type));
+        region.labels = malloc(region_label_words * word_size(ctx->label_data_type));
+    }
 
-        // If search for slot terminated because the mode changed,
-        // break out of the loop
-        if (operation_mode != training && operation_mode != evaluation)
+    while (RUNNING)
+    {
+        // Wait for an empty slot
+        uint64_t wait_start = telemetry_now();
+        slot = claim_empty_slot(ctx);
+        telemetry_add(ctx, id, stat_slot_wait_ns, telemetry_now() - wait_start);
+        if (slot < 0)
         {
-            UNLOCK_BREAK((slot + M - 1) % M, 0);
+            break;
         }
 
-    read_things:
-
-#if defined(CHAMPION_EDITION)
-        for (int i = 0; i < (1 << 7); ++i)
-#else
-        for (int i = 0; i < 1; ++i)
-#endif
+        // Read windows into the slot until one is acceptable
+        while (RUNNING)
         {
-            int wradius = radius / window_size_imagery;
+            int64_t record = -1;
+            int has_labels = 0;
+            int in_region = 0;
 
-            // Get a suitable training or evaluation window
-            if (operation_mode == training) // Training chip
+            if (ctx->store_map != NULL)
             {
-                x_windows = y_windows = -1;
-                while (BAD_WINDOW || BAD_TRAINING_WINDOW || EMPTY_WINDOW)
+                // Draw a window from the chip store
+                record = store_choose(ctx, &state);
+                pair = ctx->store_entries[record].pair;
+                x_windows = ctx->store_entries[record].x / ctx->window_size_imagery;
+                y_windows = ctx->store_entries[record].y / ctx->window_size_imagery;
+                has_labels = (ctx->label_template != NULL && store_labels(ctx, record) != NULL);
+                if (clouds_cover(ctx, id, pair, ctx->store_entries[record].x, ctx->store_entries[record].y))
                 {
-                    const int rand_x = rand_r(&state) % (2 * wradius);
-                    const int rand_y = rand_r(&state) % (2 * wradius);
-                    x_windows = center_xs[id] + rand_x - wradius;
-                    y_windows = center_ys[id] + rand_y - wradius;
+                    telemetry_add(ctx, id, stat_windows, 1);
+                    telemetry_add(ctx, id, stat_rejections, 1);
+                    continue;
                 }
             }
-            else if (operation_mode == evaluation) // Evaluation chip
+            else if (region.order != NULL)
             {
-                x_windows = y_windows = -1;
-                while (BAD_WINDOW || BAD_EVALUATION_WINDOW || EMPTY_WINDOW)
+                // Take the next window of the current region, reading
+                // a new region once it is used up (backing off if
+                // several attempts yield nothing)
+                for (int attempts = 0; region.remaining == 0 && attempts < MAX_WINDOW_DRAWS && RUNNING; ++attempts)
                 {
-                    const int rand_x = rand_r(&state) % (2 * wradius);
-                    const int rand_y = rand_r(&state) % (2 * wradius);
-                    x_windows = center_xs[id] + rand_x - wradius;
-                    y_windows = center_ys[id] + rand_y - wradius;
+                    read_region(ctx, id, &state, &region);
                 }
+                if (region.remaining == 0)
+                {
+                    back_off(ctx, id, &fruitless);
+                    continue;
+                }
+                fruitless = 0;
+                int i = region.order[--region.remaining];
+                pair = region.pair;
+                x_windows = region.x_windows + (i % region.size);
+                y_windows = region.y_windows + (i / region.size);
+                has_labels = region.has_labels;
+                in_region = 1;
             }
             else
             {
-                break;
-            }
+                // Keep the windows after this one chosen in advance
+                // (and advised) so that fetching them overlaps with
+                // reading and decoding this one
+                int cloudy_draws = 0;
+                while (upcoming_count < upcoming_capacity)
+                {
+                    struct upcoming_window *window = &upcoming[(upcoming_head + upcoming_count) % upcoming_capacity];
 
-            // Read imagery
-            {
-                int x = x_windows * window_size_imagery;
-                int y = y_windows * window_size_imagery;
-
-                pthread_mutex_lock(&dataset_mutexes[id]);
-                err = GDALDatasetRasterIO(imagery_datasets[id], 0,
-                                          x, y, window_size_imagery, window_size_imagery,
-                                          imagery_slots[slot],
-                                          window_size_imagery, window_size_imagery,
-                                          imagery_data_type, band_count, bands,
-                                          0, 0, 0);
-                pthread_mutex_unlock(&dataset_mutexes[id]);
-                if (err != CE_None)
-                {
-                    fprintf(stderr, "FAILED IMAGERY READ AT %d %d\n", x, y);
-                    UNLOCK_CONTINUE(slot, 1000)
+                    if (!draw_window(ctx, &state, window))
+                    {
+                        break;
+                    }
+                    if (clouds_cover(ctx, id, window->pair,
+                                     window->x_windows * ctx->window_size_imagery,
+                                     window->y_windows * ctx->window_size_imagery))
+                    {
+                        // Drop cloudy windows before anything of them
+                        // is fetched or decoded
+                        telemetry_add(ctx, id, stat_windows, 1);
+                        telemetry_add(ctx, id, stat_rejections, 1);
+                        if (++cloudy_draws >= MAX_WINDOW_DRAWS || !RUNNING)
+                        {
+                            break;
+                        }
+                        continue;
+                    }
+                    if (ctx->lookahead > 0)
+                    {
+                        advise_window(ctx, id, window);
+                    }
+                    upcoming_count++;
+                }
+                if (upcoming_count == 0)
+                {
+                    back_off(ctx, id, &fruitless);
+                    continue;
+                }
+                fruitless = 0;
+
+                // Take the oldest of them and get this reader's
+                // handles to its pair
+                struct upcoming_window *window = &upcoming[upcoming_head];
+                upcoming_head = (upcoming_head + 1) % upcoming_capacity;
+                upcoming_count--;
+                pair = window->pair;
+                x_windows = window->x_windows;
+                y_windows = window->y_windows;
+                reader_handles(ctx, id, pair, &imagery_dataset, &first_band, &label_dataset);
+                has_labels = (label_dataset != NULL || ctx->label_vectors != NULL);
+                if (window->advised_generation != 0 &&
+                    window->advised_generation == ctx->reader_generations[id * ctx->L + pair])
+                {
+                    telemetry_add(ctx, id, stat_prefetched, 1);
                 }
             }
+            telemetry_add(ctx, id, stat_windows, 1);
 
-            // Read labels
-            if (label_datasets[id] != NULL)
+            // Read labels.  These are read first because they are
+            // cheaper than the imagery, so rejected windows waste
+            // less work.
+            if (has_labels)
             {
-                int x = x_windows * window_size_labels;
-                int y = y_windows * window_size_labels;
-
-                pthread_mutex_lock(&dataset_mutexes[id]);
-                err = GDALDatasetRasterIO(label_datasets[id], 0,
-                                          x, y, window_size_labels, window_size_labels,
-                                          label_slots[slot],
-                                          window_size_labels, window_size_labels,
-                                          label_data_type, 1, NULL,
-                                          0, 0, 0);
-                pthread_mutex_unlock(&dataset_mutexes[id]);
-                if (err != CE_None)
-                {
-                    fprintf(stderr, "FAILED LABEL READ AT %d %d\n", x, y);
-                    UNLOCK_CONTINUE(slot, 1000)
+                int x = x_windows * ctx->window_size_labels;
+                int y = y_windows * ctx->window_size_labels;
+
+                if (record >= 0)
+                {
+                    memcpy(ctx->label_slots[slot], store_labels(ctx, record), num_label_words * word_size(ctx->label_data_type));
+                }
+                else if (in_region)
+                {
+                    buffer_crop(region.labels, region.size * ctx->window_size_labels,
+                                ctx->label_slots[slot], ctx->window_size_labels,
+                                (x_windows - region.x_windows) * ctx->window_size_labels,
+                                (y_windows - region.y_windows) * ctx->window_size_labels,
+                                ctx->label_data_type, 1);
+                }
+                else if (ctx->label_vectors != NULL)
+                {
+                    if ((err = vectors_read(ctx, pair, x, y, ctx->window_size_labels, ctx->label_slots[slot])) != CE_None)
+                    {
+                        fprintf(stderr, "FAILED LABEL BURN AT %d %d IN PAIR %d\n", x, y, pair);
+                        telemetry_add(ctx, id, stat_failures, 1);
+                        continue;
+                    }
+                }
+                else if ((err = cache_read(ctx, pair, label_block, label_dataset,
+                                           x, y, ctx->window_size_labels,
+                                           ctx->label_slots[slot], ctx->label_data_type,
+                                           1, NULL)) != CE_None)
+                {
+                    fprintf(stderr, "FAILED LABEL READ AT %d %d IN PAIR %d\n", x, y, pair);
+                    telemetry_add(ctx, id, stat_failures, 1);
+                    continue;
+                }
+                telemetry_add(ctx, id, stat_bytes, num_label_words * word_size(ctx->label_data_type));
+
+                if (ctx->forbidden_label_check && buffer_contains(ctx->label_slots[slot], ctx->label_data_type, num_label_words, ctx->forbidden_label_value))
+                {
+                    telemetry_add(ctx, id, stat_rejections, 1);
+                    continue;
+                }
+                if (ctx->desired_label_check && !buffer_contains(ctx->label_slots[slot], ctx->label_data_type, num_label_words, ctx->desired_label_value))
+                {
+                    if (ctx->reroll > ((double)rand_r(&state) / RAND_MAX))
+                    {
+                        telemetry_add(ctx, id, stat_rejections, 1);
+                        continue;
+                    }
+                }
+                if (histogram != NULL)
+                {
+                    buffer_histogram(ctx->label_slots[slot], ctx->label_data_type, num_label_words,
+                                     ctx->label_lut, ctx->label_lut_size, ctx->label_nd,
+                                     histogram, ctx->class_count);
+                    if (!classes_accept(ctx, histogram, &state))
+                    {
+                        telemetry_add(ctx, id, stat_rejections, 1);
+                        continue;
+                    }
                 }
             }
 
-#if defined(CHAMPION_EDITION)
-#define DESIRED (0x02)
-            // Imagery and labels have been read, at this point.  Now
-            // see if they have the desired characteristics.  If not,
-            // continue.
-            int should_go_again = 0;
-
-            // Inventory of labels
-            uint32_t label_words_found = 0;
-            uint64_t num_label_words = 1 * window_size_labels * window_size_labels;
-            for (int j = 0; j < num_label_words; ++j)
+            // Read imagery
             {
-                uint32_t word = ((uint32_t *)(label_slots[slot]))[j];
-                label_words_found |= word;
+                int x = x_windows * ctx->window_size_imagery;
+                int y = y_windows * ctx->window_size_imagery;
+
+                if (record >= 0)
+                {
+                    memcpy(ctx->imagery_slots[slot], store_imagery(ctx, record), num_imagery_words * word_size(ctx->imagery_data_type));
+                }
+                else if (in_region)
+                {
+                    buffer_crop(region.imagery, region.size * ctx->window_size_imagery,
+                                ctx->imagery_slots[slot], ctx->window_size_imagery,
+                                (x_windows - region.x_windows) * ctx->window_size_imagery,
+                                (y_windows - region.y_windows) * ctx->window_size_imagery,
+                                ctx->imagery_data_type, ctx->band_count);
+                }
+                else if (ctx->imagery_output_size != ctx->window_size_imagery)
+                {
+                    if ((err = reduced_read(imagery_dataset, x, y, ctx->window_size_imagery,
+                                            ctx->imagery_slots[slot], ctx->imagery_output_size,
+                                            ctx->imagery_data_type, ctx->band_count, ctx->bands)) != CE_None)
+                    {
+                        fprintf(stderr, "FAILED IMAGERY READ AT %d %d IN PAIR %d\n", x, y, pair);
+                        telemetry_add(ctx, id, stat_failures, 1);
+                        continue;
+                    }
+                }
+                else if ((err = cache_read(ctx, pair, imagery_block, imagery_dataset,
+                                           x, y, ctx->window_size_imagery,
+                                           ctx->imagery_slots[slot], ctx->imagery_data_type,
+                                           ctx->band_count, ctx->bands)) != CE_None)
+                {
+                    fprintf(stderr, "FAILED IMAGERY READ AT %d %d IN PAIR %d\n", x, y, pair);
+                    telemetry_add(ctx, id, stat_failures, 1);
+                    continue;
+                }
+                telemetry_add(ctx, id, stat_bytes, num_imagery_words * word_size(ctx->imagery_data_type));
+
+                if (ctx->forbidden_imagery_check && buffer_contains(ctx->imagery_slots[slot], ctx->imagery_data_type, num_imagery_words, ctx->forbidden_imagery_value))
+                {
+                    telemetry_add(ctx, id, stat_rejections, 1);
+                    continue;
+                }
             }
-            if (should_go_again)
+
+            // Count the classes of the accepted window
+            if (has_labels && histogram != NULL)
             {
-                continue;
+                classes_record(ctx, histogram);
             }
 
-#if 0
-            // Check ensure that IEEE-754 zero is not present in the
-            // imagery (the value is forbidden).
-            uint64_t num_imagery_words = band_count * window_size_imagery * window_size_imagery;
-            for (int j = 0; j < num_imagery_words; ++j)
+            // Remap the labels of the accepted window
+            if (has_labels && ctx->label_lut != NULL)
             {
-                uint32_t word = ((uint32_t *)imagery_slots[slot])[j];
-                if (!(word & 0x7fffffff))
-                {
-                    should_go_again |= 1;
-                }
+                buffer_remap(ctx->label_slots[slot], ctx->label_data_type, num_label_words, ctx->label_lut, ctx->label_lut_size, ctx->label_nd);
             }
-            if (should_go_again)
+
+            // Normalize the imagery of the accepted window
+            if (ctx->normalization_mus != NULL)
             {
-                continue;
+                buffer_normalize(ctx->imagery_slots[slot], ctx->imagery_data_type, ctx->band_count, ctx->imagery_output_size * ctx->imagery_output_size,
+                                 ctx->normalization_mus, ctx->normalization_sigmas, ctx->imagery_nd_check, ctx->imagery_nd);
             }
-#endif
 
-            // Check to see whether label value 2 was found earlier.
-            // If so, this pair is okay.  If not, fall through and
-            // (probably) do the for-loop again.
-            if (DESIRED & label_words_found)
+            // Flip and/or rotate the imagery and labels together
+            if (ctx->augmentations)
             {
-                break;
+                int transform = choose_transform(ctx->augmentations, &state);
+                buffer_transform(ctx->imagery_slots[slot], scratch, ctx->imagery_data_type, ctx->band_count, ctx->imagery_output_size, transform);
+                if (has_labels)
+                {
+                    buffer_transform(ctx->label_slots[slot], scratch, ctx->label_data_type, 1, ctx->window_size_labels, transform);
+                }
             }
-#endif
-        }
 
-        // The slot is now ready for reading
-        ready[slot] = 1;
+            break;
+        }
 
-        // Done
-        UNLOCK(slot, 1000)
+        // Hand the slot to the consumers, or return it if the
+        // library stopped before it could be filled
+        if (RUNNING)
+        {
+            ctx->slot_origins[(3 * slot) + 0] = pair;
+            ctx->slot_origins[(3 * slot) + 1] = x_windows * ctx->window_size_imagery;
+            ctx->slot_origins[(3 * slot) + 2] = y_windows * ctx->window_size_imagery;
+            pairs_delivered(ctx, pair);
+            publish_slot(ctx, slot);
+        }
+        else
+        {
+            abandon_slot(ctx, slot);
+        }
     }
 
+    free(scratch);
+    free(histogram);
+    free(region.order);
+    free(region.imagery);
+    free(region.labels);
+    free(upcoming);
     return NULL;
 }
@@ -29,6 +29,6 @@
 #ifndef __READER_H__
 #define __READER_H__
 
-void *reader(void *_id);
+void *reader(void *_arg);
 
 #endif
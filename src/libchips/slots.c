@@ -0,0 +1,251 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#include <stdlib.h>
+#include <errno.h>
+#include <pthread.h>
+#include <time.h>
+
+#include "context.h"
+#include "slots.h"
+#include "telemetry.h"
+#include "macros.h"
+
+/**
+ * Initialize the slot queues.  All M slots start out empty.
+ *
+ * @param ctx The context
+ */
+void slots_init(struct context *ctx)
+{
+    pthread_condattr_t attr;
+
+    pthread_mutex_init(&ctx->slot_mutex, NULL);
+    pthread_condattr_init(&attr);
+    pthread_condattr_setclock(&attr, CLOCK_MONOTONIC);
+    pthread_cond_init(&ctx->slot_filled, &attr);
+    pthread_cond_init(&ctx->slot_emptied, &attr);
+    pthread_condattr_destroy(&attr);
+
+    ctx->empty_slots = (int *)malloc(sizeof(int) * ctx->M);
+    ctx->full_slots = (int *)malloc(sizeof(int) * ctx->M);
+    ctx->slot_origins = (int *)calloc(3 * ctx->M, sizeof(int));
+    ctx->slot_lent = (int *)calloc(ctx->M, sizeof(int));
+    for (int i = 0; i < ctx->M; ++i)
+    {
+        ctx->empty_slots[i] = i;
+    }
+    ctx->empty_count = ctx->M;
+    ctx->full_head = ctx->full_count = 0;
+}
+
+/**
+ * Deinitialize the slot queues.
+ *
+ * @param ctx The context
+ */
+void slots_deinit(struct context *ctx)
+{
+    pthread_cond_destroy(&ctx->slot_filled);
+    pthread_cond_destroy(&ctx->slot_emptied);
+    pthread_mutex_destroy(&ctx->slot_mutex);
+    free(ctx->empty_slots);
+    free(ctx->full_slots);
+    free(ctx->slot_origins);
+    free(ctx->slot_lent);
+    ctx->empty_slots = ctx->full_slots = ctx->slot_origins = ctx->slot_lent = NULL;
+    ctx->empty_count = ctx->full_head = ctx->full_count = 0;
+}
+
+/**
+ * Wake every thread blocked on a slot queue so that it can notice a
+ * change of operation mode.
+ *
+ * @param ctx The context
+ */
+void slots_wake(struct context *ctx)
+{
+    pthread_mutex_lock(&ctx->slot_mutex);
+    pthread_cond_broadcast(&ctx->slot_filled);
+    pthread_cond_broadcast(&ctx->slot_emptied);
+    pthread_mutex_unlock(&ctx->slot_mutex);
+}
+
+/**
+ * Take an empty slot, blocking until one is available.  Used by the
+ * reader threads.
+ *
+ * @param ctx The context
+ * @return The slot index, or -1 if the library stopped while waiting
+ */
+int claim_empty_slot(struct context *ctx)
+{
+    int slot = -1;
+
+    pthread_mutex_lock(&ctx->slot_mutex);
+    while (RUNNING && ctx->empty_count == 0)
+    {
+        pthread_cond_wait(&ctx->slot_emptied, &ctx->slot_mutex);
+    }
+    if (RUNNING)
+    {
+        slot = ctx->empty_slots[--ctx->empty_count];
+    }
+    pthread_mutex_unlock(&ctx->slot_mutex);
+
+    return slot;
+}
+
+/**
+ * Return a claimed slot to the empty queue without publishing it
+ * (e.g. after a failed read).
+ *
+ * @param ctx The context
+ * @param slot The slot index
+ */
+void abandon_slot(struct context *ctx, int slot)
+{
+    pthread_mutex_lock(&ctx->slot_mutex);
+    ctx->empty_slots[ctx->empty_count++] = slot;
+    pthread_cond_signal(&ctx->slot_emptied);
+    pthread_mutex_unlock(&ctx->slot_mutex);
+}
+
+/**
+ * Publish a filled slot to the consumers.
+ *
+ * @param ctx The context
+ * @param slot The slot index
+ */
+void publish_slot(struct context *ctx, int slot)
+{
+    pthread_mutex_lock(&ctx->slot_mutex);
+    ctx->full_slots[(ctx->full_head + ctx->full_count++) % ctx->M] = slot;
+    pthread_cond_signal(&ctx->slot_filled);
+    pthread_mutex_unlock(&ctx->slot_mutex);
+}
+
+/**
+ * Take a filled slot, blocking until one is available.  Used by the
+ * consumer.
+ *
+ * @param ctx The context
+ * @param milliseconds The maximum time to wait, or a negative number to wait indefinitely
+ * @return The slot index, or -1 on timeout or if the library is stopped
+ */
+int claim_full_slot(struct context *ctx, int milliseconds)
+{
+    struct timespec deadline;
+    int slot = -1;
+    int err = 0;
+    uint64_t wait_start = telemetry_now();
+
+    if (milliseconds >= 0)
+    {
+        clock_gettime(CLOCK_MONOTONIC, &deadline);
+        deadline.tv_sec += milliseconds / 1000;
+        deadline.tv_nsec += (long)(milliseconds % 1000) * 1000000;
+        if (deadline.tv_nsec >= 1000000000)
+        {
+            deadline.tv_sec += 1;
+            deadline.tv_nsec -= 1000000000;
+        }
+    }
+
+    pthread_mutex_lock(&ctx->slot_mutex);
+    while (RUNNING && ctx->full_count == 0 && err != ETIMEDOUT)
+    {
+        if (milliseconds >= 0)
+        {
+            err = pthread_cond_timedwait(&ctx->slot_filled, &ctx->slot_mutex, &deadline);
+        }
+        else
+        {
+            pthread_cond_wait(&ctx->slot_filled, &ctx->slot_mutex);
+        }
+    }
+    if (ctx->full_count > 0)
+    {
+        slot = ctx->full_slots[ctx->full_head];
+        ctx->full_head = (ctx->full_head + 1) % ctx->M;
+        ctx->full_count--;
+    }
+    pthread_mutex_unlock(&ctx->slot_mutex);
+    telemetry_add_consumer_wait(ctx, telemetry_now() - wait_start);
+
+    return slot;
+}
+
+/**
+ * Return a consumed slot to the empty queue.
+ *
+ * @param ctx The context
+ * @param slot The slot index
+ */
+void release_slot(struct context *ctx, int slot)
+{
+    abandon_slot(ctx, slot);
+}
+
+/**
+ * Mark a filled slot (from claim_full_slot) as lent to the consumer.
+ *
+ * @param ctx The context
+ * @param slot The slot index
+ */
+void lend_slot(struct context *ctx, int slot)
+{
+    pthread_mutex_lock(&ctx->slot_mutex);
+    ctx->slot_lent[slot] = 1;
+    pthread_mutex_unlock(&ctx->slot_mutex);
+}
+
+/**
+ * Return a lent slot to the empty queue.  Slots that are not
+ * currently lent are refused, so that a slot released twice is not
+ * queued twice (and filled by two readers at once).
+ *
+ * @param ctx The context
+ * @param slot The slot index
+ * @return 1 if the slot was returned, 0 if it is not lent
+ */
+int return_lent_slot(struct context *ctx, int slot)
+{
+    pthread_mutex_lock(&ctx->slot_mutex);
+    if (ctx->slot_lent == NULL || !ctx->slot_lent[slot])
+    {
+        pthread_mutex_unlock(&ctx->slot_mutex);
+        return 0;
+    }
+    ctx->slot_lent[slot] = 0;
+    ctx->empty_slots[ctx->empty_count++] = slot;
+    pthread_cond_signal(&ctx->slot_emptied);
+    pthread_mutex_unlock(&ctx->slot_mutex);
+
+    return 1;
+}
@@ -0,0 +1,54 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#ifndef __SLOTS_H__
+#define __SLOTS_H__
+
+struct context;
+
+void slots_init(struct context *ctx);
+
+void slots_deinit(struct context *ctx);
+
+void slots_wake(struct context *ctx);
+
+int claim_empty_slot(struct context *ctx);
+
+void abandon_slot(struct context *ctx, int slot);
+
+void publish_slot(struct context *ctx, int slot);
+
+int claim_full_slot(struct context *ctx, int milliseconds);
+
+void release_slot(struct context *ctx, int slot);
+
+void lend_slot(struct context *ctx, int slot);
+
+int return_lent_slot(struct context *ctx, int slot);
+
+#endif
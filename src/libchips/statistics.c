@@ -0,0 +1,241 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#include <math.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+
+#include <pthread.h>
+
+#include <gdal.h>
+
+#include "context.h"
+#include "config.h"
+#include "pairs.h"
+#include "statistics.h"
+#include "windows.h"
+#include "macros.h"
+
+/**
+ * Merge one set of (count, mean, sum of squared deviations) into
+ * another (Chan et al.).
+ *
+ * @param count The count to update
+ * @param mean The mean to update
+ * @param m2 The sum of squared deviations to update
+ * @param count_b The count of the other set
+ * @param mean_b The mean of the other set
+ * @param m2_b The sum of squared deviations of the other set
+ */
+static void merge(double *count, double *mean, double *m2,
+                  double count_b, double mean_b, double m2_b)
+{
+    double n = *count + count_b;
+    double delta = mean_b - *mean;
+
+    if (count_b == 0)
+    {
+        return;
+    }
+    *mean += delta * count_b / n;
+    *m2 += m2_b + delta * delta * (*count) * count_b / n;
+    *count = n;
+}
+
+/**
+ * The code behind the statistics threads.  Each thread repeatedly
+ * claims the next window (of any pair), reads it if it is not empty,
+ * and folds its valid pixels into the running statistics of the
+ * thread.
+ *
+ * @param _arg The context and id of this particular thread (a struct thread_arg)
+ * @return NULL on success, non-NULL on failure
+ */
+static void *accumulator(void *_arg)
+{
+    struct context *ctx = ((struct thread_arg *)_arg)->ctx;
+    uint64_t id = ((struct thread_arg *)_arg)->id;
+    uint64_t n = ctx->window_size_imagery * ctx->window_size_imagery;
+    double *buffer = (double *)malloc(sizeof(double) * ctx->band_count * n);
+    void *failed = NULL;
+
+    config_apply(ctx);
+    while (failed == NULL)
+    {
+        GDALDatasetH imagery_dataset, label_dataset;
+        GDALRasterBandH first_band;
+        int64_t w;
+        int x_windows, y_windows, columns, pair;
+        int lo = 0;
+        int hi = ctx->L - 1;
+
+        pthread_mutex_lock(&ctx->work_mutex);
+        w = ctx->work_next++;
+        pthread_mutex_unlock(&ctx->work_mutex);
+        if (w >= ctx->work_offsets[ctx->L])
+        {
+            break;
+        }
+
+        // Find the pair to which the window belongs
+        while (lo < hi)
+        {
+            int mid = (lo + hi) / 2;
+            if (ctx->work_offsets[mid + 1] > w)
+            {
+                hi = mid;
+            }
+            else
+            {
+                lo = mid + 1;
+            }
+        }
+        pair = lo;
+        columns = ctx->widths[pair] / ctx->window_size_imagery;
+        x_windows = (w - ctx->work_offsets[pair]) % columns;
+        y_windows = (w - ctx->work_offsets[pair]) / columns;
+        if (!window_nonempty(ctx, pair, x_windows, y_windows))
+        {
+            continue;
+        }
+
+        reader_handles(ctx, id, pair, &imagery_dataset, &first_band, &label_dataset);
+        if (GDALDatasetRasterIO(imagery_dataset, GF_Read,
+                                x_windows * ctx->window_size_imagery, y_windows * ctx->window_size_imagery,
+                                ctx->window_size_imagery, ctx->window_size_imagery,
+                                buffer,
+                                ctx->window_size_imagery, ctx->window_size_imagery,
+                                GDT_Float64, ctx->band_count, ctx->bands,
+                                0, 0, 0) != CE_None)
+        {
+            fprintf(stderr, "FAILED STATISTICS READ AT %d %d IN PAIR %d\n",
+                    x_windows * ctx->window_size_imagery, y_windows * ctx->window_size_imagery, pair);
+            failed = buffer;
+            continue;
+        }
+
+        // Two passes over each band of the window, then merge
+        for (int band = 0; band < ctx->band_count; ++band)
+        {
+            const double *words = buffer + band * n;
+            double count = 0, sum = 0, mean, m2 = 0;
+
+            for (uint64_t i = 0; i < n; ++i)
+            {
+                if (words[i] == words[i] && !(ctx->imagery_nd_check && words[i] == ctx->imagery_nd))
+                {
+                    count += 1;
+                    sum += words[i];
+                }
+            }
+            if (count == 0)
+            {
+                continue;
+            }
+            mean = sum / count;
+            for (uint64_t i = 0; i < n; ++i)
+            {
+                if (words[i] == words[i] && !(ctx->imagery_nd_check && words[i] == ctx->imagery_nd))
+                {
+                    m2 += (words[i] - mean) * (words[i] - mean);
+                }
+            }
+            merge(&ctx->work_counts[id * ctx->band_count + band], &ctx->work_means[id * ctx->band_count + band], &ctx->work_m2s[id * ctx->band_count + band],
+                  count, mean, m2);
+        }
+    }
+
+    free(buffer);
+    return failed;
+}
+
+/**
+ * Compute the exact per-band mean and (population) standard deviation
+ * of the imagery over every whole, non-empty window of every pair,
+ * ignoring NaNs and nodata.  N threads do the reading.
+ *
+ * @param ctx The context
+ * @param mus The return-location for the per-band means
+ * @param sigmas The return-location for the per-band standard deviations
+ * @return 1 for success, 0 for failure
+ */
+int statistics_compute(struct context *ctx, double *mus, double *sigmas)
+{
+    pthread_t *threads;
+    int ok = 1;
+
+    ctx->work_counts = (double *)calloc(ctx->N * ctx->band_count, sizeof(double));
+    ctx->work_means = (double *)calloc(ctx->N * ctx->band_count, sizeof(double));
+    ctx->work_m2s = (double *)calloc(ctx->N * ctx->band_count, sizeof(double));
+    ctx->work_offsets = (int64_t *)malloc(sizeof(int64_t) * (ctx->L + 1));
+    ctx->work_offsets[0] = 0;
+    for (int pair = 0; pair < ctx->L; ++pair)
+    {
+        ctx->work_offsets[pair + 1] = ctx->work_offsets[pair] +
+                                      (int64_t)(ctx->widths[pair] / ctx->window_size_imagery) * (ctx->heights[pair] / ctx->window_size_imagery);
+    }
+
+    ctx->work_next = 0;
+    threads = (pthread_t *)malloc(sizeof(pthread_t) * ctx->N);
+    for (int i = 0; i < ctx->N; ++i)
+    {
+        pthread_create(&threads[i], NULL, accumulator, &ctx->thread_args[i]);
+    }
+    for (int i = 0; i < ctx->N; ++i)
+    {
+        void *failed = NULL;
+        pthread_join(threads[i], &failed);
+        ok = ok && (failed == NULL);
+    }
+    free(threads);
+
+    // Merge the threads
+    for (int band = 0; band < ctx->band_count; ++band)
+    {
+        double count = 0, mean = 0, m2 = 0;
+
+        for (int i = 0; i < ctx->N; ++i)
+        {
+            merge(&count, &mean, &m2,
+                  ctx->work_counts[i * ctx->band_count + band], ctx->work_means[i * ctx->band_count + band], ctx->work_m2s[i * ctx->band_count + band]);
+        }
+        mus[band] = mean;
+        sigmas[band] = (count > 0) ? sqrt(m2 / count) : 0;
+        ok = ok && (count > 0);
+    }
+
+    free(ctx->work_counts);
+    free(ctx->work_means);
+    free(ctx->work_m2s);
+    free(ctx->work_offsets);
+    ctx->work_counts = ctx->work_means = ctx->work_m2s = NULL;
+    ctx->work_offsets = NULL;
+
+    return ok;
+}
@@ -0,0 +1,503 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+
+#include <fcntl.h>
+#include <pthread.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#include <gdal.h>
+
+#include "context.h"
+#include "config.h"
+#include "buffers.h"
+#include "cache.h"
+#include "pairs.h"
+#include "store.h"
+#include "vectors.h"
+#include "windows.h"
+#include "macros.h"
+
+#define STORE_MAGIC "LIBCHIP2"
+
+/**
+ * Summarize the sources of a store: the bands read and the identity
+ * (see dataset_identity) of the imagery and labels of every pair, so
+ * that a store exported from other data is not served.
+ *
+ * @param ctx The context
+ * @return The identity
+ */
+static uint64_t store_identity(struct context *ctx)
+{
+    uint64_t identity = 0xcbf29ce484222325ULL;
+    char filename[0xff];
+
+    for (int i = 0; i < ctx->band_count; ++i)
+    {
+        identity = (identity ^ (uint64_t)ctx->bands[i]) * 0x100000001b3ULL;
+    }
+    for (int pair = 0; pair < ctx->L; ++pair)
+    {
+        sprintf(filename, ctx->imagery_template, pair);
+        identity = (identity ^ dataset_identity(filename, ctx->imagery_data_type)) * 0x100000001b3ULL;
+        if (ctx->label_template != NULL)
+        {
+            sprintf(filename, ctx->label_template, pair);
+            identity = (identity ^ dataset_identity(filename, ctx->label_data_type)) * 0x100000001b3ULL;
+        }
+    }
+
+    return identity;
+}
+
+/**
+ * Enumerate every whole, non-empty window of every pair, recording
+ * which split it belongs to.
+ *
+ * @param ctx The context
+ * @return The number of entries found
+ */
+static int64_t enumerate_windows(struct context *ctx)
+{
+    int64_t count = 0;
+    int64_t capacity = 1 << 16;
+
+    ctx->store_entries = (struct store_entry *)malloc(sizeof(struct store_entry) * capacity);
+    for (int pair = 0; pair < ctx->L; ++pair)
+    {
+        for (int y_windows = 0; y_windows < ctx->heights[pair] / ctx->window_size_imagery; ++y_windows)
+        {
+            for (int x_windows = 0; x_windows < ctx->widths[pair] / ctx->window_size_imagery; ++x_windows)
+            {
+                if (!window_nonempty(ctx, pair, x_windows, y_windows))
+                {
+                    continue;
+                }
+                if (count == capacity)
+                {
+                    capacity *= 2;
+                    ctx->store_entries = (struct store_entry *)realloc(ctx->store_entries, sizeof(struct store_entry) * capacity);
+                }
+                ctx->store_entries[count].pair = pair;
+                ctx->store_entries[count].x = x_windows * ctx->window_size_imagery;
+                ctx->store_entries[count].y = y_windows * ctx->window_size_imagery;
+                ctx->store_entries[count].split = BAD_TRAINING_WINDOW ? evaluation : training;
+                count++;
+            }
+        }
+    }
+
+    return count;
+}
+
+/**
+ * The code behind the export threads.  Each thread repeatedly takes
+ * the next unwritten entry, reads it, and writes it at its fixed
+ * position in the store.
+ *
+ * @param _arg The context and id of this particular thread (a struct thread_arg)
+ * @return NULL on success, non-NULL on failure
+ */
+static void *exporter(void *_arg)
+{
+    struct context *ctx = ((struct thread_arg *)_arg)->ctx;
+    uint64_t id = ((struct thread_arg *)_arg)->id;
+    uint8_t *record = (uint8_t *)malloc(ctx->store_header.stride);
+    void *failed = NULL;
+
+    config_apply(ctx);
+    while (failed == NULL)
+    {
+        GDALDatasetH imagery_dataset, label_dataset;
+        GDALRasterBandH first_band;
+        struct store_entry *entry;
+        int64_t i;
+        CPLErr err;
+
+        pthread_mutex_lock(&ctx->work_mutex);
+        i = ctx->work_next++;
+        pthread_mutex_unlock(&ctx->work_mutex);
+        if (i >= ctx->store_header.count)
+        {
+            break;
+        }
+        entry = &ctx->store_entries[i];
+
+        reader_handles(ctx, id, entry->pair, &imagery_dataset, &first_band, &label_dataset);
+        err = GDALDatasetRasterIO(imagery_dataset, GF_Read,
+                                  entry->x, entry->y, ctx->window_size_imagery, ctx->window_size_imagery,
+                                  record,
+                                  ctx->window_size_imagery, ctx->window_size_imagery,
+                                  ctx->imagery_data_type, ctx->band_count, ctx->bands,
+                                  0, 0, 0);
+        if (err == CE_None && ctx->label_vectors != NULL)
+        {
+            int x = (entry->x / ctx->window_size_imagery) * ctx->window_size_labels;
+            int y = (entry->y / ctx->window_size_imagery) * ctx->window_size_labels;
+
+            err = vectors_read(ctx, entry->pair, x, y, ctx->window_size_labels, record + ctx->store_header.imagery_bytes);
+        }
+        else if (err == CE_None && label_dataset != NULL)
+        {
+            int x = (entry->x / ctx->window_size_imagery) * ctx->window_size_labels;
+            int y = (entry->y / ctx->window_size_imagery) * ctx->window_size_labels;
+            void *labels = record + ctx->store_header.imagery_bytes;
+
+            err = GDALDatasetRasterIO(label_dataset, GF_Read,
+                                      x, y, ctx->window_size_labels, ctx->window_size_labels,
+                                      labels,
+                                      ctx->window_size_labels, ctx->window_size_labels,
+                                      ctx->label_data_type, 1, NULL,
+                                      0, 0, 0);
+        }
+        if (err != CE_None)
+        {
+            fprintf(stderr, "FAILED EXPORT READ AT %d %d IN PAIR %d\n", entry->x, entry->y, entry->pair);
+            failed = record;
+        }
+        else if (pwrite(ctx->store_fd, record, ctx->store_header.stride, STORE_HEADER_BYTES + i * ctx->store_header.stride) != ctx->store_header.stride)
+        {
+            fprintf(stderr, "FAILED EXPORT WRITE OF ENTRY %ld\n", (long)i);
+            failed = record;
+        }
+    }
+
+    free(record);
+    return failed;
+}
+
+/**
+ * Export every whole, non-empty window of every pair (using the
+ * configuration given to start) into a chip store.  The store is a
+ * flat file of fixed-stride (imagery, label) records after a
+ * one-page header; a companion index file (the store filename plus
+ * ".index") records the pair, x, y and split of each record.  The
+ * export uses the N reader handle sets, so it should be done while
+ * the library is started in stopped mode (operation mode 0).  Labels
+ * are stored as read; the label lookup table is applied when chips
+ * are served.
+ *
+ * @param ctx The context
+ * @param store_filename The filename of the store
+ * @return 1 for success, 0 for failure
+ */
+int store_export(struct context *ctx, const char *store_filename)
+{
+    char index_filename[0x1ff];
+    FILE *index;
+    int ok = 1;
+
+    memset(&ctx->store_header, 0, sizeof(ctx->store_header));
+    memcpy(ctx->store_header.magic, STORE_MAGIC, sizeof(ctx->store_header.magic));
+    ctx->store_header.imagery_data_type = ctx->imagery_data_type;
+    ctx->store_header.label_data_type = ctx->label_data_type;
+    ctx->store_header.band_count = ctx->band_count;
+    ctx->store_header.window_size_imagery = ctx->window_size_imagery;
+    ctx->store_header.window_size_labels = ctx->window_size_labels;
+    ctx->store_header.has_labels = (ctx->label_template != NULL);
+    ctx->store_header.pair_count = ctx->L;
+    ctx->store_header.source_identity = store_identity(ctx);
+    ctx->store_header.imagery_bytes = word_size(ctx->imagery_data_type) * ctx->band_count * ctx->window_size_imagery * ctx->window_size_imagery;
+    ctx->store_header.label_bytes = ctx->store_header.has_labels ? word_size(ctx->label_data_type) * 1 * ctx->window_size_labels * ctx->window_size_labels : 0;
+    ctx->store_header.stride = ctx->store_header.imagery_bytes + ctx->store_header.label_bytes;
+    ctx->store_header.count = enumerate_windows(ctx);
+
+    // Write the index
+    sprintf(index_filename, "%s.index", store_filename);
+    if ((index = fopen(index_filename, "wb")) == NULL ||
+        fwrite(ctx->store_entries, sizeof(struct store_entry), ctx->store_header.count, index) != ctx->store_header.count)
+    {
+        fprintf(stderr, "FAILED TO WRITE %s\n", index_filename);
+        ok = 0;
+    }
+    if (index != NULL)
+    {
+        fclose(index);
+    }
+
+    // Write the header and the chips
+    if (ok && (ctx->store_fd = open(store_filename, O_CREAT | O_TRUNC | O_WRONLY, 0644)) < 0)
+    {
+        fprintf(stderr, "FAILED TO CREATE %s\n", store_filename);
+        ok = 0;
+    }
+    if (ok && pwrite(ctx->store_fd, &ctx->store_header, sizeof(ctx->store_header), 0) != sizeof(ctx->store_header))
+    {
+        ok = 0;
+    }
+    if (ok)
+    {
+        pthread_t *threads = (pthread_t *)malloc(sizeof(pthread_t) * ctx->N);
+
+        ctx->work_next = 0;
+        for (int i = 0; i < ctx->N; ++i)
+        {
+            pthread_create(&threads[i], NULL, exporter, &ctx->thread_args[i]);
+        }
+        for (int i = 0; i < ctx->N; ++i)
+        {
+            void *failed = NULL;
+            pthread_join(threads[i], &failed);
+            ok = ok && (failed == NULL);
+        }
+        free(threads);
+    }
+    if (ctx->store_fd >= 0)
+    {
+        close(ctx->store_fd);
+        ctx->store_fd = -1;
+    }
+
+    if (!ok)
+    {
+        unlink(store_filename);
+        unlink(index_filename);
+    }
+
+    free(ctx->store_entries);
+    ctx->store_entries = NULL;
+
+    return ok;
+}
+
+/**
+ * Whether the header of a store matches the current configuration
+ * and data.
+ *
+ * @param ctx The context
+ * @param header The header of the store
+ * @return 1 if the store was exported with the same settings from the same data, otherwise 0
+ */
+static int header_matches(struct context *ctx, const struct store_header *header)
+{
+    return (memcmp(header->magic, STORE_MAGIC, sizeof(header->magic)) == 0 &&
+            header->imagery_data_type == ctx->imagery_data_type &&
+            header->band_count == ctx->band_count &&
+            header->window_size_imagery == ctx->window_size_imagery &&
+            (!header->has_labels || (header->label_data_type == ctx->label_data_type && header->window_size_labels == ctx->window_size_labels)) &&
+            header->pair_count == ctx->L &&
+            header->source_identity == store_identity(ctx));
+}
+
+/**
+ * Whether a chip store exists and matches the current configuration
+ * and data (see header_matches), so that it need not be exported
+ * again.
+ *
+ * @param ctx The context
+ * @param store_filename The filename of the store
+ * @return 1 if the store matches, otherwise 0
+ */
+int store_matches(struct context *ctx, const char *store_filename)
+{
+    struct store_header header;
+    int fd;
+    int ok;
+
+    if ((fd = open(store_filename, O_RDONLY)) < 0)
+    {
+        return 0;
+    }
+    ok = (pread(fd, &header, sizeof(header), 0) == sizeof(header) && header_matches(ctx, &header));
+    close(fd);
+
+    return ok;
+}
+
+/**
+ * Open a chip store for sampling.  The store is memory-mapped and
+ * the entries of each split are gathered so that they can be drawn
+ * uniformly.
+ *
+ * @param ctx The context
+ * @param store_filename The filename of the store
+ * @return 1 for success, 0 if the store cannot be used with the current configuration
+ */
+int store_open(struct context *ctx, const char *store_filename)
+{
+    char index_filename[0x1ff];
+    struct stat st;
+    FILE *index;
+    void *map;
+
+    if ((ctx->store_fd = open(store_filename, O_RDONLY)) < 0 ||
+        pread(ctx->store_fd, &ctx->store_header, sizeof(ctx->store_header), 0) != sizeof(ctx->store_header) ||
+        !header_matches(ctx, &ctx->store_header) ||
+        fstat(ctx->store_fd, &st) != 0 ||
+        st.st_size < STORE_HEADER_BYTES + ctx->store_header.count * ctx->store_header.stride)
+    {
+        fprintf(stderr, "CHIP STORE %s IS MISSING OR DOES NOT MATCH\n", store_filename);
+        store_close(ctx);
+        return 0;
+    }
+
+    map = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, ctx->store_fd, 0);
+    if (map == MAP_FAILED)
+    {
+        store_close(ctx);
+        return 0;
+    }
+    madvise(map, st.st_size, MADV_RANDOM);
+    ctx->store_map = map;
+    ctx->store_map_bytes = st.st_size;
+
+    // Gather the entries of each split
+    ctx->store_entries = (struct store_entry *)malloc(sizeof(struct store_entry) * ctx->store_header.count);
+    sprintf(index_filename, "%s.index", store_filename);
+    if ((index = fopen(index_filename, "rb")) == NULL ||
+        fread(ctx->store_entries, sizeof(struct store_entry), ctx->store_header.count, index) != ctx->store_header.count)
+    {
+        fprintf(stderr, "FAILED TO READ %s\n", index_filename);
+        if (index != NULL)
+        {
+            fclose(index);
+        }
+        store_close(ctx);
+        return 0;
+    }
+    fclose(index);
+    for (int64_t i = 0; i < ctx->store_header.count; ++i)
+    {
+        const struct store_entry *entry = &ctx->store_entries[i];
+
+        if (entry->pair < 0 || entry->pair >= ctx->L ||
+            entry->x < 0 || entry->x > ctx->widths[entry->pair] - ctx->window_size_imagery ||
+            entry->y < 0 || entry->y > ctx->heights[entry->pair] - ctx->window_size_imagery)
+        {
+            fprintf(stderr, "ENTRY %ld OF %s IS OUT OF BOUNDS\n", (long)i, index_filename);
+            store_close(ctx);
+            return 0;
+        }
+    }
+    for (int split = training; split <= evaluation; ++split)
+    {
+        ctx->store_records[split] = (int64_t *)malloc(sizeof(int64_t) * (ctx->store_header.count + 1));
+        ctx->store_record_counts[split] = 0;
+        for (int64_t i = 0; i < ctx->store_header.count; ++i)
+        {
+            if (ctx->store_entries[i].split == split)
+            {
+                ctx->store_records[split][ctx->store_record_counts[split]++] = i;
+            }
+        }
+    }
+
+    if (ctx->store_record_counts[ctx->operation_mode] == 0)
+    {
+        fprintf(stderr, "CHIP STORE %s HAS NO WINDOWS FOR MODE %d\n", store_filename, ctx->operation_mode);
+        store_close(ctx);
+        return 0;
+    }
+
+    return 1;
+}
+
+/**
+ * Close the chip store (if open).
+ *
+ * @param ctx The context
+ */
+void store_close(struct context *ctx)
+{
+    if (ctx->store_map != NULL)
+    {
+        munmap(ctx->store_map, ctx->store_map_bytes);
+    }
+    if (ctx->store_fd >= 0)
+    {
+        close(ctx->store_fd);
+    }
+    for (int split = training; split <= evaluation; ++split)
+    {
+        free(ctx->store_records[split]);
+        ctx->store_records[split] = NULL;
+        ctx->store_record_counts[split] = 0;
+    }
+    free(ctx->store_entries);
+    ctx->store_entries = NULL;
+    ctx->store_fd = -1;
+    ctx->store_map = NULL;
+    ctx->store_map_bytes = 0;
+}
+
+/**
+ * Choose a random record of the split for the current operation
+ * mode.
+ *
+ * @param ctx The context
+ * @param state The random state of the calling thread
+ * @return The index of the record, or -1 if the split is empty
+ */
+int64_t store_choose(struct context *ctx, unsigned int *state)
+{
+    int64_t count = ctx->store_record_counts[ctx->operation_mode];
+    uint64_t r;
+
+    if (count == 0)
+    {
+        return -1;
+    }
+    r = ((uint64_t)rand_r(state) << 31) | (uint64_t)rand_r(state);
+
+    return ctx->store_records[ctx->operation_mode][r % count];
+}
+
+/**
+ * Get the imagery of a record.
+ *
+ * @param ctx The context
+ * @param record The index of the record
+ * @return A pointer to the imagery within the mapped store
+ */
+const void *store_imagery(struct context *ctx, int64_t record)
+{
+    return (const uint8_t *)ctx->store_map + STORE_HEADER_BYTES + record * ctx->store_header.stride;
+}
+
+/**
+ * Get the labels of a record.
+ *
+ * @param ctx The context
+ * @param record The index of the record
+ * @return A pointer to the labels within the mapped store (NULL if the store has no labels)
+ */
+const void *store_labels(struct context *ctx, int64_t record)
+{
+    if (!ctx->store_header.has_labels)
+    {
+        return NULL;
+    }
+    return (const uint8_t *)store_imagery(ctx, record) + ctx->store_header.imagery_bytes;
+}
@@ -0,0 +1,80 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#ifndef __STORE_H__
+#define __STORE_H__
+
+#include <stdint.h>
+
+struct context;
+
+// Chips start at this offset in a chip store (one page of header)
+#define STORE_HEADER_BYTES (4096)
+
+struct store_header
+{
+    char magic[8];
+    int32_t imagery_data_type;
+    int32_t label_data_type;
+    int32_t band_count;
+    int32_t window_size_imagery;
+    int32_t window_size_labels;
+    int32_t has_labels;
+    int32_t pair_count;
+    int32_t reserved;
+    uint64_t source_identity;
+    int64_t count;
+    int64_t imagery_bytes;
+    int64_t label_bytes;
+    int64_t stride;
+};
+
+// One entry of a chip store index
+struct store_entry
+{
+    int32_t pair;
+    int32_t x;
+    int32_t y;
+    int32_t split;
+};
+
+int store_export(struct context *ctx, const char *store_filename);
+
+int store_matches(struct context *ctx, const char *store_filename);
+
+int store_open(struct context *ctx, const char *store_filename);
+
+void store_close(struct context *ctx);
+
+int64_t store_choose(struct context *ctx, unsigned int *state);
+
+const void *store_imagery(struct context *ctx, int64_t record);
+
+const void *store_labels(struct context *ctx, int64_t record);
+
+#endif
@@ -0,0 +1,133 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+#include <pthread.h>
+#include <time.h>
+
+#include "context.h"
+#include "telemetry.h"
+
+/**
+ * Allocate the (zeroed) per-thread counters.
+ *
+ * @param ctx The context
+ */
+void telemetry_init(struct context *ctx)
+{
+    ctx->reader_stats = (uint64_t *)calloc(ctx->N * stat_count, sizeof(uint64_t));
+    ctx->consumer_wait_ns = 0;
+}
+
+/**
+ * Free the per-thread counters.
+ *
+ * @param ctx The context
+ */
+void telemetry_deinit(struct context *ctx)
+{
+    free(ctx->reader_stats);
+    ctx->reader_stats = NULL;
+}
+
+/**
+ * The current time, for measuring waits.
+ *
+ * @return The value of the monotonic clock in nanoseconds
+ */
+uint64_t telemetry_now()
+{
+    struct timespec tp;
+
+    clock_gettime(CLOCK_MONOTONIC, &tp);
+    return ((uint64_t)tp.tv_sec * 1000000000) + tp.tv_nsec;
+}
+
+/**
+ * Add to a counter.  Counters are updated atomically so that they
+ * can be read while the readers are running.
+ *
+ * @param ctx The context
+ * @param thread The reader thread to which the counter belongs
+ * @param stat The counter
+ * @param value The amount to add
+ */
+void telemetry_add(struct context *ctx, int thread, int stat, uint64_t value)
+{
+    __atomic_fetch_add(&ctx->reader_stats[(thread * stat_count) + stat], value, __ATOMIC_RELAXED);
+}
+
+/**
+ * Add to the time consumers have spent waiting for a full slot.
+ * This belongs to no reader thread, so it is kept for the context
+ * as a whole.
+ *
+ * @param ctx The context
+ * @param value The wait in nanoseconds
+ */
+void telemetry_add_consumer_wait(struct context *ctx, uint64_t value)
+{
+    __atomic_fetch_add(&ctx->consumer_wait_ns, value, __ATOMIC_RELAXED);
+}
+
+/**
+ * Read the counters of one reader thread, or the totals over all
+ * of them.  The consumer wait is not per-thread and is reported
+ * only in the totals (it is zero for a single thread); the slot
+ * occupancy is always reported for the context as a whole.
+ *
+ * @param ctx The context
+ * @param thread The reader thread (or -1 for totals)
+ * @param stats The return-location for the stat_count counters
+ */
+void telemetry_collect(struct context *ctx, int thread, uint64_t *stats)
+{
+    memset(stats, 0, sizeof(uint64_t) * stat_count);
+
+    for (int i = 0; i < ctx->N; ++i)
+    {
+        if (thread >= 0 && thread != i)
+        {
+            continue;
+        }
+        for (int stat = 0; stat < stat_count; ++stat)
+        {
+            stats[stat] += __atomic_load_n(&ctx->reader_stats[(i * stat_count) + stat], __ATOMIC_RELAXED);
+        }
+    }
+    if (thread < 0)
+    {
+        stats[stat_consumer_wait_ns] = __atomic_load_n(&ctx->consumer_wait_ns, __ATOMIC_RELAXED);
+    }
+
+    pthread_mutex_lock(&ctx->slot_mutex);
+    stats[stat_full_slots] = ctx->full_count;
+    pthread_mutex_unlock(&ctx->slot_mutex);
+}
@@ -0,0 +1,63 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#ifndef __TELEMETRY_H__
+#define __TELEMETRY_H__
+
+#include <stdint.h>
+
+struct context;
+
+// The counters kept for each reader thread (and reported in this
+// order by get_stats)
+enum stat
+{
+    stat_windows = 0,          // Windows drawn (and read, unless the read failed)
+    stat_bytes = 1,            // Bytes of imagery and labels read into slots
+    stat_rejections = 2,       // Windows read and then rejected
+    stat_failures = 3,         // Failed reads
+    stat_slot_wait_ns = 4,     // Time spent waiting for an empty slot
+    stat_consumer_wait_ns = 5, // Time consumers spent waiting for a full slot (totals only)
+    stat_full_slots = 6,       // Slots currently waiting to be consumed
+    stat_prefetched = 7,       // Windows read after being advised to GDAL
+    stat_count = 8,
+};
+
+void telemetry_init(struct context *ctx);
+
+void telemetry_deinit(struct context *ctx);
+
+uint64_t telemetry_now();
+
+void telemetry_add(struct context *ctx, int thread, int stat, uint64_t value);
+
+void telemetry_add_consumer_wait(struct context *ctx, uint64_t value);
+
+void telemetry_collect(struct context *ctx, int thread, uint64_t *stats);
+
+#endif
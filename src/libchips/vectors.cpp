@@ -0,0 +1,315 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#include <cstdio>
+#include <cstdint>
+#include <cstring>
+
+#include <algorithm>
+#include <vector>
+
+#include <boost/geometry.hpp>
+#include <boost/geometry/geometries/geometries.hpp>
+#include <boost/geometry/geometries/point_xy.hpp>
+#include <boost/geometry/index/rtree.hpp>
+
+#include <gdal.h>
+#include <gdal_alg.h>
+#include <ogr_api.h>
+#include <ogr_srs_api.h>
+
+#include "context.h"
+#include "macros.h"
+#include "vectors.h"
+extern "C"
+{
+#include "buffers.h"
+}
+
+namespace bg = boost::geometry;
+namespace bgi = boost::geometry::index;
+
+typedef bg::model::d2::point_xy<double> point_t;
+typedef bg::model::box<point_t> box_t;
+typedef std::pair<box_t, int> value_t;
+typedef bgi::rtree<value_t, bgi::linear<8>> rtree_t;
+
+// The label features of one pair, in the coordinates of its imagery
+struct vector_pair
+{
+    double transform[6];
+    std::vector<OGRGeometryH> geometries;
+    std::vector<double> burn_values;
+    rtree_t tree;
+};
+
+// The label features of every pair
+struct vector_labels
+{
+    std::vector<vector_pair> pairs;
+};
+
+/**
+ * Load the features of every layer of one label file, moving them into
+ * the coordinate system of the imagery if they are in another one.
+ *
+ * @param ctx The context
+ * @param pair The index of the pair
+ * @param dataset The (vector) label dataset
+ * @param labels The pair's features
+ */
+static void load_features(struct context *ctx, int pair, GDALDatasetH dataset, struct vector_pair *labels)
+{
+    const char *wkt = GDALGetProjectionRef(ctx->imagery_datasets[pair]);
+    OGRSpatialReferenceH imagery_srs = (wkt != NULL && strlen(wkt) > 0) ? OSRNewSpatialReference(wkt) : NULL;
+
+    GDALGetGeoTransform(ctx->imagery_datasets[pair], labels->transform);
+#if GDAL_VERSION_NUM >= 3000000
+    if (imagery_srs != NULL)
+    {
+        OSRSetAxisMappingStrategy(imagery_srs, OAMS_TRADITIONAL_GIS_ORDER);
+    }
+#endif
+
+    for (int i = 0; i < GDALDatasetGetLayerCount(dataset); ++i)
+    {
+        OGRLayerH layer = GDALDatasetGetLayer(dataset, i);
+        OGRSpatialReferenceH layer_srs = OGR_L_GetSpatialRef(layer);
+        OGRCoordinateTransformationH transformation = NULL;
+        OGRFeatureH feature;
+
+        if (imagery_srs != NULL && layer_srs != NULL && !OSRIsSame(imagery_srs, layer_srs))
+        {
+            layer_srs = OSRClone(layer_srs);
+#if GDAL_VERSION_NUM >= 3000000
+            OSRSetAxisMappingStrategy(layer_srs, OAMS_TRADITIONAL_GIS_ORDER);
+#endif
+            transformation = OCTNewCoordinateTransformation(layer_srs, imagery_srs);
+            OSRDestroySpatialReference(layer_srs);
+            if (transformation == NULL)
+            {
+                fprintf(stderr, "COULD NOT MOVE LABEL LAYER %d OF PAIR %d INTO THE COORDINATES OF THE IMAGERY\n", i, pair);
+                continue;
+            }
+        }
+
+        OGR_L_ResetReading(layer);
+        while ((feature = OGR_L_GetNextFeature(layer)) != NULL)
+        {
+            OGRGeometryH geometry = OGR_F_GetGeometryRef(feature);
+            int field = OGR_F_GetFieldIndex(feature, VECTOR_LABEL_FIELD);
+            OGREnvelope envelope;
+
+            if (geometry != NULL)
+            {
+                geometry = OGR_G_Clone(geometry);
+                if (transformation != NULL && OGR_G_Transform(geometry, transformation) != OGRERR_NONE)
+                {
+                    OGR_G_DestroyGeometry(geometry);
+                    OGR_F_Destroy(feature);
+                    continue;
+                }
+                OGR_G_GetEnvelope(geometry, &envelope);
+                labels->tree.insert(std::make_pair(box_t(point_t(envelope.MinX, envelope.MinY), point_t(envelope.MaxX, envelope.MaxY)),
+                                                   (int)labels->geometries.size()));
+                labels->geometries.push_back(geometry);
+                labels->burn_values.push_back((field >= 0 && OGR_F_IsFieldSetAndNotNull(feature, field)) ? OGR_F_GetFieldAsInteger(feature, field) : 1);
+            }
+            OGR_F_Destroy(feature);
+        }
+
+        if (transformation != NULL)
+        {
+            OCTDestroyCoordinateTransformation(transformation);
+        }
+    }
+
+    if (imagery_srs != NULL)
+    {
+        OSRDestroySpatialReference(imagery_srs);
+    }
+}
+
+/**
+ * Load the labels of every pair into memory if they are vector data
+ * (e.g. GeoJSON) rather than rasters.  The features of each pair are
+ * indexed by their bounding boxes so that each window burns only the
+ * features that touch it.  Either every pair has vector labels or
+ * none does.
+ *
+ * @param ctx The context
+ * @return 1 if the labels are vector data, otherwise 0
+ */
+int vectors_init(struct context *ctx)
+{
+    ctx->label_vectors = NULL;
+    if (ctx->label_template == NULL)
+    {
+        return 0;
+    }
+
+    for (int pair = 0; pair < ctx->L; ++pair)
+    {
+        char filename[0xff];
+        GDALDatasetH dataset;
+
+        sprintf(filename, ctx->label_template, pair);
+        dataset = GDALOpenEx(filename, GDAL_OF_VECTOR | GDAL_OF_READONLY, NULL, NULL, NULL);
+        if (dataset == NULL || GDALDatasetGetLayerCount(dataset) == 0)
+        {
+            if (dataset != NULL)
+            {
+                GDALClose(dataset);
+            }
+            if (pair > 0)
+            {
+                fprintf(stderr, "LABELS OF PAIR %d ARE NOT VECTOR DATA\n", pair);
+            }
+            break;
+        }
+        if (pair == 0)
+        {
+            ctx->label_vectors = new vector_labels();
+            ctx->label_vectors->pairs.resize(ctx->L);
+        }
+        load_features(ctx, pair, dataset, &ctx->label_vectors->pairs[pair]);
+        GDALClose(dataset);
+    }
+
+    return (ctx->label_vectors != NULL);
+}
+
+/**
+ * Free the label features.
+ *
+ * @param ctx The context
+ */
+void vectors_deinit(struct context *ctx)
+{
+    if (ctx->label_vectors == NULL)
+    {
+        return;
+    }
+    for (auto &labels : ctx->label_vectors->pairs)
+    {
+        for (auto geometry : labels.geometries)
+        {
+            OGR_G_DestroyGeometry(geometry);
+        }
+    }
+    delete ctx->label_vectors;
+    ctx->label_vectors = NULL;
+}
+
+/**
+ * Burn the label features that touch a square label window into a
+ * buffer, in the order in which they appear in the label file.
+ * Every pixel that a feature touches gets its label (the
+ * VECTOR_LABEL_FIELD of the feature, or 1), and the rest get 0.  Label
+ * pixels are window_size_imagery / window_size_labels imagery pixels
+ * across.
+ *
+ * @param ctx The context
+ * @param pair The index of the pair
+ * @param x The x-offset of the window (in label pixels)
+ * @param y The y-offset of the window (in label pixels)
+ * @param size The width and height of the window (in label pixels)
+ * @param buffer The return-location for the labels (of the label data type)
+ * @return CE_None on success, otherwise the error from GDAL
+ */
+CPLErr vectors_read(struct context *ctx, int pair, int x, int y, int size, void *buffer)
+{
+    struct vector_pair *labels = &ctx->label_vectors->pairs[pair];
+    double scale = (double)ctx->window_size_imagery / ctx->window_size_labels;
+    const double *t = labels->transform;
+    double transform[6];
+    std::vector<value_t> results;
+    std::vector<OGRGeometryH> geometries;
+    std::vector<double> burn_values;
+    char pointer_option[0x40];
+    char *band_options[] = {pointer_option, NULL};
+    char all_touched_option[] = "ALL_TOUCHED=TRUE";
+    char *rasterize_options[] = {all_touched_option, NULL};
+    int band = 1;
+    GDALDatasetH dataset;
+    CPLErr err;
+
+    memset(buffer, 0, word_size(ctx->label_data_type) * size * size);
+
+    // The window in the coordinates of the features
+    transform[0] = t[0] + (x * scale * t[1]) + (y * scale * t[2]);
+    transform[1] = t[1] * scale;
+    transform[2] = t[2] * scale;
+    transform[3] = t[3] + (x * scale * t[4]) + (y * scale * t[5]);
+    transform[4] = t[4] * scale;
+    transform[5] = t[5] * scale;
+    {
+        double xs[4], ys[4];
+
+        for (int corner = 0; corner < 4; ++corner)
+        {
+            int i = (corner & 1) ? size : 0;
+            int j = (corner & 2) ? size : 0;
+            xs[corner] = transform[0] + (i * transform[1]) + (j * transform[2]);
+            ys[corner] = transform[3] + (i * transform[4]) + (j * transform[5]);
+        }
+        box_t box(point_t(*std::min_element(xs, xs + 4), *std::min_element(ys, ys + 4)),
+                  point_t(*std::max_element(xs, xs + 4), *std::max_element(ys, ys + 4)));
+        labels->tree.query(bgi::intersects(box), std::back_inserter(results));
+    }
+    if (results.empty())
+    {
+        return CE_None;
+    }
+
+    // Later features are burned over earlier ones, as gdal_rasterize does
+    std::sort(results.begin(), results.end(),
+              [](const value_t &a, const value_t &b) { return a.second < b.second; });
+    for (const auto &result : results)
+    {
+        geometries.push_back(labels->geometries[result.second]);
+        burn_values.push_back(labels->burn_values[result.second]);
+    }
+
+    // Burn them straight into the buffer through an in-memory dataset
+    dataset = GDALCreate(GDALGetDriverByName("MEM"), "", size, size, 0, ctx->label_data_type, NULL);
+    if (dataset == NULL)
+    {
+        return CE_Failure;
+    }
+    snprintf(pointer_option, sizeof(pointer_option), "DATAPOINTER=%p", buffer);
+    GDALAddBand(dataset, ctx->label_data_type, band_options);
+    GDALSetGeoTransform(dataset, transform);
+    err = GDALRasterizeGeometries(dataset, 1, &band,
+                                  (int)geometries.size(), geometries.data(),
+                                  NULL, NULL, burn_values.data(),
+                                  rasterize_options, NULL, NULL);
+    GDALClose(dataset);
+
+    return err;
+}
@@ -0,0 +1,466 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+
+#include <pthread.h>
+
+#include <gdal.h>
+
+#include "context.h"
+#include "cache.h"
+#include "config.h"
+#include "pairs.h"
+#include "windows.h"
+#include "macros.h"
+
+#define WINDOWS_MAGIC "LCWNDOW2"
+
+// The number of bitmap bytes that a builder thread claims at once
+#define WINDOW_CHUNK_BYTES (64)
+
+/**
+ * The number of whole windows in a pair.
+ *
+ * @param ctx The context
+ * @param pair The index of the pair
+ * @return The number of windows
+ */
+static int64_t window_count(struct context *ctx, int pair)
+{
+    return (int64_t)(ctx->widths[pair] / ctx->window_size_imagery) * (ctx->heights[pair] / ctx->window_size_imagery);
+}
+
+/**
+ * The filename of the sidecar that caches the bitmap of a pair.
+ *
+ * @param ctx The context
+ * @param pair The index of the pair
+ * @param filename The return-location for the filename
+ */
+static void sidecar_filename(struct context *ctx, int pair, char *filename)
+{
+    char imagery_filename[0xff];
+
+    sprintf(imagery_filename, ctx->imagery_template, pair);
+    sprintf(filename, "%s.windows", imagery_filename);
+}
+
+/**
+ * The identity (see dataset_identity) of the imagery of a pair, by
+ * which a sidecar is tied to the raster that it was built from.
+ *
+ * @param ctx The context
+ * @param pair The index of the pair
+ * @return The identity
+ */
+static uint64_t sidecar_identity(struct context *ctx, int pair)
+{
+    char imagery_filename[0xff];
+
+    sprintf(imagery_filename, ctx->imagery_template, pair);
+    return dataset_identity(imagery_filename, GDT_Unknown);
+}
+
+/**
+ * Load the bitmap of a pair from its sidecar, if the sidecar exists
+ * and matches the imagery of the pair and the window size.
+ *
+ * @param ctx The context
+ * @param pair The index of the pair
+ * @return 1 if the bitmap was loaded, 0 otherwise
+ */
+static int load_sidecar(struct context *ctx, int pair)
+{
+    char filename[0x1ff];
+    struct window_sidecar_header header;
+    uint64_t num_bytes = (window_count(ctx, pair) + 7) / 8;
+    FILE *fp;
+    int ok;
+
+    sidecar_filename(ctx, pair, filename);
+    if ((fp = fopen(filename, "rb")) == NULL)
+    {
+        return 0;
+    }
+    ok = (fread(&header, sizeof(header), 1, fp) == 1 &&
+          memcmp(header.magic, WINDOWS_MAGIC, sizeof(header.magic)) == 0 &&
+          header.window_size == ctx->window_size_imagery &&
+          header.width == ctx->widths[pair] &&
+          header.height == ctx->heights[pair] &&
+          header.identity == sidecar_identity(ctx, pair) &&
+          fread(ctx->window_bitmaps[pair], 1, num_bytes, fp) == num_bytes);
+    fclose(fp);
+
+    return ok;
+}
+
+/**
+ * Save the bitmap of a pair to its sidecar.  Failure (for example
+ * when the imagery is not on a writable filesystem) is not an error,
+ * the bitmap will just be rebuilt next time.
+ *
+ * @param ctx The context
+ * @param pair The index of the pair
+ */
+static void save_sidecar(struct context *ctx, int pair)
+{
+    char filename[0x1ff];
+    struct window_sidecar_header header;
+    uint64_t num_bytes = (window_count(ctx, pair) + 7) / 8;
+    FILE *fp;
+
+    memset(&header, 0, sizeof(header));
+    memcpy(header.magic, WINDOWS_MAGIC, sizeof(header.magic));
+    header.window_size = ctx->window_size_imagery;
+    header.width = ctx->widths[pair];
+    header.height = ctx->heights[pair];
+    header.identity = sidecar_identity(ctx, pair);
+
+    sidecar_filename(ctx, pair, filename);
+    if ((fp = fopen(filename, "wb")) == NULL)
+    {
+        return;
+    }
+    if (fwrite(&header, sizeof(header), 1, fp) != 1 ||
+        fwrite(ctx->window_bitmaps[pair], 1, num_bytes, fp) != num_bytes)
+    {
+        fclose(fp);
+        remove(filename);
+        return;
+    }
+    fclose(fp);
+}
+
+/**
+ * The code behind the builder threads.  Each thread repeatedly claims
+ * the next chunk of bitmap bytes (of any pair that needs building)
+ * and fills it in by querying the data coverage of each window.
+ * Chunks are whole bytes, so no two threads write the same byte.
+ *
+ * @param _arg The context and id of this particular thread (a struct thread_arg)
+ * @return Unused
+ */
+static void *builder(void *_arg)
+{
+    struct context *ctx = ((struct thread_arg *)_arg)->ctx;
+    uint64_t id = ((struct thread_arg *)_arg)->id;
+
+    config_apply(ctx);
+    while (1)
+    {
+        GDALDatasetH imagery_dataset, label_dataset;
+        GDALRasterBandH first_band;
+        int64_t chunk, first_byte, last_byte, n;
+        int columns, pair;
+        int lo = 0;
+        int hi = ctx->L - 1;
+
+        pthread_mutex_lock(&ctx->work_mutex);
+        chunk = ctx->work_next++;
+        pthread_mutex_unlock(&ctx->work_mutex);
+        if (chunk >= ctx->work_offsets[ctx->L])
+        {
+            break;
+        }
+
+        // Find the pair to which the chunk belongs
+        while (lo < hi)
+        {
+            int mid = (lo + hi) / 2;
+            if (ctx->work_offsets[mid + 1] > chunk)
+            {
+                hi = mid;
+            }
+            else
+            {
+                lo = mid + 1;
+            }
+        }
+        pair = lo;
+
+        reader_handles(ctx, id, pair, &imagery_dataset, &first_band, &label_dataset);
+        columns = ctx->widths[pair] / ctx->window_size_imagery;
+        n = window_count(ctx, pair);
+        first_byte = (chunk - ctx->work_offsets[pair]) * WINDOW_CHUNK_BYTES;
+        last_byte = first_byte + WINDOW_CHUNK_BYTES;
+        if (last_byte > (n + 7) / 8)
+        {
+            last_byte = (n + 7) / 8;
+        }
+        for (int64_t b = first_byte; b < last_byte; ++b)
+        {
+            uint8_t bits = 0;
+
+            for (int bit = 0; bit < 8 && (b * 8 + bit) < n; ++bit)
+            {
+                int x_windows = (b * 8 + bit) % columns;
+                int y_windows = (b * 8 + bit) / columns;
+
+                if (!EMPTY_WINDOW)
+                {
+                    bits |= (1 << bit);
+                }
+            }
+            ctx->window_bitmaps[pair][b] = bits;
+        }
+    }
+
+    return NULL;
+}
+
+/**
+ * Prepare the bitmap of non-empty windows of every pair (loading it
+ * from the sidecar file next to the imagery or building it with N
+ * threads), then gather the windows of each pair that are valid for
+ * the current operation mode and reweight the pairs by their number
+ * of valid windows.  Nothing is done in inference mode.
+ *
+ * @param ctx The context
+ */
+void windows_init(struct context *ctx)
+{
+    int64_t total = 0;
+    int *loaded;
+
+    if (ctx->operation_mode == inference)
+    {
+        return;
+    }
+
+    ctx->window_bitmaps = (uint8_t **)malloc(sizeof(uint8_t *) * ctx->L);
+    ctx->valid_windows = (int64_t **)malloc(sizeof(int64_t *) * ctx->L);
+    ctx->valid_window_counts = (int64_t *)malloc(sizeof(int64_t) * ctx->L);
+    ctx->work_offsets = (int64_t *)malloc(sizeof(int64_t) * (ctx->L + 1));
+    loaded = (int *)malloc(sizeof(int) * ctx->L);
+
+    // Load what can be loaded
+    ctx->work_offsets[0] = 0;
+    for (int pair = 0; pair < ctx->L; ++pair)
+    {
+        uint64_t num_bytes = (window_count(ctx, pair) + 7) / 8;
+
+        ctx->window_bitmaps[pair] = (uint8_t *)calloc(num_bytes + 1, sizeof(uint8_t));
+        loaded[pair] = load_sidecar(ctx, pair);
+        ctx->work_offsets[pair + 1] = ctx->work_offsets[pair];
+        if (!loaded[pair])
+        {
+            ctx->work_offsets[pair + 1] += (num_bytes + WINDOW_CHUNK_BYTES - 1) / WINDOW_CHUNK_BYTES;
+        }
+    }
+
+    // Build the rest
+    if (ctx->work_offsets[ctx->L] > 0)
+    {
+        pthread_t *threads = (pthread_t *)malloc(sizeof(pthread_t) * ctx->N);
+
+        ctx->work_next = 0;
+        for (int i = 0; i < ctx->N; ++i)
+        {
+            pthread_create(&threads[i], NULL, builder, &ctx->thread_args[i]);
+        }
+        for (int i = 0; i < ctx->N; ++i)
+        {
+            pthread_join(threads[i], NULL);
+        }
+        free(threads);
+        for (int pair = 0; pair < ctx->L; ++pair)
+        {
+            if (!loaded[pair])
+            {
+                save_sidecar(ctx, pair);
+            }
+        }
+    }
+    free(loaded);
+    free(ctx->work_offsets);
+    ctx->work_offsets = NULL;
+
+    // Gather the valid windows
+    for (int pair = 0; pair < ctx->L; ++pair)
+    {
+        int columns = ctx->widths[pair] / ctx->window_size_imagery;
+        int64_t n = window_count(ctx, pair);
+        int64_t count = 0;
+
+        ctx->valid_windows[pair] = (int64_t *)malloc(sizeof(int64_t) * (n + 1));
+        for (int64_t i = 0; i < n; ++i)
+        {
+            if (window_valid(ctx, pair, i % columns, i / columns))
+            {
+                ctx->valid_windows[pair][count++] = i;
+            }
+        }
+        ctx->valid_windows[pair] = (int64_t *)realloc(ctx->valid_windows[pair], sizeof(int64_t) * (count + 1));
+        ctx->valid_window_counts[pair] = count;
+        total += count;
+    }
+    if (total == 0)
+    {
+        fprintf(stderr, "NO VALID WINDOWS IN ANY PAIR\n");
+    }
+
+    pairs_reweight(ctx);
+}
+
+/**
+ * Release the window bitmaps and lists.
+ *
+ * @param ctx The context
+ */
+void windows_deinit(struct context *ctx)
+{
+    if (ctx->window_bitmaps == NULL)
+    {
+        return;
+    }
+    for (int pair = 0; pair < ctx->L; ++pair)
+    {
+        free(ctx->window_bitmaps[pair]);
+        free(ctx->valid_windows[pair]);
+    }
+    free(ctx->window_bitmaps);
+    free(ctx->valid_windows);
+    free(ctx->valid_window_counts);
+    ctx->window_bitmaps = NULL;
+    ctx->valid_windows = NULL;
+    ctx->valid_window_counts = NULL;
+}
+
+/**
+ * Is a window whole and not empty?
+ *
+ * @param ctx The context
+ * @param pair The index of the pair
+ * @param x_windows The x-coordinate of the window (in windows)
+ * @param y_windows The y-coordinate of the window (in windows)
+ * @return 1 if the window is whole and has data, 0 otherwise
+ */
+int window_nonempty(struct context *ctx, int pair, int x_windows, int y_windows)
+{
+    int64_t i;
+
+    if (BAD_WINDOW)
+    {
+        return 0;
+    }
+    i = (int64_t)y_windows * (ctx->widths[pair] / ctx->window_size_imagery) + x_windows;
+
+    return (ctx->window_bitmaps[pair][i / 8] >> (i % 8)) & 1;
+}
+
+/**
+ * Is a window whole, not empty, and in the split of the current
+ * operation mode?
+ *
+ * @param ctx The context
+ * @param pair The index of the pair
+ * @param x_windows The x-coordinate of the window (in windows)
+ * @param y_windows The y-coordinate of the window (in windows)
+ * @return 1 if the window may be sampled, 0 otherwise
+ */
+int window_valid(struct context *ctx, int pair, int x_windows, int y_windows)
+{
+    if (RUNNING && BAD_SPLIT_WINDOW)
+    {
+        return 0;
+    }
+    return window_nonempty(ctx, pair, x_windows, y_windows);
+}
+
+/**
+ * Choose a valid window of a pair from one of its strata.  The valid
+ * windows (in row-major order) are divided into bands of roughly the
+ * area sampled around one center, so that choosing from the bands in
+ * turn sweeps centers over the whole pair.
+ *
+ * @param ctx The context
+ * @param pair The index of the pair
+ * @param round The number of times that a center has been chosen for the pair before
+ * @param state The random state of the calling thread
+ * @param x_windows The return-location for the x-coordinate of the window (in windows)
+ * @param y_windows The return-location for the y-coordinate of the window (in windows)
+ * @return 1 for success, 0 if the pair has no valid windows (or they are not known)
+ */
+int choose_stratified_window(struct context *ctx, int pair, int round, unsigned int *state, int *x_windows, int *y_windows)
+{
+    int64_t count = (ctx->valid_window_counts != NULL) ? ctx->valid_window_counts[pair] : 0;
+    int64_t wradius = ctx->radius / ctx->window_size_imagery;
+    int64_t per_stratum = (wradius > 0) ? 4 * wradius * wradius : 1;
+    int columns = ctx->widths[pair] / ctx->window_size_imagery;
+    int64_t strata, stratum, lo, hi;
+    uint64_t r;
+    int64_t i;
+
+    if (count == 0)
+    {
+        return 0;
+    }
+    strata = (count + per_stratum - 1) / per_stratum;
+    stratum = round % strata;
+    lo = (stratum * count) / strata;
+    hi = ((stratum + 1) * count) / strata;
+    r = ((uint64_t)rand_r(state) << 31) | (uint64_t)rand_r(state);
+    i = ctx->valid_windows[pair][lo + (r % (hi - lo))];
+    *x_windows = i % columns;
+    *y_windows = i / columns;
+
+    return 1;
+}
+
+/**
+ * Choose one of the valid windows of a pair uniformly at random.
+ *
+ * @param ctx The context
+ * @param pair The index of the pair
+ * @param state The random state of the calling thread
+ * @param x_windows The return-location for the x-coordinate of the window (in windows)
+ * @param y_windows The return-location for the y-coordinate of the window (in windows)
+ * @return 1 for success, 0 if the pair has no valid windows (or they are not known)
+ */
+int choose_window(struct context *ctx, int pair, unsigned int *state, int *x_windows, int *y_windows)
+{
+    int64_t count = (ctx->valid_window_counts != NULL) ? ctx->valid_window_counts[pair] : 0;
+    int columns = ctx->widths[pair] / ctx->window_size_imagery;
+    uint64_t r;
+    int64_t i;
+
+    if (count == 0)
+    {
+        return 0;
+    }
+    r = ((uint64_t)rand_r(state) << 31) | (uint64_t)rand_r(state);
+    i = ctx->valid_windows[pair][r % count];
+    *x_windows = i % columns;
+    *y_windows = i / columns;
+
+    return 1;
+}
@@ -0,0 +1,59 @@
+/*
+ * The MIT License (MIT)
+ * =====================
+ *
+ * Copyright © 2019-2020 Azavea
+ *
+ * Permission is hereby granted, free of charge, to any person
+ * obtaining a copy of this software and associated documentation
+ * files (the “Software”), to deal in the Software without
+ * restriction, including without limitation the rights to use,
+ * copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following
+ * conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+ * OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+ * HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+ * WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+ * OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+#ifndef __WINDOWS_H__
+#define __WINDOWS_H__
+
+#include <stdint.h>
+
+struct context;
+
+// The header of a valid-window sidecar file (followed by the bitmap)
+struct window_sidecar_header
+{
+    char magic[8];
+    int32_t window_size;
+    int32_t width;
+    int32_t height;
+    int32_t reserved;
+    uint64_t identity;
+};
+
+void windows_init(struct context *ctx);
+
+void windows_deinit(struct context *ctx);
+
+int window_nonempty(struct context *ctx, int pair, int x_windows, int y_windows);
+
+int window_valid(struct context *ctx, int pair, int x_windows, int y_windows);
+
+int choose_stratified_window(struct context *ctx, int pair, int round, unsigned int *state, int *x_windows, int *y_windows);
+
+int choose_window(struct context *ctx, int pair, unsigned int *state, int *x_windows, int *y_windows);
+
+#endif